@@ -0,0 +1,382 @@
+'''
+Storage backends underneath pyphotdb.database.
+
+A backend knows how to open connections, create cursors and turn the MySQL flavoured
+schema and statements used by database into what its engine understands:
+
+  mysqlBackend   pooled mysql.connector connections to the shared production server
+  sqliteBackend  an embedded SQLite file in WAL mode, for single-node reductions and tests
+
+Statements are written with %s / %(name)s parameters and backtick quoted identifiers; the
+SQLite backend translates parameters to ? / :name on the fly.
+
+@author: harbeck
+'''
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import mysql.connector as mysql
+    from mysql.connector import pooling
+except ImportError:
+    mysql = None
+
+
+# database errors of all available drivers, for use in except clauses
+Error = (sqlite3.Error,) if mysql is None else (mysql.Error, sqlite3.Error)
+
+
+class mysqlBackend(object):
+    '''
+    MySQL / InnoDB through mysql.connector, with one connection pool per process and server.
+    '''
+
+    name = 'mysql'
+
+    # connections per pool, i.e., per database and process
+    POOLSIZE = 8
+
+    # seconds to wait for a free pooled connection before giving up
+    POOLTIMEOUT = 60.
+
+    # connection pools by process id and connection parameters; pools do not survive a fork
+    _pools = {}
+    _poolLock = threading.Lock()
+
+    def __init__(self, host, port, dbuser, dbpass, dbname, poolsize=None):
+        if mysql is None:
+            raise ImportError("mysql.connector is required for the MySQL backend")
+        self.dbhost = host
+        self.dbport = port
+        self.dbuser = dbuser
+        self.dbpass = dbpass
+        self.dbname = dbname
+        self.poolsize = poolsize if poolsize is not None else self.POOLSIZE
+
+    def _pool(self):
+        '''
+        The connection pool for this database in the current process, created on first use.
+        '''
+        key = (os.getpid(), self.dbhost, self.dbport, self.dbuser, self.dbname)
+        with self._poolLock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = pooling.MySQLConnectionPool(pool_name="pyphotdb_%d_%d" % (os.getpid(), len(self._pools)),
+                                                   pool_size=self.poolsize,
+                                                   host=self.dbhost, port=self.dbport,
+                                                   user=self.dbuser, password=self.dbpass,
+                                                   database=self.dbname,
+                                                   charset='latin1', use_unicode=False)
+                self._pools[key] = pool
+        return pool
+
+    def connect(self):
+        '''
+        Borrow a connection from the pool, waiting up to POOLTIMEOUT seconds for one to be
+        returned if all are in use. Closing the connection returns it to the pool.
+        '''
+        pool = self._pool()
+        deadline = time.time() + self.POOLTIMEOUT
+        while True:
+            try:
+                return pool.get_connection()
+            except mysql.PoolError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def cursor(self, conn, dictionary=False, prepared=False, buffered=True):
+        '''
+        A cursor on conn: rows as dicts, a server-side prepared statement, or streamed
+        from the server (buffered=False).
+        '''
+        if prepared:
+            return conn.cursor(prepared=True)
+        if dictionary:
+            return conn.cursor(dictionary=True)
+        if not buffered:
+            return conn.cursor(buffered=False)
+        return conn.cursor()
+
+    def schema(self, ddl):
+        '''
+        Statements that create a table from its MySQL DDL.
+        '''
+        return [ddl]
+
+    def tableExists(self, err):
+        return getattr(err, 'errno', None) == mysql.errorcode.ER_TABLE_EXISTS_ERROR
+
+    def hasColumn(self, cursor, table, column):
+        cursor.execute("SELECT COUNT(*) FROM information_schema.columns"
+                       " WHERE table_schema = %s AND table_name = %s AND column_name = %s",
+                       (self.dbname, table, column))
+        return cursor.fetchone()[0] > 0
+
+    def addZoneColumn(self, cursor, table, zonecolumn):
+        cursor.execute("ALTER TABLE `%s` ADD COLUMN %s, ADD INDEX `zone_ra` (`zoneid`, `ra`)"
+                       % (table, zonecolumn))
+
+    def firstInsertId(self, cursor, nrows):
+        '''
+        Id of the first row of the multi-row insert just executed on cursor.
+        '''
+        return cursor.lastrowid
+
+    def updateJoin(self, table, alias, source, salias, on, assignments, condition):
+        '''
+        UPDATE of table (as alias) from the matching rows of source (as salias); assignments are
+        (column, expression) pairs.
+        '''
+        return ("UPDATE `%s` %s INNER JOIN `%s` %s ON %s SET %s WHERE %s" %
+                (table, alias, source, salias, on,
+                 ", ".join("%s.`%s` = %s" % (alias, column, expression) for column, expression in assignments),
+                 condition))
+
+    def upsert(self, table, columns, keys, merge):
+        '''
+        INSERT statement for columns that merges into an existing row with the same keys;
+        merge maps columns to 'add', 'min' or 'max', how the new value combines with the stored one.
+        '''
+        return (_insertStatement(table, columns) + " ON DUPLICATE KEY UPDATE " +
+                ", ".join(_mergeExpression(column, how, "VALUES(`%s`)" % column, 'LEAST', 'GREATEST')
+                          for column, how in merge.iteritems()))
+
+
+def _convertDatetime(value):
+    value = value.replace('T', ' ')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+sqlite3.register_converter('datetime', _convertDatetime)
+for _type, _python in ((np.int32, int), (np.int64, int), (np.float32, float), (np.float64, float)):
+    sqlite3.register_adapter(_type, _python)
+
+
+class sqliteCursor(object):
+    '''
+    Wraps a sqlite3 cursor so that statements with %s / %(name)s parameters can be executed.
+    '''
+
+    def __init__(self, backend, cursor):
+        self.backend = backend
+        self.cursor = cursor
+
+    def execute(self, sqlCommand, data=()):
+        return self.cursor.execute(self.backend.translate(sqlCommand), data)
+
+    def executemany(self, sqlCommand, rows):
+        return self.cursor.executemany(self.backend.translate(sqlCommand), rows)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def _dictRow(cursor, row):
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+class sqliteBackend(object):
+    '''
+    An embedded SQLite database file. Every connection runs in WAL mode, so one writer and
+    any number of readers (e.g., the streaming reader of matchVisits) work concurrently.
+
+    The file must be on a local disk; ':memory:' works for a single connection only, as
+    clones and readers would each see their own empty database.
+    '''
+
+    name = 'sqlite'
+
+    # applied to every new connection
+    PRAGMAS = ("journal_mode=WAL",
+               "synchronous=NORMAL",
+               "cache_size=-262144",
+               "temp_store=MEMORY",
+               "mmap_size=1073741824",
+               "busy_timeout=60000")
+
+    # statements cached per connection by sqlite3
+    STATEMENTCACHE = 128
+
+    log = logging.getLogger('sqliteBackend')
+
+    def __init__(self, filename):
+        self.dbname = filename
+        self.statements = {}
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbname, timeout=60., detect_types=sqlite3.PARSE_DECLTYPES,
+                               cached_statements=self.STATEMENTCACHE)
+        conn.text_factory = str
+        conn.create_function('FLOOR', 1, _floor)
+        conn.create_function('LOG10', 1, _log10)
+        conn.create_function('POWER', 2, _power)
+        for pragma in self.PRAGMAS:
+            conn.execute("PRAGMA %s" % pragma)
+        return conn
+
+    def translate(self, sqlCommand):
+        '''
+        sqlCommand with %s / %(name)s parameters rewritten as ? / :name.
+        '''
+        translated = self.statements.get(sqlCommand)
+        if translated is None:
+            translated = PARAMETER.sub(_sqliteParameter, sqlCommand)
+            self.statements[sqlCommand] = translated
+        return translated
+
+    def cursor(self, conn, dictionary=False, prepared=False, buffered=True):
+        '''
+        sqlite3 steps through results row by row and caches compiled statements itself, so
+        prepared and buffered make no difference here.
+        '''
+        cursor = conn.cursor()
+        if dictionary:
+            cursor.row_factory = _dictRow
+        return sqliteCursor(self, cursor)
+
+    def schema(self, ddl):
+        '''
+        Translate MySQL CREATE TABLE DDL: AUTO_INCREMENT keys become INTEGER PRIMARY KEY
+        AUTOINCREMENT (rowid) columns, inline indexes become CREATE INDEX statements, FLOOR in
+        generated columns becomes an integer CAST (the zone expressions are never negative),
+        and table options are dropped.
+        '''
+        table = re.search(r"CREATE TABLE (?:IF NOT EXISTS )?`(\w+)`", ddl).group(1)
+        body = ddl[ddl.index('(') + 1:ddl.rindex(')')]
+
+        columns = []
+        indexes = []
+        autoincrement = None
+        for definition in _splitDefinitions(body):
+            match = re.match(r"(?:INDEX|KEY)\s*(?:`(\w+)`)?\s*\((.*)\)$", definition, re.I)
+            if match is not None:
+                name = match.group(1) or "_".join(re.findall(r"`(\w+)`", match.group(2)))
+                indexes.append("CREATE INDEX IF NOT EXISTS `%s_%s` ON `%s` (%s)"
+                               % (table, name, table, match.group(2)))
+                continue
+            match = re.match(r"(`\w+`)\s+\w+(?:\(\d+\))?\s+NOT NULL\s+AUTO_INCREMENT$", definition, re.I)
+            if match is not None:
+                autoincrement = match.group(1)
+                columns.append("%s INTEGER PRIMARY KEY AUTOINCREMENT" % autoincrement)
+                continue
+            if autoincrement is not None and re.match(r"PRIMARY KEY\s*\(%s\)$" % autoincrement, definition, re.I):
+                continue
+            columns.append(_floorToCast(definition))
+
+        create = ddl[:ddl.index('(')] + "(" + ", ".join(columns) + ")"
+        return [create] + indexes
+
+    def tableExists(self, err):
+        return 'already exists' in str(err)
+
+    def hasColumn(self, cursor, table, column):
+        cursor.execute("PRAGMA table_xinfo(`%s`)" % table)
+        return column in [row[1] for row in cursor.fetchall()]
+
+    def addZoneColumn(self, cursor, table, zonecolumn):
+        # SQLite can only add virtual generated columns to existing tables
+        cursor.execute("ALTER TABLE `%s` ADD COLUMN %s" % (table, _floorToCast(zonecolumn).replace(" STORED", " VIRTUAL")))
+        cursor.execute("CREATE INDEX IF NOT EXISTS `%s_zone_ra` ON `%s` (`zoneid`, `ra`)" % (table, table))
+
+    def firstInsertId(self, cursor, nrows):
+        '''
+        Id of the first row of the multi-row insert just executed on cursor. Writers are
+        serialized by SQLite, so the rows of one executemany get consecutive ids.
+        '''
+        cursor.execute("SELECT last_insert_rowid()")
+        return cursor.fetchone()[0] - nrows + 1
+
+    def updateJoin(self, table, alias, source, salias, on, assignments, condition):
+        '''
+        UPDATE of table (as alias) from the matching rows of source (as salias); assignments are
+        (column, expression) pairs.
+        '''
+        return ("UPDATE `%s` AS %s SET %s FROM `%s` AS %s WHERE (%s) AND (%s)" %
+                (table, alias, ", ".join("`%s` = %s" % (column, expression) for column, expression in assignments),
+                 source, salias, on, condition))
+
+    def upsert(self, table, columns, keys, merge):
+        '''
+        INSERT statement for columns that merges into an existing row with the same keys;
+        merge maps columns to 'add', 'min' or 'max', how the new value combines with the stored one.
+        '''
+        return (_insertStatement(table, columns) +
+                " ON CONFLICT (%s) DO UPDATE SET " % ", ".join("`%s`" % key for key in keys) +
+                ", ".join(_mergeExpression(column, how, "excluded.`%s`" % column, 'MIN', 'MAX')
+                          for column, how in merge.iteritems()))
+
+
+def _insertStatement(table, columns):
+    return "INSERT INTO `%s` (%s) VALUES (%s)" % (table, ", ".join("`%s`" % column for column in columns),
+                                                  ", ".join(["%s"] * len(columns)))
+
+
+def _mergeExpression(column, how, new, least, greatest):
+    if how == 'add':
+        return "`%s` = `%s` + %s" % (column, column, new)
+    function = least if how == 'min' else greatest
+    return "`%s` = COALESCE(%s(`%s`, %s), `%s`, %s)" % (column, function, column, new, column, new)
+
+
+PARAMETER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+def _sqliteParameter(match):
+    if match.group(1) is not None:
+        return ":" + match.group(1)
+    return "?" if match.group(0) == "%s" else "%"
+
+
+def _splitDefinitions(body):
+    '''
+    Split the body of a CREATE TABLE at top level commas.
+    '''
+    definitions = []
+    depth = 0
+    current = []
+    for char in body:
+        if char == ',' and depth == 0:
+            definitions.append("".join(current).strip())
+            current = []
+            continue
+        depth += (char == '(') - (char == ')')
+        current.append(char)
+    definitions.append("".join(current).strip())
+    return [definition for definition in definitions if len(definition) > 0]
+
+
+def _floorToCast(definition):
+    '''
+    Replace FLOOR(x) by CAST(x AS INTEGER), which is the same for x >= 0 and, unlike a
+    Python function, allowed in generated columns.
+    '''
+    start = definition.find('FLOOR(')
+    while start >= 0:
+        depth = 0
+        for end in range(start + 5, len(definition)):
+            depth += (definition[end] == '(') - (definition[end] == ')')
+            if depth == 0:
+                break
+        definition = "%sCAST(%s AS INTEGER)%s" % (definition[:start], definition[start + 6:end], definition[end + 1:])
+        start = definition.find('FLOOR(')
+    return definition
+
+
+def _floor(value):
+    return None if value is None else int(np.floor(value))
+
+def _log10(value):
+    return None if value is None or value <= 0 else float(np.log10(value))
+
+def _power(value, exponent):
+    return None if value is None or exponent is None else float(value) ** exponent
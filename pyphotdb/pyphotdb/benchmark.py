@@ -0,0 +1,335 @@
+'''
+Reproducible benchmarks of ingestion, matching and queries on synthetic ODI data.
+
+A synthetic sky of stars is observed by dithered exposures with the ODI focal plane layout:
+every exposure is written as an ODI file with a CAT.PHOTCALIB table (the stars with SDSS
+reference photometry) and as a SExtractor ASCII catalogue (all detections). The files are
+ingested into fresh SQLite databases with odiQRIngester and sextractorIngestor, then
+findaddObjects, matchVisits, getVisits and findObjects are timed. Everything derives from
+one random seed, so runs at the same scale and seed see identical data.
+
+For every stage the report lists the number of operations, throughput, latency percentiles,
+the peak resident memory and how much the stage raised it, as JSON for regression tracking.
+Every scale runs in a fresh process, so its memory figures do not include earlier scales:
+
+    python benchmark.py --scale small medium --output bench.json
+
+@author: harbeck
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import astropy.io.fits as fits
+import numpy as np
+
+import database
+import odidb
+
+
+# benchmark scales: number of exposures, stars in the synthetic field, queries per query stage
+SCALES = {'tiny': {'exposures': 3, 'stars': 2000, 'queries': 50},
+          'small': {'exposures': 10, 'stars': 20000, 'queries': 200},
+          'medium': {'exposures': 40, 'stars': 100000, 'queries': 500},
+          'large': {'exposures': 100, 'stars': 400000, 'queries': 1000}}
+
+# latency percentiles reported per stage
+PERCENTILES = (50, 90, 99)
+
+# pixel scale in arcsec, and the OTAs of the 5odi focal plane as (otax, otay)
+PIXELSCALE = 0.11
+OTAS = [(otax, otay) for otax in range(1, 6) for otay in range(1, 7)]
+
+# light sensitive pixels per OTA side; the remaining pixels of the 4200 pixel pitch are gaps
+OTASIZE = 4000
+OTAPITCH = 4200
+
+# dither offsets in arcmin between exposures, and field centre of the synthetic sky
+DITHER = 5.
+FIELDCENTER = (23.46, 30.66)
+
+# stars brighter than this have SDSS reference photometry; detection limit of the exposures
+REFERENCELIMIT = 21.
+DETECTIONLIMIT = 23.5
+
+log = logging.getLogger('benchmark')
+
+
+def peakMemory():
+    '''
+    Peak resident memory of this process in MB.
+    '''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1024. * 1024.) if sys.platform == 'darwin' else maxrss / 1024.
+
+
+class stageTimer(object):
+    '''
+    Collect per operation latencies of one benchmark stage.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.items = 0
+        self.start = time.time()
+        self.startmemory = peakMemory()
+
+    def time(self, function, *args, **kwargs):
+        '''
+        Call function, record its latency and return its result.
+        '''
+        start = time.time()
+        result = function(*args, **kwargs)
+        self.latencies.append(time.time() - start)
+        return result
+
+    def report(self):
+        elapsed = time.time() - self.start
+        latencies = np.array(self.latencies) * 1000.
+        report = {'operations': len(self.latencies),
+                  'items': self.items,
+                  'elapsed': elapsed,
+                  'opspersec': len(self.latencies) / elapsed if elapsed > 0 else 0.,
+                  'itemspersec': self.items / elapsed if elapsed > 0 else 0.,
+                  'peakmemorymb': peakMemory(),
+                  'memorygrowthmb': peakMemory() - self.startmemory}
+        for percentile in PERCENTILES:
+            report['p%d_ms' % percentile] = float(np.percentile(latencies, percentile)) if len(latencies) > 0 else None
+        report['max_ms'] = float(np.max(latencies)) if len(latencies) > 0 else None
+        log.info("%-16s %6d ops %8d items in %7.2f s, p50 %s ms, peak %.0f MB (+%.0f MB)" %
+                 (self.name, report['operations'], self.items, elapsed, report['p50_ms'], report['peakmemorymb'],
+                  report['memorygrowthmb']))
+        return report
+
+
+class syntheticSky(object):
+    '''
+    A field of stars observed by dithered ODI exposures.
+    '''
+
+    def __init__(self, nstars, seed=0, center=FIELDCENTER):
+        self.rng = np.random.RandomState(seed)
+        self.center = center
+        # the field covers the focal plane plus the dither pattern
+        halfwidth = (max(OTAS)[0] + 1) * OTAPITCH * PIXELSCALE / 3600. / 2. + DITHER / 60.
+        cosdec = np.cos(np.radians(center[1]))
+        self.ra = center[0] + self.rng.uniform(-halfwidth, halfwidth, nstars) / cosdec
+        self.dec = center[1] + self.rng.uniform(-halfwidth, halfwidth, nstars)
+        # roughly a power law luminosity function
+        self.mag = DETECTIONLIMIT + 0.5 - np.log10(1. + self.rng.uniform(0, 1e3, nstars)) * 3.
+        colors = self.rng.normal(0.5, 0.3, nstars)
+        self.sdss = {'u': self.mag + 1.5 * colors + 0.5, 'g': self.mag + colors, 'r': self.mag,
+                     'i': self.mag - 0.3 * colors, 'z': self.mag - 0.5 * colors}
+
+    def observe(self, index, exptime=100., photzp=26.):
+        '''
+        Detections of exposure index: a dict of star index, positions, instrumental magnitudes,
+        errors, OTA and OTA pixel coordinates, plus the exposure header values.
+        '''
+        rng = np.random.RandomState(self.rng.randint(2 ** 31) + index)
+        cosdec = np.cos(np.radians(self.center[1]))
+        pointing = (self.center[0] + rng.uniform(-DITHER, DITHER) / 60. / cosdec,
+                    self.center[1] + rng.uniform(-DITHER, DITHER) / 60.)
+
+        # global focal plane pixels, origin at the corner of OTA 00
+        focalcenter = (max(OTAS)[0] + 1) * OTAPITCH / 2., (max(OTAS)[1] + 1) * OTAPITCH / 2.
+        x = (self.ra - pointing[0]) * cosdec * 3600. / PIXELSCALE + focalcenter[0]
+        y = (self.dec - pointing[1]) * 3600. / PIXELSCALE + focalcenter[1]
+        otax, odix = np.divmod(x, OTAPITCH)
+        otay, odiy = np.divmod(y, OTAPITCH)
+        onchip = (odix < OTASIZE) & (odiy < OTASIZE) & (x >= 0) & (y >= 0)
+        onchip &= np.in1d((otax * 10 + otay).astype(np.int64), [10 * ox + oy for ox, oy in OTAS])
+
+        zpoffset = rng.normal(0, 0.03)
+        magerr = 0.005 + 0.2 * 10 ** (0.4 * (self.mag - DETECTIONLIMIT))
+        detected = onchip & (self.mag + rng.normal(0, 0.1, len(self.mag)) < DETECTIONLIMIT)
+        stars = np.flatnonzero(detected)
+        jitter = 0.1 / 3600.
+        return {'stars': stars,
+                'ra': self.ra[stars] + rng.normal(0, jitter, len(stars)) / cosdec,
+                'dec': self.dec[stars] + rng.normal(0, jitter, len(stars)),
+                'mag': (self.mag[stars] - photzp - 2.5 * np.log10(exptime) + zpoffset +
+                        rng.normal(0, 1, len(stars)) * magerr[stars]),
+                'magerr': magerr[stars],
+                'ota': (otax[stars] * 10 + otay[stars]).astype(np.int64),
+                'odix': odix[stars], 'odiy': odiy[stars],
+                'obsid': 'bench%05d' % index,
+                'dateobs': datetime(2016, 1, 1) + timedelta(hours=index),
+                'exptime': exptime, 'photzp': photzp, 'airmass': 1. + rng.uniform(0, 0.5)}
+
+    def writeODIFile(self, filename, exposure):
+        '''
+        An ODI file with the exposure header and the CAT.PHOTCALIB table of the reference stars.
+        '''
+        primary = fits.PrimaryHDU()
+        primary.header['OBSID'] = exposure['obsid']
+        primary.header['FILTER'] = 'odi_r'
+        primary.header['AIRMASS'] = exposure['airmass']
+        primary.header['EXPTIME'] = exposure['exptime']
+        primary.header['PHOTZP'] = exposure['photzp']
+        primary.header['DATE-MID'] = exposure['dateobs'].isoformat()
+
+        reference = self.mag[exposure['stars']] < REFERENCELIMIT
+        stars = exposure['stars'][reference]
+        columns = [fits.Column(name='SDSS_RA', format='D', array=self.ra[stars]),
+                   fits.Column(name='SDSS_DEC', format='D', array=self.dec[stars])]
+        for band in ('u', 'g', 'r', 'i', 'z'):
+            columns.append(fits.Column(name='SDSS_MAG_%s' % band.upper(), format='E', array=self.sdss[band][stars]))
+        for name, key, format in (('ODI_RA', 'ra', 'D'), ('ODI_DEC', 'dec', 'D'), ('ODI_MAG_AUTO', 'mag', 'E'),
+                                  ('ODI_ERR_AUTO', 'magerr', 'E'), ('ODI_X', 'odix', 'E'), ('ODI_Y', 'odiy', 'E'),
+                                  ('ODI_OTA', 'ota', 'E')):
+            columns.append(fits.Column(name=name, format=format, array=exposure[key][reference]))
+        table = fits.BinTableHDU.from_columns(columns, name='CAT.PHOTCALIB')
+        fits.HDUList([primary, table]).writeto(filename, overwrite=True)
+
+    @staticmethod
+    def writeSexCatalog(filename, exposure):
+        '''
+        A SExtractor ASCII_HEAD catalogue of all detections of the exposure.
+        '''
+        names = ('NUMBER', 'MAG_AUTO', 'MAGERR_AUTO', 'X_IMAGE', 'Y_IMAGE', 'ALPHA_J2000', 'DELTA_J2000')
+        nrows = len(exposure['stars'])
+        data = np.column_stack((np.arange(1, nrows + 1), exposure['mag'], exposure['magerr'],
+                                exposure['odix'], exposure['odiy'], exposure['ra'], exposure['dec']))
+        header = "\n".join("%4d %s" % (ii + 1, name) for ii, name in enumerate(names))
+        np.savetxt(filename, data, fmt=['%d', '%.4f', '%.4f', '%.2f', '%.2f', '%.7f', '%.7f'],
+                   header=header, comments='#')
+
+
+def generate(directory, nexposures, nstars, seed=0):
+    '''
+    Write the synthetic ODI files and SExtractor catalogues of nexposures exposures into
+    directory. Returns the sky and a list of (odi file, SExtractor catalogue) pairs.
+    '''
+    sky = syntheticSky(nstars, seed)
+    files = []
+    for index in range(nexposures):
+        exposure = sky.observe(index)
+        odifile = os.path.join(directory, '%s.fits' % exposure['obsid'])
+        sexfile = os.path.join(directory, '%s.cat' % exposure['obsid'])
+        sky.writeODIFile(odifile, exposure)
+        sky.writeSexCatalog(sexfile, exposure)
+        files.append((odifile, sexfile))
+    return sky, files
+
+
+def run(scale, seed=0, workdir=None, keep=False):
+    '''
+    Run all benchmark stages at one scale (a SCALES key or a dict like its values).
+    Returns the report as a dict.
+    '''
+    parameters = SCALES[scale] if isinstance(scale, basestring) else scale
+    workdir = tempfile.mkdtemp(prefix='pyphotdb-bench-', dir=workdir)
+    rng = np.random.RandomState(seed)
+    stages = {}
+    try:
+        timer = stageTimer('generate')
+        sky, files = timer.time(generate, workdir, parameters['exposures'], parameters['stars'], seed)
+        timer.items = len(files)
+        stages['generate'] = timer.report()
+
+        db = database.sqliteDatabase(os.path.join(workdir, 'bench.db'))
+        db.createDatabase()
+
+        timer = stageTimer('odiQRIngester')
+        for odifile, sexfile in files:
+            timer.time(odidb.odiQRIngester, odifile, db)
+            timer.items += len(fits.getdata(odifile, 'CAT.PHOTCALIB'))
+        stages['odiQRIngester'] = timer.report()
+
+        # the SExtractor catalogues describe the same exposures, so they go into a database of their own
+        sexdb = database.sqliteDatabase(os.path.join(workdir, 'sextractor.db'))
+        sexdb.createDatabase()
+        timer = stageTimer('sextractor')
+        for odifile, sexfile in files:
+            timer.items += timer.time(odidb.sextractorIngestor(odifile, sexfile, sexdb).readSexFile)
+        stages['sextractor'] = timer.report()
+        sexdb.closeDataBase()
+
+        # re-adding known stars resolves them against the existing objects
+        timer = stageTimer('findaddObjects')
+        sample = rng.choice(len(sky.ra), min(len(sky.ra), 1000 * parameters['exposures']), replace=False)
+        for chunk in np.array_split(sample, parameters['exposures']):
+            objects = []
+            for star in chunk.tolist():
+                obj = database.photObject(float(sky.ra[star]), float(sky.dec[star]))
+                for band in ('u', 'g', 'r', 'i', 'z'):
+                    obj.data['sdss_%s' % band] = float(sky.sdss[band][star])
+                objects.append(obj)
+            timer.time(db.findaddObjects, objects)
+            timer.items += len(objects)
+        stages['findaddObjects'] = timer.report()
+
+        timer = stageTimer('matchVisits')
+        timer.items = timer.time(db.matchVisits, 0.5) or 0
+        stages['matchVisits'] = timer.report()
+
+        objectids = db.getObjectStats(minVisits=2)['objectid']
+        timer = stageTimer('getVisits')
+        for objectid in rng.choice(objectids, min(len(objectids), parameters['queries']), replace=False).tolist():
+            timer.items += len(timer.time(db.getVisits, objectid))
+        stages['getVisits'] = timer.report()
+
+        timer = stageTimer('findObjects')
+        for star in rng.randint(0, len(sky.ra), parameters['queries']).tolist():
+            timer.items += len(timer.time(db.findObjects, float(sky.ra[star]), float(sky.dec[star]), 10.))
+        stages['findObjects'] = timer.report()
+
+        db.closeDataBase()
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'scale': scale if isinstance(scale, basestring) else 'custom',
+            'parameters': parameters,
+            'seed': seed,
+            'stages': stages}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARN)
+    log.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark pyphotdb on synthetic ODI data')
+    parser.add_argument('--scale', nargs='+', default=['small'], choices=sorted(SCALES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory for the temporary files')
+    parser.add_argument('--keep', action='store_true', help='keep the generated files and database')
+    parser.add_argument('--output', help='JSON report file; default standard output')
+    args = parser.parse_args()
+
+    runs = []
+    for scale in args.scale:
+        # a fresh process per scale, as ru_maxrss never decreases
+        pool = multiprocessing.Pool(1)
+        try:
+            runs.append(pool.apply(run, (scale, args.seed, args.workdir, args.keep)))
+        finally:
+            pool.close()
+            pool.join()
+
+    report = {'created': datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'runs': runs}
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+    else:
+        with open(args.output, 'w') as outf:
+            json.dump(report, outf, indent=1)
@@ -0,0 +1,238 @@
+'''
+In-memory positional cross-matching of visits against reference objects.
+
+Reference positions are held in a declination zone index: the sky is cut into
+zones of constant declination height, and within each zone the positions are
+sorted by right ascension. A batch of query positions is then matched with a
+handful of vectorized binary searches instead of one database query per position.
+
+@author: harbeck
+'''
+
+import numpy as np
+
+
+# declination zones per degree; the database `zoneid` columns use the same zoning
+ZONESPERDEGREE = 60
+
+# height of one declination zone in degrees
+ZONEHEIGHT = 1. / ZONESPERDEGREE
+
+# size of the sky tiles used to fetch reference objects from the database, in degrees
+TILESIZE = 1.
+
+# number of query positions processed at once, bounds the size of the candidate pair arrays
+QUERYCHUNK = 100000
+
+
+def angularSeparation (ra1, dec1, ra2, dec2):
+    '''
+    Great circle distance in degrees between (ra1, dec1) and (ra2, dec2), all in degrees.
+    Uses the haversine formula, which is accurate at small separations. Accepts arrays.
+    '''
+    ra1 = np.radians(ra1)
+    dec1 = np.radians(dec1)
+    ra2 = np.radians(ra2)
+    dec2 = np.radians(dec2)
+
+    sdec = np.sin((dec2 - dec1) / 2.)
+    sra = np.sin((ra2 - ra1) / 2.)
+    a = sdec * sdec + np.cos(dec1) * np.cos(dec2) * sra * sra
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(a, 0., 1.))))
+
+
+def zoneOf (dec, zoneheight=ZONEHEIGHT):
+    '''
+    Declination zone number(s) for dec in degrees.
+    '''
+    return np.floor((np.asarray(dec, dtype=np.float64) + 90.) / zoneheight).astype(np.int64)
+
+
+def raHalfWidth (dec, radius):
+    '''
+    Half width in RA (degrees) of a box that contains a circle of given radius around dec.
+    Capped at 180 degrees, i.e., the full circle, close to the poles.
+    '''
+    maxdec = np.minimum(np.abs(dec) + radius, 90.)
+    cosdec = np.cos(np.radians(maxdec))
+    with np.errstate(divide='ignore'):
+        width = np.where(cosdec > 1e-10, radius / np.maximum(cosdec, 1e-10), 180.)
+    return np.minimum(width, 180.)
+
+
+def tileFootprints (ra, dec, margin=0., tilesize=TILESIZE):
+    '''
+    Returns one box (declo, dechi, ralo, rahi) per sky tile containing any of the positions: the
+    bounding box of the positions in that tile, extended by margin, so the boxes only cover the
+    sky around the positions rather than whole tiles.
+    '''
+    ra = np.mod(np.asarray(ra, dtype=np.float64), 360.)
+    dec = np.asarray(dec, dtype=np.float64)
+    if len(ra) == 0:
+        return []
+
+    ntiles = int(np.ceil(360. / tilesize))
+    tdec = np.floor((dec + 90.) / tilesize).astype(np.int64)
+    tra = np.minimum(np.floor(ra / tilesize).astype(np.int64), ntiles - 1)
+    keys = tdec * ntiles + tra
+
+    order = np.argsort(keys, kind='mergesort')
+    tilekeys, first = np.unique(keys[order], return_index=True)
+    return [footprint(ra[members], dec[members], margin) for members in np.split(order, first[1:])]
+
+
+def footprint (ra, dec, margin=0.):
+    '''
+    Bounding box (declo, dechi, ralo, rahi) in degrees of a set of positions, extended by margin.
+    The RA range is the complement of the largest empty RA gap, so fields straddling 0/360 yield
+    ralo < 0 rather than a box around the whole sky.
+    '''
+    ra = np.sort(np.mod(np.asarray(ra, dtype=np.float64), 360.))
+    dec = np.asarray(dec, dtype=np.float64)
+
+    declo = max(np.min(dec) - margin, -90.)
+    dechi = min(np.max(dec) + margin, 90.)
+
+    # gaps between consecutive RAs, including the one across 360 -> 0
+    gaps = np.diff(np.concatenate((ra, [ra[0] + 360.])))
+    widest = np.argmax(gaps)
+    ralo = ra[(widest + 1) % len(ra)]
+    rahi = ra[widest]
+    if ralo > rahi:
+        ralo -= 360.
+
+    rawidth = raHalfWidth(max(abs(declo), abs(dechi)), margin)
+    return declo, dechi, ralo - rawidth, rahi + rawidth
+
+
+class ZoneIndex (object):
+    '''
+    Spatial index over a fixed set of reference positions (degrees).
+
+    Positions are sorted by (zone, ra) and searched with np.searchsorted; RA wrap-around at
+    0/360 and the widening of the RA search window with declination are taken into account.
+    '''
+
+    def __init__ (self, ra, dec, zoneheight=ZONEHEIGHT):
+        ra = np.mod(np.asarray(ra, dtype=np.float64), 360.)
+        dec = np.asarray(dec, dtype=np.float64)
+
+        self.zoneheight = zoneheight
+        zones = zoneOf(dec, zoneheight)
+        # original index of every sorted entry
+        self.order = np.lexsort((ra, zones))
+        self.ra = ra[self.order]
+        self.dec = dec[self.order]
+        self.zones = zones[self.order]
+        # a single sort key, zone-major: each zone occupies an interval of width 720 degrees
+        self.keys = self.zones * 720. + self.ra
+
+    def __len__ (self):
+        return len(self.ra)
+
+    def _candidates (self, ra, dec, radius):
+        '''
+        Returns (query index, sorted reference position) of all candidate pairs whose
+        reference lies within the zone/RA box around the query positions.
+        '''
+        width = raHalfWidth(dec, radius)
+        zlo = zoneOf(np.maximum(dec - radius, -90.), self.zoneheight)
+        zhi = zoneOf(np.minimum(dec + radius, 90.), self.zoneheight)
+        queryidx = np.arange(len(ra))
+
+        starts = []
+        counts = []
+        owners = []
+        for dz in range(int(np.max(zhi - zlo)) + 1 if len(ra) > 0 else 0):
+            inzone = zlo + dz <= zhi
+            zone = (zlo + dz)[inzone]
+            for shift in (0., 360., -360.):
+                lo = np.clip(ra[inzone] + shift - width[inzone], 0., 360.)
+                hi = np.clip(ra[inzone] + shift + width[inzone], 0., 360.)
+                first = np.searchsorted(self.keys, zone * 720. + lo, side='left')
+                last = np.searchsorted(self.keys, zone * 720. + hi, side='right')
+                valid = (last > first) & (hi > lo)
+                starts.append(first[valid])
+                counts.append((last - first)[valid])
+                owners.append(queryidx[inzone][valid])
+
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        starts = np.concatenate(starts)
+        counts = np.concatenate(counts)
+        owners = np.concatenate(owners)
+
+        # expand (start, count) ranges into individual candidate positions
+        total = int(np.sum(counts))
+        pairq = np.repeat(owners, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pairref = np.repeat(starts, counts) + offsets
+        return pairq, pairref
+
+    def query (self, ra, dec, radius):
+        '''
+        Find all reference positions within radius (degrees, scalar or per query) of the
+        query positions. Returns arrays (query index, reference index, separation in degrees),
+        where the reference index refers to the arrays the index was built from.
+        '''
+        ra = np.mod(np.atleast_1d(np.asarray(ra, dtype=np.float64)), 360.)
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), ra.shape)
+
+        allq = []
+        allref = []
+        allsep = []
+        for first in range(0, len(ra), QUERYCHUNK):
+            chunk = slice(first, first + QUERYCHUNK)
+            pairq, pairref = self._candidates(ra[chunk], dec[chunk], radius[chunk])
+            sep = angularSeparation(ra[chunk][pairq], dec[chunk][pairq], self.ra[pairref], self.dec[pairref])
+            good = sep <= radius[chunk][pairq]
+            allq.append(pairq[good] + first)
+            allref.append(self.order[pairref[good]])
+            allsep.append(sep[good])
+
+        if len(allq) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.concatenate(allq), np.concatenate(allref), np.concatenate(allsep)
+
+    def nearest (self, ra, dec, radius):
+        '''
+        Find the nearest reference position within radius for every query position.
+        Returns arrays (reference index, separation in degrees); the index is -1 and the
+        separation NaN where nothing lies within the radius.
+        '''
+        nquery = len(np.atleast_1d(ra))
+        refidx = np.full(nquery, -1, dtype=np.int64)
+        separation = np.full(nquery, np.nan)
+
+        pairq, pairref, sep = self.query(ra, dec, radius)
+        if len(pairq) > 0:
+            order = np.lexsort((sep, pairq))
+            queries, first = np.unique(pairq[order], return_index=True)
+            refidx[queries] = pairref[order][first]
+            separation[queries] = sep[order][first]
+        return refidx, separation
+
+
+def groupPositions (ra, dec, radius, zoneheight=ZONEHEIGHT):
+    '''
+    Friends-of-friends grouping of positions that lie within radius of each other.
+    Returns for every position the index of the first (lowest index) member of its group.
+    '''
+    nrows = len(ra)
+    leader = np.arange(nrows)
+    if nrows == 0:
+        return leader
+
+    index = ZoneIndex(ra, dec, zoneheight)
+    pairq, pairref, sep = index.query(ra, dec, radius)
+
+    # propagate the lowest index through linked pairs until stable
+    while True:
+        newleader = leader.copy()
+        np.minimum.at(newleader, pairq, leader[pairref])
+        newleader = newleader[newleader]
+        if np.array_equal(newleader, leader):
+            return leader
+        leader = newleader
@@ -4,13 +4,20 @@ Created on Jan 8, 2016
 @author: harbeck
 '''
 
-import mysql.connector as mysql
-
+import collections
+import contextlib
 import math
+import os
+import re
+import threading
+import time
 import numpy as np
 from datetime import date, datetime, timedelta
 import dateutil.parser
 import logging 
+import backends
+import crossmatch
+import phottables
 from _curses import ERR
 
 
@@ -43,9 +50,10 @@ class photObject (object):
         Iterates through all visits (if exitent) and returns the mean, stddev magnitude of all visits
         '''
         
-        if self.visits != None:
+        if self.visits:
+            visits = self.visits.values() if isinstance(self.visits, dict) else self.visits
             tmp = []
-            for v in self.visits:
+            for v in visits:
                 tmp.append (v.data['mag'])
             m  = np.mean (tmp)
             s = np.std(tmp)
@@ -98,6 +106,8 @@ class photVisit(object):
         return (coox,cooy)
     
 def collateDataField (array, datafield):
+    if isinstance(array, phottables.recordTable):
+        return array[datafield]
     retVal = []
     for obj in array:
         try:
@@ -108,14 +118,228 @@ def collateDataField (array, datafield):
             
     return np.asarray(retVal)
 
+# record layouts of visits, objects and exposures returned as arrays, see phottables
+VISITDTYPE = phottables.VISITDTYPE
+OBJECTDTYPE = phottables.OBJECTDTYPE
+EXPOSUREDTYPE = phottables.EXPOSUREDTYPE
+OBJECTSTATSDTYPE = phottables.OBJECTSTATSDTYPE
+
+# the columns of OBJECTDTYPE / EXPOSUREDTYPE as selected from their tables
+OBJECTQUERY = "SELECT %s FROM `objects`" % ", ".join("`%s`" % name for name in OBJECTDTYPE.names)
+EXPOSUREQUERY = "SELECT %s FROM `exposures`" % ", ".join("`%s`" % name for name in EXPOSUREDTYPE.names)
+
+def recordArrayFromRows (rows, dtype):
+    '''
+    Convert rows whose values are ordered as the fields of dtype into a structured array.
+    NULLs become -1, NaN, '' or NaT depending on the column type.
+    '''
+    result = np.zeros(len(rows), dtype=dtype)
+    for idx, name in enumerate(dtype.names):
+        null = phottables.NULLS[dtype[name].kind]
+        result[name] = [null if row[idx] is None else row[idx] for row in rows]
+    return result
+
+def visitArrayFromRows (rows):
+    '''
+    Convert rows of database.VISITQUERY into a VISITDTYPE structured array in one go: each
+    column is converted as a whole, magnitudes without a current applied calibration (calmag)
+    are calibrated vectorized, and the datetimes
+    returned by the database become datetime64 without string parsing. NULL ids become -1.
+    '''
+    result = np.zeros(len(rows), dtype=VISITDTYPE)
+    if len(rows) == 0:
+        return result
+
+    (visitid, ra, dec, mag, magerr, ota, odix, odiy, filter, exposureid,
+     photzp, exptime, objid, dateobs, calmag) = zip(*rows)
+
+    def numeric(values, dtype, null):
+        return np.array([null if v is None else v for v in values], dtype=dtype)
+
+    result['visitid'] = visitid
+    result['objectid'] = numeric(objid, np.int64, -1)
+    result['exposureid'] = exposureid
+    result['filter'] = ['' if f is None else f for f in filter]
+    result['ra'] = ra
+    result['decl'] = dec
+    instmag = numeric(mag, np.float64, np.nan)
+    photzp = numeric(photzp, np.float64, np.nan)
+    exptime = numeric(exptime, np.float64, np.nan)
+    result['instmag'] = instmag
+    result['magerr'] = numeric(magerr, np.float64, np.nan)
+    result['photzp'] = photzp
+    result['exptime'] = exptime
+    calmag = numeric(calmag, np.float64, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['mag'] = np.where(np.isnan(calmag), instmag + photzp + 2.5 * np.log10(exptime), calmag)
+    result['ota'] = numeric(ota, np.int32, -1)
+    result['odix'] = numeric(odix, np.int32, -1)
+    result['odiy'] = numeric(odiy, np.int32, -1)
+    result['dateobs'] = np.array(dateobs, dtype='datetime64[us]')
+    return result
+
+def columnsToRows (columns, keys):
+    '''
+    Convert a dict of equal-length column arrays into a list of row tuples ordered as keys,
+    as needed for executemany. Scalar (non-array) entries are repeated for every row.
+    NumPy scalars are converted to native Python types on the way.
+    '''
+    nrows = None
+    for key in keys:
+        if np.ndim(columns.get(key)) > 0:
+            nrows = len(columns[key])
+            break
+    if nrows is None:
+        return []
+
+    values = []
+    for key in keys:
+        column = columns.get(key)
+        if np.ndim(column) > 0:
+            values.append(np.asarray(column).tolist())
+        else:
+            values.append([column] * nrows)
+    return list(zip(*values))
+
+def positionalParameters (sqlCommand, data):
+    '''
+    Convert a statement with named %(name)s parameters and its dict of values into the
+    positional %s form and value tuple needed by prepared statements.
+    '''
+    names = NAMEDPARAMETER.findall(sqlCommand)
+    return NAMEDPARAMETER.sub("%s", sqlCommand), tuple(data[name] for name in names)
+
+NAMEDPARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+def inList (name, values, data):
+    '''
+    Placeholders %(name0)s, %(name1)s, ... for an SQL IN list; the values are added to data.
+    '''
+    keys = ["%s%d" % (name, idx) for idx in range(len(values))]
+    data.update(zip(keys, values))
+    return ", ".join("%%(%s)s" % key for key in keys)
+
+
+# above this number of zones, region queries use a zoneid range instead of an explicit list
+MAXZONELIST = 500
+
+# zone lists of region queries are padded to a multiple of this length
+ZONELISTPAD = 4
+
+def regionCondition (declo, dechi, ralo, rahi):
+    '''
+    SQL condition and parameters selecting rows with `decl` in declo..dechi and `ra` in ralo..rahi.
+    RA limits below 0 or above 360 wrap around; a range of 360 degrees or more drops the RA cut.
+
+    The declination range is expressed as a list of `zoneid` values (padded by one zone against
+    rounding differences), so that together with the RA cut the (zoneid, ra) index is range scanned
+    once per zone. The zones are bound parameters, and the list is filled up to a multiple of
+    ZONELISTPAD by repeating the last zone, so the statement text only depends on the size of the
+    region, not on its position, and stays cacheable as a prepared statement.
+    '''
+    declo = max(declo, -90.)
+    dechi = min(dechi, 90.)
+    zlo = int(math.floor((declo + 90.) * crossmatch.ZONESPERDEGREE)) - 1
+    zhi = int(math.floor((dechi + 90.) * crossmatch.ZONESPERDEGREE)) + 1
+
+    data = {'declo': declo, 'dechi': dechi}
+    if zhi - zlo < MAXZONELIST:
+        nzones = int(math.ceil((zhi - zlo + 1) / float(ZONELISTPAD))) * ZONELISTPAD
+        zones = [min(zone, zhi) for zone in range(zlo, zlo + nzones)]
+        condition = "(`zoneid` IN (%s))" % inList('zone', zones, data)
+    else:
+        condition = "(`zoneid` BETWEEN %(zonelo)s AND %(zonehi)s)"
+        data.update({'zonelo': zlo, 'zonehi': zhi})
+    condition += " AND (`decl` BETWEEN %(declo)s AND %(dechi)s)"
+
+    if rahi - ralo >= 360.:
+        return condition, data
+
+    if ralo < 0.:
+        condition += " AND (`ra` >= %(ralo)s OR `ra` <= %(rahi)s)"
+        data.update({'ralo': ralo + 360., 'rahi': rahi})
+    elif rahi > 360.:
+        condition += " AND (`ra` >= %(ralo)s OR `ra` <= %(rahi)s)"
+        data.update({'ralo': ralo, 'rahi': rahi - 360.})
+    else:
+        condition += " AND (`ra` BETWEEN %(ralo)s AND %(rahi)s)"
+        data.update({'ralo': ralo, 'rahi': rahi})
+    return condition, data
+
+
+class exposureCache(object):
+    '''
+    Size-bounded LRU cache of photExposures by exposureid. Hit / miss counters are kept in stats.
+    '''
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize if maxsize is not None else EXPOSURECACHESIZE
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, exposureid):
+        '''
+        Returns (found, exposure); exposure is None if the id is not cached.
+        '''
+        with self.lock:
+            if exposureid not in self.entries:
+                self.stats['misses'] += 1
+                return False, None
+            exposure = self.entries.pop(exposureid)
+            self.entries[exposureid] = exposure
+            self.stats['hits'] += 1
+            return True, exposure
+
+    def put(self, exposureid, exposure):
+        with self.lock:
+            self.entries.pop(exposureid, None)
+            self.entries[exposureid] = exposure
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, exposureid=None):
+        '''
+        Drop one exposureid, or everything if exposureid is None.
+        '''
+        with self.lock:
+            if exposureid is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(exposureid, None)
+
+
+# maximum number of exposures held in a database's exposure cache
+EXPOSURECACHESIZE = 10000
+
+
+def sqliteDatabase (filename):
+    '''
+    A database stored in the SQLite file filename; a new file needs createDatabase() as usual.
+    '''
+    return database(backend=backends.sqliteBackend(filename))
+
 
 class database(object):
     '''
     Basic configuration to connect, setup, and interact with a mysql database
+
+    The tables and statements are written for MySQL; the storage backend (see backends) opens
+    the connections and adapts them to its engine, e.g., to an embedded SQLite file.
     '''
 
     log = logging.getLogger('database')
     TABLES = {}
+
+    # declination zone of a row, kept up to date by the database on every insert / update.
+    # Together with the (zoneid, ra) indexes this lets box and cone searches use index range scans.
+    ZONECOLUMN = ("`zoneid` int GENERATED ALWAYS AS (FLOOR((`decl` + 90) * %d)) STORED"
+                  % crossmatch.ZONESPERDEGREE)
     
     TABLES['exposures'] = ("CREATE TABLE IF NOT EXISTS `exposures` ("
                            " `exposureid` varchar(20) NOT NULL,"
@@ -126,6 +350,8 @@ class database(object):
                            " `fwhm` float, "
                            " `dateobs` datetime,"
                            " `photzp` float,"
+                           " `zpversion` int NOT NULL DEFAULT 0,"
+                           " `calversion` int,"
                            " PRIMARY KEY (`exposureid`)"
                            ") ENGINE=InnoDB DEFAULT CHARSET=latin1;")
 
@@ -139,17 +365,21 @@ class database(object):
   " `decl` double NOT NULL,"
   " `mag` float NOT NULL,"
   " `magerr` float NOT NULL,"
-  " `class1` float NOT NULL,"
-  " `class2` float NOT NULL,"
+  " `class1` float NOT NULL DEFAULT 0,"
+  " `class2` float NOT NULL DEFAULT 0,"
   " `odix` INT,"
   " `odiy` INT,"
   " `ota` INT,"
+  " `calmag` float,"
+  " `calversion` int,"
+  " %(zonecolumn)s,"
   " PRIMARY KEY (`visitid`),"
   " INDEX (`objectid`),"
-  " INDEX (`ra`),"
+  " INDEX (`exposureid`),"
+  " INDEX `zone_ra` (`zoneid`, `ra`),"
   " INDEX (`decl`)" 
   
-  " ) ENGINE=InnoDB DEFAULT CHARSET=latin1;")
+  " ) ENGINE=InnoDB DEFAULT CHARSET=latin1;") % {'zonecolumn': ZONECOLUMN}
     
     TABLES['objects'] = ( "CREATE TABLE IF NOT EXISTS `objects` ("
      " `objectid` bigint(20) NOT NULL AUTO_INCREMENT,"
@@ -160,48 +390,218 @@ class database(object):
      " `sdss_r` float,"
      " `sdss_i` float,"
      " `sdss_z` float,"
+     " %(zonecolumn)s,"
      
      " PRIMARY KEY (`objectid`),"
-     " INDEX (`ra`),"
+     " INDEX `zone_ra` (`zoneid`, `ra`),"
      " INDEX (`decl`)"
+     " ) ENGINE=InnoDB DEFAULT CHARSET=latin1;") % {'zonecolumn': ZONECOLUMN}
+
+    # Running sums of the calibrated visit magnitudes per object and filter, merged into on
+    # every visit ingested or matched, so selections by number of visits or scatter are index lookups.
+    # Weights are 1 / magerr^2; magvar is the unweighted variance of the magnitudes.
+    TABLES['objectstats'] = ("CREATE TABLE IF NOT EXISTS `objectstats` ("
+     " `objectid` bigint(20) NOT NULL,"
+     " `filter` varchar(10) NOT NULL,"
+     " `nvisits` int NOT NULL,"
+     " `sumw` double NOT NULL,"
+     " `sumwmag` double NOT NULL,"
+     " `summag` double NOT NULL,"
+     " `summag2` double NOT NULL,"
+     " `firstobs` datetime,"
+     " `lastobs` datetime,"
+     " `meanmag` double GENERATED ALWAYS AS (`sumwmag` / NULLIF(`sumw`, 0)) STORED,"
+     " `magvar` double GENERATED ALWAYS AS (`summag2` / `nvisits` - (`summag` / `nvisits`) * (`summag` / `nvisits`)) STORED,"
+     " PRIMARY KEY (`objectid`, `filter`),"
+     " INDEX `filter_nvisits` (`filter`, `nvisits`),"
+     " INDEX `filter_magvar` (`filter`, `magvar`)"
      " ) ENGINE=InnoDB DEFAULT CHARSET=latin1;")
 
+    # columns of objectstats written by the database, and how new sums merge into stored ones
+    STATSCOLUMNS = ('objectid', 'filter', 'nvisits', 'sumw', 'sumwmag', 'summag', 'summag2', 'firstobs', 'lastobs')
+    STATSMERGE = {'nvisits': 'add', 'sumw': 'add', 'sumwmag': 'add', 'summag': 'add', 'summag2': 'add',
+                  'firstobs': 'min', 'lastobs': 'max'}
+
+    # keep objectstats up to date while ingesting and matching; if off, use rebuildObjectStats
+    OBJECTSTATS = True
+
+    # column order used for bulk visit ingestion
+    VISITCOLUMNS = ('exposureid', 'objectid', 'ra', 'decl', 'mag', 'magerr', 'odix', 'odiy', 'ota')
+
+    # column order used for bulk object ingestion
+    OBJECTCOLUMNS = ('ra', 'decl', 'sdss_u', 'sdss_g', 'sdss_r', 'sdss_i', 'sdss_z')
+
+    # number of rows per multi-row INSERT statement in bulk loads
+    BULKBATCHSIZE = 5000
+
     STATEMENTS = {}
-    STATEMENTS['insertVisit'] = ()
+    STATEMENTS['insertVisit'] = ("INSERT INTO `visits`"
+                                 " (%s)"
+                                 " VALUES (%s)") % (", ".join("`%s`" % c for c in VISITCOLUMNS),
+                                                    ", ".join(["%s"] * len(VISITCOLUMNS)))
+    STATEMENTS['insertObject'] = ("INSERT INTO `objects`"
+                                  " (%s)"
+                                  " VALUES (%s)") % (", ".join("`%s`" % c for c in OBJECTCOLUMNS),
+                                                     ", ".join(["%s"] * len(OBJECTCOLUMNS)))
+    # visits joined with their exposure metadata, the common part of all visit queries.
+    # The last column is the applied calibrated magnitude if it is up to date with the zero point.
+    VISITQUERY = ("select v.visitid,v.ra,v.decl,v.mag,v.magerr,v.ota,v.odix,v.odiy,e.filter,e.exposureid, e.photzp, e.exptime, v.objectid, e.dateobs,"
+                  " CASE WHEN v.calversion = e.calversion THEN v.calmag END"
+                  " FROM  visits v INNER JOIN exposures e ON e.exposureid = v.exposureid")
+
+    # calibrated magnitude of a visit v with exposure e
+    CALIBRATEDMAG = "(v.mag + e.photzp + 2.5 * LOG10(e.exptime))"
+
+    # exposures per statement when applying zero points
+    ZPCHUNK = 50
+
+    # number of objectids per IN list in bulk visit queries
+    OBJECTCHUNK = 1000
+
+    # visits per chunk when streaming visits
+    VISITCHUNK = 50000
+
+    STATEMENTS['linkVisit'] = "UPDATE `visits` SET `objectid`=%s WHERE `visitid`=%s"
 
     instruments = {'odi', 'sdss'}
 
-    def __init__(self, host, port, dbuser, dbpass, dbname):
+    # prepared statements kept per connection
+    PREPAREDCACHE = 32
+
+    def __init__(self, host=None, port=None, dbuser=None, dbpass=None, dbname=None, poolsize=None, backend=None):
         '''
         Constructor
+
+        Without a backend, connects to the MySQL server given by host, port, dbuser, dbpass and
+        dbname. The connection is taken from a pool shared by all database instances with the same
+        parameters in this process; poolsize sets its size when the pool is first created.
         '''
-        self.dbhost = host
-        self.dbport = port
-        self.dbuser = dbuser
-        self.dbpass = dbpass
-        self.dbname = dbname
+        if backend is None:
+            backend = backends.mysqlBackend(host, port, dbuser, dbpass, dbname, poolsize=poolsize)
+        self.backend = backend
+        self.dbname = backend.dbname
+        self.preparedCursors = collections.OrderedDict()
+        self._txn = None
         
-        self.connectDataBase (self.dbhost, self.dbport, self.dbuser, self.dbpass, self.dbname)
+        self.connectDataBase ()
         
-        self.EXPOSUREBUFFER = {}
+        self.exposureCache = exposureCache()
+
+    def __enter__(self):
+        return self
         
-    def __exit__(self):
-        self.db.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closeDataBase()
+        return False
+
+    def clone (self):
+        '''
+        A new database instance on its own connection, e.g., for use in another thread.
+        '''
+        return database(backend=self.backend)
+
+    def getConnection (self):
+        '''
+        A new connection from the backend; for MySQL it is borrowed from the pool, waiting up to
+        POOLTIMEOUT seconds for a free one. Closing the connection gives it back.
+        '''
+        return self.backend.connect()
+
+    def cursor (self, conn=None, dictionary=False, prepared=False, buffered=True):
+        '''
+        A cursor on conn, by default the connection of this instance; see the backend's cursor.
+        '''
+        return self.backend.cursor(self.db if conn is None else conn, dictionary=dictionary,
+                                   prepared=prepared, buffered=buffered)
+
+    @contextlib.contextmanager
+    def connection (self):
+        '''
+        Context manager yielding an additional pooled connection that is always given back.
+        '''
+        conn = self.getConnection()
+        try:
+            yield conn
+        finally:
+            conn.close()
       
-    def connectDataBase (self, host, port, user, passwd, name):
+    def connectDataBase (self):
         try:
-            self.db = mysql.connect (host=host, port=port, user=user, password=passwd, database=name)  
-            self.db.set_charset_collation('latin1')
-            self.db.set_unicode(False)
+            self.db = self.getConnection()
             
-        except mysql.Error as err:
+        except backends.Error as err:
             self.log.exception (err)
-            
+
+    def _prepared (self, sqlCommand):
+        '''
+        A server-side prepared cursor for sqlCommand on the connection of this instance. Cursors are
+        cached per statement, so a hot statement is parsed by the server only once.
+        sqlCommand must use positional (%s) parameters, see positionalParameters.
+        '''
+        cursor = self.preparedCursors.pop(sqlCommand, None)
+        if cursor is None:
+            cursor = self.cursor(prepared=True)
+            if len(self.preparedCursors) >= self.PREPAREDCACHE:
+                stale = self.preparedCursors.popitem(last=False)[1]
+                stale.close()
+        self.preparedCursors[sqlCommand] = cursor
+        return cursor
+
+    @contextlib.contextmanager
+    def transaction (self, commitEvery=None):
+        '''
+        Unit of work: everything written inside 'with db.transaction():' is committed once at the
+        end, or rolled back if an exception leaves the block.
+
+        commitEvery: if set, additionally commit whenever that many rows have been written since
+        the last commit; a rollback then only undoes the rows since the last intermediate commit.
+
+        Transactions nest: an inner transaction joins the outer one, which owns the commit.
+        All write methods of this class run inside a transaction, so outside an explicit one
+        each call is committed on its own.
+        Inside an explicit transaction, write methods pass database errors on to the caller
+        without logging them; outside one they log the error and return.
+        '''
+        if self._txn is not None:
+            yield self
+            return
+
+        self._txn = {'every': commitEvery, 'pending': 0}
+        try:
+            yield self
+            self.db.commit()
+        except:
+            self.log.warn("Rolling back transaction")
+            try:
+                self.db.rollback()
+            except backends.Error:
+                self.log.exception("While rolling back:")
+            raise
+        finally:
+            self._txn = None
+
+    def inTransaction (self):
+        return self._txn is not None
+
+    def _written (self, nrows):
+        '''
+        Record nrows written in the current transaction and apply its commit-every-N policy.
+        '''
+        txn = self._txn
+        if txn is None or txn['every'] is None:
+            return
+        txn['pending'] += nrows
+        if txn['pending'] >= txn['every']:
+            self.db.commit()
+            txn['pending'] = 0
     
     def closeDataBase (self):
         try:
+            for cursor in self.preparedCursors.values():
+                cursor.close()
+            self.preparedCursors.clear()
             self.db.close()
-        except mysql.Error as err:
+        except backends.Error as err:
              self.log.error (err)
             
          
@@ -209,32 +609,70 @@ class database(object):
     def cleanSlateDatabase (self):
         self.log.info("DROPPING all tables in database %s" % self.dbname)
         try :
-            cur = self.db.cursor()
+            cur = self.cursor()
             for name, sql in self.TABLES.iteritems():
                 cur.execute ("DROP TABLE %s" % name)
-        except mysql.Error as err:
-            self.log.error (err.msg)
+        except backends.Error as err:
+            self.log.error (err)
                 
                 
     def createDatabase (self):
         # table 1: a basic photometry table that contains only a measurement with epoch, filter, mag, magerr etc
         
         try:
-            cur = self.db.cursor()
+            cur = self.cursor()
             for name, sql  in self.TABLES.iteritems():
                 print ("Creating table %s with command %s" % (name,str(sql)))
 
-                cur.execute (sql)
+                for statement in self.backend.schema(sql):
+                    cur.execute (statement)
 
                     
-        except mysql.Error as err:
-            if err.errno == mysql.errorcode.ER_TABLE_EXISTS_ERROR:
+        except backends.Error as err:
+            if self.backend.tableExists(err):
                 self.log.warn ("already exists.")
             else:
-                self.log.error(err.msg)
+                self.log.error(err)
         else:
             self.log.info("OK")
             
+    def migrateDatabase (self):
+        '''
+        Bring the tables of an existing database up to the current schema. Currently this adds the
+        `zoneid` column and (zoneid, ra) index to `objects` and `visits` where they are missing, adds
+        the calibration columns and the visits exposureid index, and creates and fills the `objectstats` table.
+        Existing indexes are left untouched.
+        '''
+        try:
+            cur = self.cursor()
+            for table in ('objects', 'visits'):
+                if self.backend.hasColumn(cur, table, 'zoneid'):
+                    continue
+                self.log.info("Adding sky zone column and index to table %s" % table)
+                self.backend.addZoneColumn(cur, table, self.ZONECOLUMN)
+            self.db.commit()
+
+            if not self.backend.hasColumn(cur, 'exposures', 'zpversion'):
+                self.log.info("Adding zero point versions to table exposures")
+                cur.execute("ALTER TABLE `exposures` ADD COLUMN `zpversion` int NOT NULL DEFAULT 0")
+                cur.execute("ALTER TABLE `exposures` ADD COLUMN `calversion` int")
+            if not self.backend.hasColumn(cur, 'visits', 'calmag'):
+                self.log.info("Adding calibrated magnitudes and exposure index to table visits")
+                cur.execute("ALTER TABLE `visits` ADD COLUMN `calmag` float")
+                cur.execute("ALTER TABLE `visits` ADD COLUMN `calversion` int")
+                cur.execute("CREATE INDEX `visits_exposureid` ON `visits` (`exposureid`)")
+            self.db.commit()
+
+            if not self.backend.hasColumn(cur, 'objectstats', 'objectid'):
+                self.log.info("Creating and filling table objectstats")
+                for statement in self.backend.schema(self.TABLES['objectstats']):
+                    cur.execute(statement)
+                self.db.commit()
+                self.rebuildObjectStats()
+            cur.close()
+        except backends.Error as err:
+            self.log.exception("While migrating database:")
+
     def addExposure (self, exposureObject, cursor=None):
         '''
         
@@ -244,13 +682,17 @@ class database(object):
                       "VALUES (%(exposureid)s, %(instrument)s, %(filter)s, %(airmass)s, %(exptime)s, %(fwhm)s, %(dateobs)s, %(photzp)s);")
     
         try:
-            if cursor == None:
-                cursor = self.db.cursor()
+            with self.transaction():
+                if cursor == None:
+                    cursor = self.cursor()
             
-            cursor.execute (sqlCommand, exposureObject.data);
-            self.db.commit()
+                cursor.execute (sqlCommand, exposureObject.data);
+                self._written(1)
+                self.exposureCache.invalidate(exposureObject.data['exposureid'])
             
-        except mysql.Error as err:
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
             self.log.exception("While addExposure:")
     
     
@@ -258,38 +700,74 @@ class database(object):
     def getExposure (self, exposureid):
         '''
         returns a photExposure object for the given exposureid
+
+        Exposures are served from an LRU cache. Ids that are not in the database are not
+        cached: each clone has its own cache, so a miss cached here would hide an exposure
+        written later through another connection.
         '''
-        exposure = None
+        found, exposure = self.exposureCache.get(exposureid)
+        if found:
+            return exposure
         
+        self.log.debug ("Entering getExposure")
+        sqlCommand = ("select * from `exposures` where `exposureid`=%s")
         try:
-            exposure = self.EXPOSUREBUFFER[exposureid]
-          #  print "buffer success"
-            
-        except:
+            cursor = self.cursor(dictionary=True)
+            cursor.execute (sqlCommand, (exposureid,))
+            data = cursor.fetchone()
+            cursor.close()
+            self.log.debug(data)
+       
+        except Exception as err:
+            self.log.exception("While finding exposure by id")
+            return photExposure()
         
-            self.log.info ("Entering getExposure")
-            sqlCommand = ("select * from `exposures` where `exposureid`=%s")
-            result = None
-            data = None
-            try:
+        if data is None:
+            self.log.info("No exposure for id %s found" % exposureid)
+            return photExposure()
 
-                cursor = self.db.cursor(dictionary=True)
-                cursor.execute (sqlCommand, (exposureid,))
-            
-                data = cursor.fetchone()
-                self.log.debug(data)
-           
-            except Exception as err:
-                self.log.exception("While finding exposure by id")
-            
-            exposure = photExposure()
-            if data != None:
-                exposure.data = data
-                self.EXPOSUREBUFFER[exposureid] = exposure
-            else:
-                self.log.info("No exposure for id %s found" % exposureid)
-        
+        exposure = photExposure()
+        exposure.data = data
+        self.exposureCache.put(exposureid, exposure)
         return exposure
+
+    def prefetchExposures (self, filter=None, exposureids=None):
+        '''
+        Load all exposures of a filter and/or a list of exposureids into the exposure cache
+        with a single query.
+        Returns the number of exposures loaded.
+        '''
+        data = {}
+        conditions = []
+        if filter is not None:
+            conditions.append("`filter` = %(filter)s")
+            data['filter'] = filter
+        if exposureids is not None:
+            exposureids = [id.rstrip() for id in exposureids]
+            if len(exposureids) == 0:
+                return 0
+            conditions.append("`exposureid` IN (%s)" % inList('exposureid', exposureids, data))
+
+        sqlCommand = "select * from `exposures`"
+        if len(conditions) > 0:
+            sqlCommand += " WHERE " + " AND ".join(conditions)
+
+        try:
+            cursor = self.cursor(dictionary=True)
+            cursor.execute(sqlCommand, data)
+            rows = cursor.fetchall()
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While prefetching exposures:")
+            return 0
+
+        for row in rows:
+            exposure = photExposure()
+            exposure.data = row
+            self.exposureCache.put(row['exposureid'], exposure)
+
+        self.log.info("Prefetched %d exposures" % len(rows))
+        return len(rows)
     
     def getExposureIDs (self, filter):
         ''' 
@@ -297,397 +775,997 @@ class database(object):
         '''
         results = []
         try:
-            cursor = self.db.cursor()
+            cursor = self.cursor()
             cursor.execute("select `exposureid` from `exposures` WHERE `filter` = %s", (filter,))
            
               
             for row in cursor:
                 results.append(str(row[0]))
             cursor.close()
-        except mysql.Error as err:
+        except backends.Error as err:
             self.log.exception (err)
        
         return results
         
-    def getVisitsForObject (self, object, minVisits=0, exposureids = None):
+    def updateObjectStats (self, objectids, exposureids, instmag, magerr):
+        '''
+        Merge visits, given as parallel sequences of objectid, exposureid, instrumental mag and
+        magerr, into the objectstats table. Magnitudes are calibrated with the zero point and
+        exposure time of their exposure (from the exposure cache); visits of unknown or
+        uncalibrated exposures are left out. Runs in the current transaction.
+        '''
+        if len(objectids) == 0:
+            return 0
+
+        exposureids = np.asarray(exposureids)
+        uniqueids, expidx = np.unique(exposureids, return_inverse=True)
+        exposures = [self.getExposure(exposureid).data for exposureid in uniqueids.tolist()]
+
+        filters = np.asarray([exposure['filter'] or '' for exposure in exposures])
+        zeropoint = np.asarray([np.nan if exposure['photzp'] is None or not exposure['exptime'] > 0
+                                else exposure['photzp'] + 2.5 * math.log10(exposure['exptime'])
+                                for exposure in exposures])
+        dateobs = np.asarray([np.datetime64('NaT') if exposure['dateobs'] is None else exposure['dateobs']
+                              for exposure in exposures], dtype='datetime64[us]')
+
+        mag = np.asarray(instmag, dtype=np.float64) + zeropoint[expidx]
+        magerr = np.asarray([np.nan if err is None else err for err in magerr], dtype=np.float64)
+        good = np.isfinite(mag)
+        if not np.all(good):
+            self.log.debug("%d visits without calibrated exposure left out of objectstats" % np.sum(~good))
+
+        # one row per (object, filter)
+        objectids = np.asarray(objectids, dtype=np.int64)[good]
+        expidx = expidx[good]
+        mag = mag[good]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(magerr[good] > 0, 1. / (magerr[good] * magerr[good]), 0.)
+        keys = np.empty(len(objectids), dtype=[('objectid', np.int64), ('filter', filters.dtype)])
+        keys['objectid'] = objectids
+        keys['filter'] = filters[expidx]
+        groups, inverse = np.unique(keys, return_inverse=True)
+
+        nvisits = np.bincount(inverse)
+        sums = [np.bincount(inverse, weights=values) for values in (weight, weight * mag, mag, mag * mag)]
+        epoch = dateobs[expidx].astype(np.int64)
+        valid = ~np.isnat(dateobs[expidx])
+        firstobs = np.full(len(groups), np.iinfo(np.int64).max)
+        lastobs = np.full(len(groups), np.iinfo(np.int64).min)
+        np.minimum.at(firstobs, inverse[valid], epoch[valid])
+        np.maximum.at(lastobs, inverse[valid], epoch[valid])
+
+        def obs(values, missing):
+            # datetime, or None for groups without any dateobs
+            dates = values.astype('datetime64[us]').astype(object).tolist()
+            return [None if value == missing else date for value, date in zip(values.tolist(), dates)]
+
+        rows = list(zip(groups['objectid'].tolist(), groups['filter'].tolist(), nvisits.tolist(),
+                        sums[0].tolist(), sums[1].tolist(), sums[2].tolist(), sums[3].tolist(),
+                        obs(firstobs, np.iinfo(np.int64).max), obs(lastobs, np.iinfo(np.int64).min)))
+        try:
+            with self.transaction():
+                sqlCommand = self.backend.upsert('objectstats', self.STATSCOLUMNS, ('objectid', 'filter'),
+                                                 self.STATSMERGE)
+                cursor = self.cursor()
+                cursor.executemany(sqlCommand, rows)
+                cursor.close()
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While updating object statistics:")
+        return len(rows)
+
+    def rebuildObjectStats (self, exposureids=None):
+        '''
+        Recompute the objectstats table from the visits in one set-based statement, e.g. after
+        zero points changed or with OBJECTSTATS turned off during a bulk load. With exposureids,
+        only the objects with visits in these exposures are recomputed.
+        '''
+        calibrated = ("COALESCE(CASE WHEN v.calversion = e.calversion THEN v.calmag END, %s)"
+                      % self.CALIBRATEDMAG)
+        weight = "(CASE WHEN v.magerr > 0 THEN 1. / (v.magerr * v.magerr) ELSE 0. END)"
+        sqlCommand = ("INSERT INTO `objectstats` (%s)"
+                      " SELECT v.objectid, COALESCE(e.filter, ''), COUNT(*), SUM(%s), SUM(%s * %s), SUM(%s), SUM(%s * %s),"
+                      " MIN(e.dateobs), MAX(e.dateobs)"
+                      " FROM visits v INNER JOIN exposures e ON e.exposureid = v.exposureid"
+                      " WHERE v.objectid IS NOT NULL AND e.photzp IS NOT NULL AND e.exptime > 0"
+                      % (", ".join("`%s`" % column for column in self.STATSCOLUMNS),
+                         weight, weight, calibrated, calibrated, calibrated, calibrated))
+        deleteCommand = "DELETE FROM `objectstats`"
+
+        data = {}
+        if exposureids is not None:
+            touched = ("SELECT DISTINCT `objectid` FROM `visits` WHERE `exposureid` IN (%s)"
+                       % inList('exposureid', list(exposureids), data))
+            sqlCommand += " AND v.objectid IN (%s)" % touched
+            deleteCommand += " WHERE `objectid` IN (%s)" % touched
+        sqlCommand += " GROUP BY v.objectid, COALESCE(e.filter, '')"
+
+        start = time.time()
+        try:
+            with self.transaction():
+                cursor = self.cursor()
+                cursor.execute(deleteCommand, data)
+                cursor.execute(sqlCommand, data)
+                cursor.close()
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While rebuilding object statistics:")
+        self.log.info("Rebuilt objectstats in %.1f s" % (time.time() - start))
+
+    def setZeroPoints (self, exposureids, photzp, version):
+        '''
+        Store a new photometric zero point per exposure as calibration version. Until
+        applyZeroPoints has run, visit magnitudes of these exposures are calibrated on the fly.
+        '''
+        rows = list(zip(np.asarray(photzp, dtype=np.float64).tolist(), [int(version)] * len(exposureids),
+                        [id.rstrip() for id in exposureids]))
+        try:
+            with self.transaction():
+                cursor = self.cursor()
+                cursor.executemany("UPDATE `exposures` SET `photzp` = %s, `zpversion` = %s, `calversion` = NULL"
+                                   " WHERE `exposureid` = %s", rows)
+                cursor.close()
+                self._written(len(rows))
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While setting zero points:")
+        for exposureid in exposureids:
+            self.exposureCache.invalidate(exposureid.rstrip())
+        return len(rows)
+
+    def applyZeroPoints (self):
+        '''
+        Calibrate the visits of all exposures whose zero point version has not been applied yet:
+        calmag = mag + photzp + 2.5 log10(exptime) is written with one UPDATE joining visits to
+        exposures per ZPCHUNK exposures, and each visit and exposure records the applied version.
+        Exposures already up to date are not touched, so re-running is cheap; each chunk is
+        committed on its own, so an interrupted run resumes where it stopped.
+        Returns the number of exposures calibrated. A database error is logged and ends the
+        run after the chunks already committed; inside an explicit transaction it is raised.
+        '''
+        try:
+            cursor = self.cursor()
+            cursor.execute("SELECT `exposureid` FROM `exposures`"
+                           " WHERE `photzp` IS NOT NULL AND `exptime` > 0"
+                           " AND (`calversion` IS NULL OR `calversion` <> `zpversion`)")
+            stale = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While finding uncalibrated exposures:")
+            return 0
+
+        start = time.time()
+        applied = 0
+        try:
+            for first in range(0, len(stale), self.ZPCHUNK):
+                exposureids = stale[first:first + self.ZPCHUNK]
+                data = {}
+                condition = "v.exposureid IN (%s)" % inList('exposureid', exposureids, data)
+                with self.transaction():
+                    cursor = self.cursor()
+                    cursor.execute(self.backend.updateJoin(
+                        'visits', 'v', 'exposures', 'e', "e.exposureid = v.exposureid",
+                        (('calmag', self.CALIBRATEDMAG), ('calversion', "e.zpversion")), condition), data)
+                    self._written(cursor.rowcount)
+                    cursor.execute("UPDATE `exposures` SET `calversion` = `zpversion` WHERE `exposureid` IN (%s)"
+                                   % inList('exposureid', exposureids, data), data)
+                    cursor.close()
+                    if self.OBJECTSTATS:
+                        self.rebuildObjectStats(exposureids)
+                for exposureid in exposureids:
+                    self.exposureCache.invalidate(exposureid)
+                applied += len(exposureids)
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While applying zero points:")
+
+        self.log.info("Applied zero points of %d exposures in %.1f s" % (applied, time.time() - start))
+        return applied
+
+    def getObjectStats (self, filter=None, minVisits=0, maxRms=None, objectids=None):
+        '''
+        Photometric statistics of objects as OBJECTSTATSDTYPE structured array.
+
+        With a filter, the rows of that filter with at least minVisits visits and an rms of at
+        most maxRms are selected through the (filter, nvisits) / (filter, magvar) indexes.
+        Without one, the statistics of all filters are combined per object (filter is '').
+        timespan is lastobs - firstobs in days.
+        '''
+        if objectids is None:
+            chunks = [None]
+        else:
+            objectids = sorted(set(objectids))
+            chunks = [objectids[first:first + self.OBJECTCHUNK] for first in range(0, len(objectids), self.OBJECTCHUNK)]
+
+        rows = []
+        try:
+            cursor = self.cursor()
+            for chunk in chunks:
+                data = {}
+                conditions = []
+                if chunk is not None:
+                    conditions.append("`objectid` IN (%s)" % inList('objectid', chunk, data))
+                if filter is not None:
+                    data['filter'] = filter
+                    data['minvisits'] = minVisits
+                    conditions.append("`filter` = %(filter)s")
+                    conditions.append("`nvisits` >= %(minvisits)s")
+                    if maxRms is not None:
+                        data['maxvar'] = maxRms * maxRms
+                        conditions.append("`magvar` <= %(maxvar)s")
+                    sqlCommand = ("SELECT `objectid`, `filter`, `nvisits`, `sumw`, `sumwmag`, `summag`, `summag2`,"
+                                  " `firstobs`, `lastobs` FROM `objectstats`")
+                    if len(conditions) > 0:
+                        sqlCommand += " WHERE " + " AND ".join(conditions)
+                else:
+                    sqlCommand = ("SELECT `objectid`, '', SUM(`nvisits`), SUM(`sumw`), SUM(`sumwmag`), SUM(`summag`),"
+                                  " SUM(`summag2`), MIN(`firstobs`), MAX(`lastobs`) FROM `objectstats`")
+                    if len(conditions) > 0:
+                        sqlCommand += " WHERE " + " AND ".join(conditions)
+                    sqlCommand += " GROUP BY `objectid`"
+                    if minVisits > 0:
+                        data['minvisits'] = minVisits
+                        sqlCommand += " HAVING SUM(`nvisits`) >= %(minvisits)s"
+
+                cursor.execute(sqlCommand, data)
+                rows.extend(cursor.fetchall())
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While reading object statistics:")
+
+        result = np.zeros(len(rows), dtype=OBJECTSTATSDTYPE)
+        if len(rows) == 0:
+            return result
+        objectid, filters, nvisits, sumw, sumwmag, summag, summag2, firstobs, lastobs = zip(*rows)
+        result['objectid'] = objectid
+        result['filter'] = filters
+        result['nvisits'] = nvisits
+        nvisits = result['nvisits'].astype(np.float64)
+        sumw = np.asarray(sumw, dtype=np.float64)
+        mean = np.asarray(summag, dtype=np.float64) / nvisits
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['meanmag'] = np.where(sumw > 0, np.asarray(sumwmag, dtype=np.float64) / sumw, np.nan)
+        result['rms'] = np.sqrt(np.maximum(np.asarray(summag2, dtype=np.float64) / nvisits - mean * mean, 0.))
+        result['firstobs'] = [np.datetime64('NaT') if value is None else value for value in firstobs]
+        result['lastobs'] = [np.datetime64('NaT') if value is None else value for value in lastobs]
+        result['timespan'] = (result['lastobs'] - result['firstobs']) / np.timedelta64(1, 'D')
+
+        if filter is None and maxRms is not None:
+            result = result[result['rms'] <= maxRms]
+        return result
+
+    def visitCondition (self, objectcondition, data, minVisits=0, exposureids=None, instrument=None, filter=None):
+        '''
+        WHERE clause for VISITQUERY selecting the visits of the objects in objectcondition,
+        restricted to the given exposures, instrument and filter. Values are added to data as
+        bound parameters. With minVisits > 0 only objects that have at least minVisits visits
+        passing these cuts are selected, counted by a grouped subquery inside the database.
+        '''
+        condition = "(%s)" % objectcondition
+        if exposureids is not None:
+            condition += " AND (v.exposureid IN (%s))" % inList(
+                'exposureid', [id.rstrip() for id in exposureids], data)
+        if instrument is not None:
+            condition += " AND (e.instrument = %(instrument)s)"
+            data['instrument'] = instrument
+        if filter is not None:
+            condition += " AND (e.filter = %(filter)s)"
+            data['filter'] = filter
+
+        if minVisits > 0:
+            data['minvisits'] = minVisits
+            condition += (" AND v.objectid IN (SELECT v.objectid"
+                          " FROM visits v INNER JOIN exposures e ON e.exposureid = v.exposureid"
+                          " WHERE %s GROUP BY v.objectid HAVING COUNT(v.visitid) >= %%(minvisits)s)" % condition)
+        return condition
+
+    def getVisitsForObject (self, object, minVisits=0, exposureids = None, instrument=None, filter=None):
         
-        object.visits = self.getVisits(object.data['objectid'], minVisits = minVisits, exposureids = exposureids)
+        object.visits = self.getVisits(object.data['objectid'], minVisits = minVisits, exposureids = exposureids,
+                                       instrument=instrument, filter=filter)
         #print object.visits
+
+    def getVisitsForObjects (self, objects, minVisits=0, exposureids=None, instrument=None, filter=None):
+        '''
+        Bulk version of getVisitsForObject: attach the visits of every photObject in objects,
+        with the same minVisits / exposureids / instrument / filter semantics as getVisits,
+        using one query per OBJECTCHUNK objects instead of one per object.
+        Returns the number of objects that received visits.
+        '''
+        objectids = sorted(set(obj.data['objectid'] for obj in objects if obj.data['objectid'] is not None))
+
+        visits = {}
+        try:
+            cursor = self.cursor()
+            for first in range(0, len(objectids), self.OBJECTCHUNK):
+                data = {}
+                condition = self.visitCondition(
+                    "v.objectid IN (%s)" % inList('objectid', objectids[first:first + self.OBJECTCHUNK], data),
+                    data, minVisits, exposureids, instrument, filter)
+
+                cursor.execute(self.VISITQUERY + " WHERE " + condition, data)
+                for row in cursor:
+                    visit = self._visitFromRow(row)
+                    visits.setdefault(visit.data['objectid'], {})[str(visit.data['exposureid'])] = visit
+            cursor.close()
+
+        except backends.Error as err:
+            self.log.exception("During getVisitsForObjects: ")
+
+        nfilled = 0
+        for obj in objects:
+            obj.visits = visits.get(obj.data['objectid'], {})
+            if len(obj.visits) > 0:
+                nfilled += 1
+        return nfilled
+
+    def findObjectsWithVisits (self, ra, dec, sqr=3., minVisits=0, exposureids=None, instrument=None, filter=None):
+        '''
+        findObjects for a region, with the visits of all found objects attached in bulk.
+        '''
+        objects = self.findObjects(ra, dec, sqr)
+        self.getVisitsForObjects(objects, minVisits=minVisits, exposureids=exposureids,
+                                 instrument=instrument, filter=filter)
+        return objects
+
+    def getVisitTable (self, objectids, minVisits=0, exposureids=None, instrument=None, filter=None):
+        '''
+        All visits of the given objectids as one phottables.visitTable, fetched with one query
+        per OBJECTCHUNK objects. minVisits, exposureids, instrument and filter act as in getVisits.
+        '''
+        objectids = sorted(set(objectids))
+        arrays = []
+        try:
+            cursor = self.cursor()
+            for first in range(0, len(objectids), self.OBJECTCHUNK):
+                data = {}
+                condition = self.visitCondition(
+                    "v.objectid IN (%s)" % inList('objectid', objectids[first:first + self.OBJECTCHUNK], data),
+                    data, minVisits, exposureids, instrument, filter)
+
+                cursor.execute(self.VISITQUERY + " WHERE " + condition, data)
+                arrays.append(visitArrayFromRows(cursor.fetchall()))
+            cursor.close()
+
+        except backends.Error as err:
+            self.log.exception("During getVisitTable: ")
+
+        return phottables.visitTable(np.concatenate(arrays) if len(arrays) > 0 else None)
+
+    def iterVisits (self, filter=None, exposureids=None, instrument=None, minVisits=0, orderBy=None, chunksize=None):
+        '''
+        Stream the matched visits passing the getVisits cuts as phottables.visitTable chunks of
+        up to chunksize rows, so whole surveys can be processed in bounded memory. The rows come
+        over one unbuffered cursor on a second connection; orderBy is an optional ORDER BY clause
+        such as "v.objectid, e.dateobs".
+        '''
+        if chunksize is None:
+            chunksize = self.VISITCHUNK
+
+        data = {}
+        sqlQuery = self.VISITQUERY + " WHERE " + self.visitCondition(
+            "v.objectid IS NOT NULL", data, minVisits, exposureids, instrument, filter)
+        if orderBy is not None:
+            sqlQuery += " ORDER BY " + orderBy
+
+        reader = self.getConnection()
+        try:
+            cursor = self.cursor(reader, buffered=False)
+            cursor.execute(sqlQuery, data)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if len(rows) == 0:
+                    break
+                yield phottables.visitTable(visitArrayFromRows(rows))
+            cursor.close()
+        finally:
+            reader.close()
+
+    def iterLightCurves (self, filter=None, exposureids=None, instrument=None, minVisits=0, chunksize=None):
+        '''
+        Stream complete light curves: phottables.visitTable chunks of about chunksize visits,
+        ordered by objectid and time, where no object is split across chunks. All rows come from
+        one server side sorted query, so a full database export runs in constant memory; use
+        visitTable.iterObjects on a chunk to walk its light curves. Unlike getVisitsForObject,
+        repeated visits of an object in the same exposure are all kept.
+        '''
+        pending = None
+        for visits in self.iterVisits(filter=filter, exposureids=exposureids, instrument=instrument,
+                                      minVisits=minVisits, orderBy="v.objectid, e.dateobs, v.visitid",
+                                      chunksize=chunksize):
+            array = visits.array if pending is None else np.concatenate((pending, visits.array))
+            # the last object may continue in the next chunk
+            split = np.searchsorted(array['objectid'], array['objectid'][-1])
+            pending = array[split:]
+            if split > 0:
+                yield phottables.visitTable(array[:split])
+        if pending is not None and len(pending) > 0:
+            yield phottables.visitTable(pending)
+
+    def _visitFromRow (self, row):
+        '''
+        Build a photVisit from a row of VISITQUERY; mag is the zero point corrected magnitude.
+        '''
+        visitid, ra, dec, mag, magerr,ota,odix,odiy, filter, exposureid, photzp, exptime, objid, dateobs, calmag = row
+        if calmag is not None:
+            absmag = float(calmag)
+        else:
+            absmag = float(mag) + float(photzp) + 2.5 * math.log10 (exptime)
+        #print visitid, mag, photzp, exptime, absmag
+
+        visit = photVisit(exposureid, objid, ra, dec, absmag, magerr)
+        visit.data['ota'] = ota
+        visit.data['odix'] = odix
+        visit.data['odiy'] = odiy
+        visit.data['visitid'] = visitid
+        dateobs =  str(dateobs).replace (" ", "T")
+        #print dateobs
+        visit.data['dateobs'] =  dateutil.parser.parse (dateobs)
+        return visit
         
     
-    def getVisits (self, objectid, minVisits=0, exposureids = None, instrument=None, filter=None):
+    def getVisits (self, objectid, minVisits=0, exposureids = None, instrument=None, filter=None, asarray=False):
         '''
         get all visits  for a given object ID
-        
-        TODO:
-        1. move minVisits condition into SQL query
-        2. 
+
+        Only visits in exposureids (if given) taken with instrument and filter (if given) are
+        returned, and nothing if fewer than minVisits visits pass these cuts; all of this is
+        evaluated by the database.
+
+        With asarray=True, the visits are returned as a NumPy structured array (VISITDTYPE)
+        instead of a dict of photVisits keyed by exposureid.
+
+        A database error is logged and gives an empty result in both forms, so callers cannot
+        tell it from an object without visits.
         '''
-        
-        queryCommand = ("select v.visitid,v.ra,v.decl,v.mag,v.magerr,v.ota,v.odix,v.odiy,e.filter,e.exposureid, e.photzp, e.exptime, v.objectid, e.dateobs"
-         " FROM  visits v INNER JOIN exposures e ON e.exposureid = v.exposureid"
-         " WHERE (objectid= %(objectid)s) ")
-       
-        minVisitsCond = " HAVING COUNT(v.visitid) > %(minvisits)s"
-       
-       
-       
-        if exposureids != None:
-            e = []
-            for id in exposureids:
-                e.append ("\'%s\'" % id.rstrip())
-            expIDcond = " AND (v.exposureid IN (%s))" % (','.join(e))
-            queryCommand += expIDcond
-            
+        data = {'objectid': objectid}
+        queryCommand = self.VISITQUERY + " WHERE " + self.visitCondition(
+            "v.objectid = %(objectid)s", data, minVisits, exposureids, instrument, filter)
+
         results = {}
-        c = 0;
-        count = 0
+        rows = []
         try:
-            cursor = self.db.cursor()
-            data = {
-                    'objectid' : objectid,
-                    'minvisits' : minVisits,
-                    'filter': filter,
-                    'instrument': instrument,
-                    #'exposureids': exposureids,
-                    }
-           
-            cursor.execute (queryCommand, data)
-            #print cursor.statement
-            
-            for visitid, ra, dec, mag, magerr,ota,odix,odiy, filter, exposureid, photzp, exptime, objid, dateobs in cursor:        
-                absmag = float(mag) + float(photzp) + 2.5 * math.log10 (exptime)
-                #print visitid, mag, photzp, exptime, absmag
-                
-                visit = photVisit(exposureid, objid, ra, dec, absmag, magerr)
-                visit.data['ota'] = ota
-                visit.data['odix'] = odix
-                visit.data['odiy'] = odiy
-                visit.data['visitid'] = visitid
-                dateobs =  str(dateobs).replace (" ", "T")
-                #print dateobs
-                visit.data['dateobs'] =  dateutil.parser.parse (dateobs)
-                results[str(exposureid)] = visit
-                
-                c += 1
-        
+            cursor = self.cursor()
+            try:
+                cursor.execute (queryCommand, data)
+                #print cursor.statement
+
+                if asarray:
+                    rows = cursor.fetchall()
+                else:
+                    for row in cursor:
+                        visit = self._visitFromRow(row)
+                        results[str(visit.data['exposureid'])] = visit
+            finally:
+                cursor.close()
             
-        except mysql.Error as err:
+        except backends.Error as err:
             self.log.exception("During getVisits: ")
         
-        finally:
-            pass
-            # print("Find visits for objectid %d returned %d entries (should be %d)" % (objectid, c, count))
-        
-        if c >= minVisits:
-            return results
-        return {}
+        if asarray:
+            return visitArrayFromRows(rows)
+        return results
 
 
-    def getVisitsByExpID (self, exposureid):
+    def getVisitsByExpID (self, exposureid, asarray=False):
+        '''
+        get all visits of an exposure as a list of photVisits, or with asarray=True as a
+        NumPy structured array (VISITDTYPE).
+
+        As in getVisits, a database error is logged and gives an empty result.
+        '''
 
-        queryCommand = ("select v.visitid,v.ra,v.decl,v.mag,v.magerr,v.ota,v.odix,v.odiy,e.filter,e.exposureid, e.photzp, e.exptime, v.objectid, e.dateobs"
-                        " FROM  visits v INNER JOIN exposures e ON e.exposureid = v.exposureid"
-                        " WHERE (e.exposureid= %(exposureid)s) ")
+        queryCommand = self.VISITQUERY + " WHERE (v.exposureid= %(exposureid)s) "
         results = []
+        rows = []
 
         try:
-            cursor = self.db.cursor()
+            cursor = self.cursor()
             data = {
                 'exposureid' : exposureid
             }
 
-            cursor.execute (queryCommand, data)
-            #print cursor.statement
-
-            for visitid, ra, dec, mag, magerr,ota,odix,odiy, filter, exposureid, photzp, exptime, objid, dateobs in cursor:
-                absmag = float(mag) + float(photzp) + 2.5 * math.log10 (exptime)
-                #print visitid, mag, photzp, exptime, absmag
-
-                visit = photVisit(exposureid, objid, ra, dec, absmag, magerr)
-                visit.data['ota'] = ota
-                visit.data['odix'] = odix
-                visit.data['odiy'] = odiy
-                visit.data['visitid'] = visitid
-                dateobs =  str(dateobs).replace (" ", "T")
-                #print dateobs
-                visit.data['dateobs'] =  dateutil.parser.parse (dateobs)
-                results.append ( visit)
-
-
-        except mysql.Error as err:
+            try:
+                cursor.execute (queryCommand, data)
+                #print cursor.statement
+
+                if asarray:
+                    rows = cursor.fetchall()
+                else:
+                    for row in cursor:
+                        results.append (self._visitFromRow(row))
+            finally:
+                cursor.close()
+
+        except backends.Error as err:
             self.log.exception("During getVisits: ")
 
-        finally:
-            pass
-            # print("Find visits for objectid %d returned %d entries (should be %d)" % (objectid, c, count))
-
 
+        if asarray:
+            return visitArrayFromRows(rows)
         return results
 
 
 
 
-    def matchVisits (self, tolerance=0.5):
-        import time
+    def matchVisits (self, tolerance=0.5, batchsize=5000, checkpoint=None):
         ''' 
             selects all unmatched visits and finds a nearest matched reference object within the tolerance.
             If a reference object is not found, a new reference object will be created out of the visit.
             
             The visit will be linked to the reference object
-            
+
+            Each batch of unmatched visits is matched in memory via matchPositions; the database
+            is only queried for the reference objects around the batch and to write the links.
+
+            Unmatched visits are streamed in visitid order over one unbuffered cursor on a second
+            pooled connection, batchsize rows at a time. If checkpoint is a file name, the last visitid
+            of every committed batch is recorded there, and a later call with the same checkpoint
+            resumes after it. The checkpoint file is removed once all visits are matched.
         '''
-        
-        # ## query all unmatched visits
-        unmatchedQuery = "SELECT `visitid`, `ra`, `decl` FROM `visits` where `objectid` is NULL LIMIT 5000 "
-        
-        try:
+        lastid = self._readCheckpoint(checkpoint)
+        if lastid > 0:
+            self.log.info("Resuming visit matching after visitid %d" % lastid)
 
+        unmatchedQuery = ("SELECT `visitid`, `ra`, `decl`, `exposureid`, `mag`, `magerr` FROM `visits`"
+                          " WHERE `objectid` IS NULL AND `visitid` > %s ORDER BY `visitid`")
 
+        totalvisits = 0
+        runstart = time.time()
+        reader = self.getConnection()
+        try:
+            unmatchedCursor = self.cursor(reader, buffered=False)
+            unmatchedCursor.execute(unmatchedQuery, (lastid,))
 
+            while True:
+                start = time.time()
+                results = unmatchedCursor.fetchmany(batchsize)
+                if len(results) == 0:
+                    break
+                fetched = time.time()
+
+                visitids = np.asarray([row[0] for row in results], dtype=np.int64)
+                ra = np.asarray([row[1] for row in results], dtype=np.float64)
+                dec = np.asarray([row[2] for row in results], dtype=np.float64)
+
+                # new objects, visit links and statistics of a batch are committed together
+                with self.transaction():
+                    objectids, matched, newobjects = self.matchPositions(ra, dec, tolerance)
+                    linked = objectids >= 0
+
+                    cursor = self._prepared(self.STATEMENTS['linkVisit'])
+                    cursor.executemany(self.STATEMENTS['linkVisit'],
+                                       list(zip(objectids[linked].tolist(), visitids[linked].tolist())))
+                    if self.OBJECTSTATS:
+                        self.updateObjectStats(objectids[linked].tolist(),
+                                               [row[3] for row, link in zip(results, linked) if link],
+                                               [row[4] for row, link in zip(results, linked) if link],
+                                               [row[5] for row, link in zip(results, linked) if link])
+
+                lastid = int(visitids[-1])
+                self._writeCheckpoint(checkpoint, lastid)
+                totalvisits += len(results)
 
-            unmatchedDB = database(self.dbhost, self.dbport, self.dbuser, self.dbpass, self.dbname)
+                end = time.time()
+                self.log.info("Matched %d visits up to visitid %d: %d to existing objects, %d new objects;"
+                              " fetch %.3f s, match and write %.3f s" %
+                              (len(results), lastid, matched, newobjects, fetched - start, end - fetched))
 
-            unmatchedCursor = unmatchedDB.db.cursor()
-            unmatchedCursor.execute (unmatchedQuery)
-            results = unmatchedCursor.fetchall()
+            unmatchedCursor.close()
+            self._writeCheckpoint(checkpoint, None)
 
-            while len(results) > 0:
-                start = time.time()
-                print "Matching next set of %s stars." % len(results)
-                matched = 0
-                newobjects = 0
-                newid = -1
+        except backends.Error as err:
+            self.log.exception("While matching visits, last committed visitid %d:" % lastid)
 
-                for (visitid, ra, dec) in results:
+        finally:
+            reader.close()
 
-                    #print visitid,ra,dec
-                    # find a viable reference object
-                    refObj = self.findObject(ra, dec, tolerance=tolerance)
+        elapsed = time.time() - runstart
+        self.log.info("Matched %d visits in %.1f s" % (totalvisits, elapsed))
+        return totalvisits
 
-                    if refObj is None:
-                        #print ("Create new photObject")
-                        newid = self.addObject(photObject(ra, dec))
-                        newobjects += 1
+    @staticmethod
+    def _readCheckpoint (checkpoint):
+        '''
+        Last visitid recorded in a checkpoint file, 0 if there is no checkpoint.
+        '''
+        if checkpoint is None or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as inf:
+            return int(inf.read().strip() or 0)
 
-                    else:
+    @staticmethod
+    def _writeCheckpoint (checkpoint, lastid):
+        '''
+        Atomically record lastid in the checkpoint file; lastid None removes the file.
+        '''
+        if checkpoint is None:
+            return
+        if lastid is None:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            return
+        with open(checkpoint + '.tmp', 'w') as outf:
+            outf.write("%d\n" % lastid)
+        os.rename(checkpoint + '.tmp', checkpoint)
+
+    def matchPositions (self, ra, dec, tolerance=0.5, reference=None, newrows=None):
+        '''
+        Match a batch of positions (degrees) against the reference objects in one go.
 
-                        newid = refObj.data['objectid']
-                        matched += 1
+        The objects around the batch are loaded into an in-memory ZoneIndex and
+        every position is assigned its nearest object within tolerance (arcsec). Positions without
+        a counterpart are grouped among themselves and one new object is created per group.
 
+        reference: optional (objectids, ra, dec) arrays to match against instead of loading tiles.
+        newrows: optional per-position rows (OBJECTCOLUMNS order) used to create new objects;
+        by default new objects only carry the position.
 
-                    if newid >=0:
+        Returns (objectids, number matched to existing objects, number of new objects).
+        '''
+        radius = tolerance / 3600.
+        objectids, sep = self.coneSearch(ra, dec, tolerance, nearest=True, reference=reference)
+        matched = int(np.sum(objectids >= 0))
+
+        unmatched = np.flatnonzero(objectids < 0)
+        newobjects = 0
+        if len(unmatched) > 0:
+            leader = crossmatch.groupPositions(ra[unmatched], dec[unmatched], radius)
+            leaders = np.unique(leader)
+            if newrows is None:
+                rows = [(r, d, None, None, None, None, None) for (r, d) in
+                        zip(ra[unmatched][leaders].tolist(), dec[unmatched][leaders].tolist())]
+            else:
+                rows = [newrows[idx] for idx in unmatched[leaders].tolist()]
+            newids = self.addObjectRows(rows)
 
-                        updateQuery = ("UPDATE `visits` set `objectid`=%s"
-                                       " WHERE `visitid`=%s;")
+            # map each group to the id of the object created from its leader
+            lookup = np.zeros(len(unmatched), dtype=np.int64)
+            lookup[leaders] = newids
+            objectids[unmatched] = lookup[leader]
+            newobjects = len(leaders)
 
-                        cursor = self.db.cursor()
-                        cursor.execute (updateQuery, (newid, visitid))
-                        self.db.commit()
+        return objectids, matched, newobjects
 
+    def coneSearch (self, ra, dec, radius, nearest=False, reference=None):
+        '''
+        Batch cone search of reference objects around many positions.
 
+        ra, dec are arrays in degrees, radius is in arcsec, either a scalar or one per position.
+        The candidate objects around the positions are fetched (see loadObjectPositions), or taken
+        from reference = (objectids, ra, dec); true angular separations are computed vectorized.
 
+        nearest=True: returns arrays (objectids, separation in arcsec) with the closest object per
+        position, objectid -1 and separation NaN where nothing is within radius.
+        nearest=False: returns arrays (position index, objectids, separation in arcsec) of all
+        pairs within radius.
+        '''
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        radius = np.asarray(radius, dtype=np.float64) / 3600.
+
+        if reference is None:
+            reference = self.loadObjectPositions(ra, dec, margin=float(np.max(radius)) if len(ra) > 0 else 0.)
+        refids, refra, refdec = reference
+        index = crossmatch.ZoneIndex(refra, refdec)
+
+        if nearest:
+            if len(refids) == 0:
+                return np.full(len(ra), -1, dtype=np.int64), np.full(len(ra), np.nan)
+            refidx, sep = index.nearest(ra, dec, radius)
+            objectids = np.where(refidx >= 0, refids[refidx], -1)
+            return objectids, sep * 3600.
+
+        queryidx, refidx, sep = index.query(ra, dec, radius)
+        return queryidx, refids[refidx], sep * 3600.
+
+    def loadObjectPositions (self, ra, dec, margin=0.):
+        '''
+        Fetch objectid, ra, decl of the reference objects around the given positions: one query
+        per sky tile for the bounding box of the positions in that tile, extended by margin
+        (degrees), so only the sky actually covered by the positions is read.
+        Returns three arrays (objectids, ra, dec) without duplicates.
+        '''
+        objectids = []
+        objra = []
+        objdec = []
+        for (declo, dechi, ralo, rahi) in crossmatch.tileFootprints(ra, dec, margin):
+            ids, r, d = self.getObjectPositions(declo, dechi, ralo, rahi)
+            objectids.append(ids)
+            objra.append(r)
+            objdec.append(d)
+
+        if len(objectids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+
+        objectids, first = np.unique(np.concatenate(objectids), return_index=True)
+        return objectids, np.concatenate(objra)[first], np.concatenate(objdec)[first]
+
+    def getObjectPositions (self, declo, dechi, ralo, rahi):
+        '''
+        Return arrays (objectids, ra, dec) of all reference objects in the box declo..dechi,
+        ralo..rahi (degrees). The RA limits may extend beyond 0 / 360 to cross the wrap-around.
+        '''
+        condition, data = regionCondition(declo, dechi, ralo, rahi)
+        sqlQuery = "SELECT `objectid`, `ra`, `decl` FROM `objects` WHERE %s" % condition
 
+        rows = []
+        try:
+            cursor = self.cursor()
+            cursor.execute(sqlQuery, data)
+            rows = cursor.fetchall()
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While loading object positions:")
 
-                # closing and reopening database is requried here to avoid use of buffered values. awkward!
-                unmatchedCursor.close()
-                unmatchedDB.db.commit()
-                unmatchedDB.closeDataBase()
-                unmatchedDB = database(self.dbhost, self.dbport, self.dbuser, self.dbpass, self.dbname)
-                unmatchedCursor = unmatchedDB.db.cursor()
-                unmatchedCursor.execute (unmatchedQuery)
-                results = unmatchedCursor.fetchall()
+        return (np.asarray([row[0] for row in rows], dtype=np.int64),
+                np.asarray([row[1] for row in rows], dtype=np.float64),
+                np.asarray([row[2] for row in rows], dtype=np.float64))
 
-                end = time.time()
-                print " Elapsed time for stars matching (% 4d / % 4d)plus next %d star search: %5f seconds" % (matched, newobjects,len(results),(end - start))
+    def addVisits (self, visits, batchsize=None):
+        '''
+        Add an array of photVisit objects for batch uploading.
 
+        Visits are sent as multi-row INSERT statements of up to batchsize rows each and
+        committed once at the end, i.e., one transaction per call (= per exposure for the ingesters).
+        Returns the number of visits inserted.
+        '''
+        if batchsize is None:
+            batchsize = self.BULKBATCHSIZE
 
+        rows = [tuple(visit.data[key] for key in self.VISITCOLUMNS) for visit in visits]
+        return self.addVisitRows(rows, batchsize=batchsize)
 
-            unmatchedCursor.close()
-            unmatchedDB.closeDataBase()
+    def addVisitColumns (self, columns, batchsize=None):
+        '''
+        Bulk insert visits given column-wise, i.e., as a dict mapping the names in VISITCOLUMNS
+        to NumPy arrays. Scalar entries (e.g. the exposureid, or None for objectid) apply to all rows.
+        '''
+        return self.addVisitRows(columnsToRows(columns, self.VISITCOLUMNS), batchsize=batchsize)
 
-        except mysql.Error as err:
-            print ("While matching visits: %s" % err)
-        
-        
-       
-        
-        # ## if needed, create a reference object
-        
-        
-        # ## link visit to reference object
-        
-        
-        pass
-    
-    
-    def addVisits (self, visits):
+    def addVisitRows (self, rows, batchsize=None):
         '''
-        Add an array of photVisit objects for batch uploading.
+        Bulk insert visits given as a sequence of tuples ordered as in VISITCOLUMNS.
+
+        All batches are written in a single transaction (or join the current one, see transaction);
+        on error the whole set is rolled back.
+        Throughput is reported in rows/second in the log.
         '''
+        if batchsize is None:
+            batchsize = self.BULKBATCHSIZE
+
+        start = time.time()
+        nrows = 0
         try:
-            cursor = self.db.cursor()
-            
-            for visit in visits:
-                self.addVisit(visit, cursor)
-            
-            cursor.close()
-            
-        except mysql.Error as err:
-            print ("While ingesting visits: %s" %  err)
-        
+            with self.transaction():
+                cursor = self.cursor()
+
+                for first in range(0, len(rows), batchsize):
+                    batch = rows[first:first + batchsize]
+                    cursor.executemany(self.STATEMENTS['insertVisit'], batch)
+                    nrows += len(batch)
+                    self._written(len(batch))
+
+                cursor.close()
+
+                if self.OBJECTSTATS:
+                    linked = [row for row in rows if row[1] is not None]
+                    if len(linked) > 0:
+                        exposureids, objectids, ra, dec, mag, magerr = list(zip(*linked))[:6]
+                        self.updateObjectStats(objectids, exposureids, mag, magerr)
+
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While bulk ingesting visits:")
+            return 0
+
+        elapsed = time.time() - start
+        self.log.info("Ingested %d visits in %.3f s (%.0f rows/s)" %
+                      (nrows, elapsed, nrows / elapsed if elapsed > 0 else float('inf')))
+        return nrows
+
     def addVisit (self, photVisit, cursor=None):
         '''
         Insert a single photVisit into the database.
         
-        If cursor database cursor is give, it will be used. Otherwise, a cursor will be opened. 
+        If cursor database cursor is give, it will be used. Otherwise, the cached prepared statement is used. 
         
         
         '''
         
-        sqlcommand = ("INSERT INTO `visits`"
-                    " ( `exposureid`, `objectid`, `ra`, `decl`, `mag`, `magerr`, `odix`, `odiy`, `ota`)"
-                    " VALUES (%(exposureid)s, %(objectid)s,  %(ra)s, %(decl)s, %(mag)s, %(magerr)s, %(odix)s, %(odiy)s, %(ota)s)")
-        
+        row = tuple(photVisit.data[key] for key in self.VISITCOLUMNS)
         try:
-            #print sqlcommand % photVisit.data
-            if cursor == None:
-                cursor = self.db.cursor()
+            with self.transaction():
+                if cursor == None:
+                    cursor = self._prepared(self.STATEMENTS['insertVisit'])
             
-            cursor.execute (sqlcommand, photVisit.data);
-            self.db.commit()
+                cursor.execute (self.STATEMENTS['insertVisit'], row);
+                self._written(1)
+                if self.OBJECTSTATS and photVisit.data['objectid'] is not None:
+                    self.updateObjectStats([photVisit.data['objectid']], [photVisit.data['exposureid']],
+                                           [photVisit.data['mag']], [photVisit.data['magerr']])
             
-        except mysql.Error as err:
-            print ("While ingesting visit: %s" % err.msg)
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            print ("While ingesting visit: %s" % err)
             
     
-    def findaddObjects (self, objects):
+    def findaddObjects (self, objects, tolerance=0.5):
         '''
         Add a list of photObjects to the database if they are not yet present. 
+
+        The whole list is resolved in one batch (see findaddObjectColumns) and the objectid of
+        every input object is filled in. Returns the number of new and of existing objects.
+        '''
+        columns = {}
+        for key in self.OBJECTCOLUMNS:
+            columns[key] = [obj.data[key] for obj in objects]
+
+        objectids, newobj, existobj = self._findaddObjectColumns(columns, tolerance)
+
+        for obj, objectid in zip(objects, objectids.tolist()):
+            obj.data['objectid'] = objectid if objectid >= 0 else None
+        return newobj, existobj
+
+    def addObjectRows (self, rows, batchsize=None):
         '''
-        newobj = 0
-        existobj = 0
+        Bulk insert objects given as tuples ordered as in OBJECTCOLUMNS, using one multi-row
+        INSERT per batch. Returns the array of new objectids, read back by position after each
+        batch (see _insertedObjectIds).
+        '''
+        if batchsize is None:
+            batchsize = self.BULKBATCHSIZE
+
+        objectids = np.zeros(len(rows), dtype=np.int64)
         try:
-            cursor = self.db.cursor()
-            
-            for obj in objects:
-              
-                exist = self.findObject(obj.data['ra'], obj.data['decl'], cursor=cursor)
-                if exist == None:
-                  
-                    newobj += 1
-                    newid = self.addObject(obj, cursor)
-                    obj.data['objectid'] = newid
-                    self.log.debug ("Object does not exist. Adding new one and its ID is %d" % newid)
-                else:    
-                    existobj += 1
-                    obj.data['objectid'] = exist.data['objectid']
-          
-            cursor.close()
-        
-        except mysql.Error as err:
-            self.log.exception("During findaddObecjts:")
-            
+            with self.transaction():
+                cursor = self.cursor()
+                for first in range(0, len(rows), batchsize):
+                    batch = rows[first:first + batchsize]
+                    cursor.executemany(self.STATEMENTS['insertObject'], batch)
+                    firstid = self.backend.firstInsertId(cursor, len(batch))
+                    objectids[first:first + len(batch)] = self._insertedObjectIds(cursor, firstid, batch)
+                    self._written(len(batch))
+                cursor.close()
+
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
+            self.log.exception("While bulk inserting objects:")
+            objectids[:] = -1
+        return objectids
+
+    def _insertedObjectIds (self, cursor, firstid, batch):
+        '''
+        Objectids of the rows of batch just inserted, the first of which got firstid. The ids of a
+        multi-row insert need not be consecutive (InnoDB interleaved auto increment lock mode,
+        auto_increment_increment > 1), so the new rows are read back and matched by position.
+        '''
+        decs = [row[1] for row in batch]
+        cursor.execute("SELECT `objectid`, `ra`, `decl` FROM `objects`"
+                       " WHERE `objectid` >= %s AND `decl` BETWEEN %s AND %s ORDER BY `objectid`",
+                       (int(firstid), min(decs), max(decs)))
+        inserted = {}
+        for objectid, ra, dec in cursor.fetchall():
+            inserted.setdefault((ra, dec), []).append(objectid)
+
+        objectids = np.full(len(batch), -1, dtype=np.int64)
+        for idx, row in enumerate(batch):
+            ids = inserted.get((row[0], row[1]))
+            if ids:
+                objectids[idx] = ids.pop(0)
+        if np.any(objectids < 0):
+            self.log.error("Could not read back the objectids of %d inserted objects" % np.sum(objectids < 0))
+        return objectids
+
+    def findaddObjectColumns (self, columns, tolerance=0.5):
+        '''
+        Column-wise version of findaddObjects: columns maps the names in OBJECTCOLUMNS to arrays.
+        Returns an array of objectids, one per input row, for existing or newly added objects.
+        '''
+        return self._findaddObjectColumns(columns, tolerance)[0]
+
+    def _findaddObjectColumns (self, columns, tolerance):
+        '''
+        Resolve a batch of objects (e.g. the reference catalog of one exposure) against the database:
+        all objects in the batch footprint are fetched with a single query, existing objects are
+        identified in memory within tolerance (arcsec), and only the new ones are bulk inserted.
+        Returns (objectids, number of new objects, number of existing objects).
+        '''
+        ra = np.asarray(columns['ra'], dtype=np.float64)
+        dec = np.asarray(columns['decl'], dtype=np.float64)
+        if len(ra) == 0:
+            return np.zeros(0, dtype=np.int64), 0, 0
+
+        radius = tolerance / 3600.
+        declo, dechi, ralo, rahi = crossmatch.footprint(ra, dec, margin=radius)
+        reference = self.getObjectPositions(declo, dechi, ralo, rahi)
+
+        rows = columnsToRows(columns, self.OBJECTCOLUMNS)
+        objectids, existobj, newobj = self.matchPositions(ra, dec, tolerance, reference=reference, newrows=rows)
+
         self.log.info (" New objects    : % 10d" % newobj)
         self.log.info (" Existing objets: % 10d" % existobj)
-    
-                    
+        return objectids, newobj, existobj
+
     def addObject (self, newObject, cursor=None):
         ''' 
         Add as single photObject to the database
         '''
         
-        sqlcommand = ("INSERT INTO `objects`"
-                      " (`ra`, `decl`, `sdss_u`, `sdss_g`, `sdss_r`, `sdss_i`, `sdss_z`)"
-                      " VALUES  (%(ra)s, %(decl)s, %(sdss_u)s, %(sdss_g)s, %(sdss_r)s, %(sdss_i)s, %(sdss_z)s)")
-       
+        row = tuple(newObject.data[key] for key in self.OBJECTCOLUMNS)
         newid = None
         try:
-            if cursor == None:
-                cursor = self.db.cursor()
+            with self.transaction():
+                if cursor == None:
+                    cursor = self._prepared(self.STATEMENTS['insertObject'])
             
-            cursor.execute (sqlcommand, newObject.data);
-            newid = cursor.lastrowid
-            self.db.commit()
+                cursor.execute (self.STATEMENTS['insertObject'], row);
+                newid = cursor.lastrowid
+                self._written(1)
             
-        except mysql.Error as err:
+        except backends.Error as err:
+            if self.inTransaction():
+                raise
             self.log.exception("While inserting single phot object:")
         return newid
     
     
     def distance2 (self, ra, dec, object):
         '''
-        Calcualte the distance squared (sqrt ommitted to save computation) between ra, dec 
-        and a photObject. 
+        Calculate the angular distance squared in degrees^2 between ra, dec and a photObject.
         
         photObject's data['ra'] and data['decl'] fields are used, i.e., this will work for every 
         photXXX class that has these fields.
         '''
-        
-        dra = ra - object.data['ra']
-        ddec = dec - object.data['decl']
-        
-        if (math.fabs(dec) < 90.):
-            dra = dra / math.sin (dec * math.pi / 180.)
-        
-        d2 = dra * dra + ddec * ddec
-        return d2
+        d = crossmatch.angularSeparation(ra, dec, object.data['ra'], object.data['decl'])
+        return d * d
         
         
     def findObject (self, ra, dec, tolerance=0.5, cursor=None):
-        
-        ret = None
-        tolerance /= 3600.
-        tolerance *= tolerance  # skip the sqrt
+        '''
+        Return the photObject closest to ra, dec within tolerance (arcsec), or None.
+        '''
         results = self.findObjects (ra, dec, sqr = 3, cursor=cursor)
 
         if len(results) == 0:
             return None
 
-        # Now, let us fund the closest object.
-        distances = []
-        ids = []
-
-        for obj in results:
-            d = self.distance2(ra, dec, obj)
-            distances.append (d)
-            ids.append (obj.data['objectid'])
-
+        # Now, let us find the closest object.
+        objra = np.asarray([obj.data['ra'] for obj in results], dtype=np.float64)
+        objdec = np.asarray([obj.data['decl'] for obj in results], dtype=np.float64)
+        distances = crossmatch.angularSeparation(ra, dec, objra, objdec)
         minIdx = np.argmin (distances)
 
-        if (distances[minIdx] < tolerance):
-                ret = results [minIdx]
-                if (ret.data['objectid'] != ids[minIdx]):
-                    print "Missmatch in finding enarest candidate! - somethig wrong!"
-                    return None
-
-                
-        return ret
+        if (distances[minIdx] < tolerance / 3600.):
+            return results [minIdx]
+        return None
 
     def findObjects (self, ra, dec, sqr=3., cursor=None):
         '''
         Queries all reference objects within a certain square in sky, 
         and returns a list of all objects found in the form of photObject.           
+
+        sqr is the half width of the square in arcsec, measured on the sky, i.e., the RA range
+        widens with declination. The query is served from the (zoneid, ra) index.
         '''
-        sqlQuery = ("SELECT  `objectid`,`ra`,`decl`,`sdss_u`, `sdss_g`, `sdss_r`, `sdss_i`, `sdss_z` FROM `objects`"
-            " WHERE  ("
-            " ( ABS ( (`ra`   - %(raref)s )  )  <= %(tol)s )"
-            " AND"
-            " ( ABS ( `decl` - %(declref)s) <= %(tol)s )"
-            " )")
-        
-        
-        data = { "raref" : ra,
-                
-                "tol" : sqr / 3600.,
-                "declref": dec
-                 
-                }
+        tol = sqr / 3600.
+        rawidth = crossmatch.raHalfWidth(dec, tol)
+        condition, data = regionCondition(dec - tol, dec + tol, ra - rawidth, ra + rawidth)
+        sqlQuery, data = positionalParameters(
+            "SELECT  `objectid`,`ra`,`decl`,`sdss_u`, `sdss_g`, `sdss_r`, `sdss_i`, `sdss_z` FROM `objects`"
+            " WHERE %s" % condition, data)
         
         results = []
         try:
             if cursor == None:
-                cursor = self.db.cursor()
+                cursor = self._prepared(sqlQuery)
             
             cursor.execute (sqlQuery, data)
             for (objectid, ra, dec, u,g,r,i,z) in cursor:
@@ -699,10 +1777,48 @@ class database(object):
                 obj.data['sdss_z'] = z
                 results.append (obj)
                 
-        except mysql.Error as err:
+        except backends.Error as err:
             self.log.exception("While finding photObjects:")
         return results
   
+    def findObjectTable (self, ra, dec, sqr=3.):
+        '''
+        As findObjects, but returns the objects as one phottables.objectTable.
+        '''
+        tol = sqr / 3600.
+        rawidth = crossmatch.raHalfWidth(dec, tol)
+        condition, data = regionCondition(dec - tol, dec + tol, ra - rawidth, ra + rawidth)
+        sqlQuery = OBJECTQUERY + " WHERE %s" % condition
+
+        rows = []
+        try:
+            cursor = self.cursor()
+            cursor.execute(sqlQuery, data)
+            rows = cursor.fetchall()
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While finding photObjects:")
+
+        return phottables.objectTable(recordArrayFromRows(rows, OBJECTDTYPE))
+
+    def getObjectTable (self, objectids):
+        '''
+        The objects with the given objectids as one phottables.objectTable, one query per OBJECTCHUNK ids.
+        '''
+        objectids = sorted(set(objectids))
+        rows = []
+        try:
+            cursor = self.cursor()
+            for first in range(0, len(objectids), self.OBJECTCHUNK):
+                data = {}
+                cursor.execute(OBJECTQUERY + " WHERE `objectid` IN (%s)"
+                               % inList('objectid', objectids[first:first + self.OBJECTCHUNK], data), data)
+                rows.extend(cursor.fetchall())
+            cursor.close()
+        except backends.Error as err:
+            self.log.exception("While getting objects by id:")
+        return phottables.objectTable(recordArrayFromRows(rows, OBJECTDTYPE))
+
     def findObjectsByID (self, minid, maxid, cursor = None):
         sqlQuery = ("SELECT  `objectid`,`ra`,`decl`,`sdss_u`, `sdss_g`, `sdss_r`, `sdss_i`, `sdss_z` FROM `objects`"
                     " WHERE  ("
@@ -721,7 +1837,7 @@ class database(object):
         results = []
         try:
             if cursor == None:
-                cursor = self.db.cursor()
+                cursor = self.cursor()
 
             cursor.execute (sqlQuery, data)
             for (objectid, ra, dec, u,g,r,i,z) in cursor:
@@ -733,7 +1849,7 @@ class database(object):
                 obj.data['sdss_z'] = z
                 results.append (obj)
 
-        except mysql.Error as err:
+        except backends.Error as err:
             self.log.exception("While finding photObjects:")
         return results
 
@@ -742,7 +1858,7 @@ class database(object):
 if __name__ == "__main__":      
     logging.basicConfig(format='%(asctime)s %(message)s')
    
-    print "mysql connector:", mysql.__version__
+    print "mysql connector:", backends.mysql.__version__
     db = database('localhost', 3306, 'stardb', 'stardb', 'm33')
     # db.cleanSlateDatabase()
     # sdb.createDatabase()
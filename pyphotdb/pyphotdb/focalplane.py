@@ -0,0 +1,245 @@
+'''
+Focal-plane residual maps of ODI photometry.
+
+Photometric residuals (visit magnitude minus a reference magnitude of its object) are
+accumulated over the focal plane: per OTA, on a grid of cells within each OTA, and in
+radial bins around the field centre. All statistics are kept as fixed size histograms of
+the residual, so medians of any number of visits come out of a single pass in bounded
+memory, and maps of separate runs (e.g. per night) can be merged.
+
+    fpmap = focalplane.focalPlaneResiduals(db, filter='odi_u')
+    otamedians = fpmap.otaMedians()
+    radius, profile, counts = fpmap.radialProfile()
+
+@author: harbeck
+'''
+
+import logging
+
+import numpy as np
+
+
+# OTAs per focal plane row / column; ota = 10 * otax + otay
+NOTA = 7
+
+# pixels per OTA side, as in photVisit.getGlobalXY
+OTAPIXELS = 4200
+
+# focal plane position of the field centre in global pixels, for radial profiles
+FOCALCENTER = (16800., 16800.)
+
+# residuals are histogrammed within +- RESIDUALRANGE magnitudes; visits outside are counted as outliers
+RESIDUALRANGE = 0.5
+
+# histogram bins across the residual range; sets the resolution of the medians
+RESIDUALBINS = 1000
+
+# cells per OTA side of the residual maps
+GRIDSIZE = 8
+
+# radial bins and outer radius in pixels of the radial profile
+RADIALBINS = 20
+RADIALMAX = 20000.
+
+log = logging.getLogger('focalplane')
+
+
+def histogramMedian (hist, lo, hi):
+    '''
+    Medians from histograms along the last axis, binned evenly between lo and hi, with linear
+    interpolation within the median bin. Empty histograms give NaN.
+    '''
+    nbins = hist.shape[-1]
+    width = (hi - lo) / float(nbins)
+    cumulative = np.cumsum(hist, axis=-1)
+    total = cumulative[..., -1]
+    half = total / 2.
+
+    medianbin = np.argmax(cumulative >= half[..., None], axis=-1)
+    below = np.take_along_axis(cumulative, medianbin[..., None], axis=-1)[..., 0] - \
+        np.take_along_axis(hist, medianbin[..., None], axis=-1)[..., 0]
+    inbin = np.take_along_axis(hist, medianbin[..., None], axis=-1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(inbin > 0, (half - below) / inbin, 0.5)
+    return np.where(total > 0, lo + (medianbin + fraction) * width, np.nan)
+
+
+class focalPlaneMap (object):
+    '''
+    Accumulator of residuals over the focal plane.
+
+    Per cell of the OTA grid and per radial bin a histogram of the residuals is kept, plus
+    the sums needed for means and rms. Memory use is independent of the number of visits.
+    '''
+
+    def __init__ (self, gridsize=GRIDSIZE, residualrange=RESIDUALRANGE, residualbins=RESIDUALBINS,
+                  radialbins=RADIALBINS, radialmax=RADIALMAX, center=FOCALCENTER):
+        self.gridsize = gridsize
+        self.residualrange = residualrange
+        self.residualbins = residualbins
+        self.radialbins = radialbins
+        self.radialmax = radialmax
+        self.center = center
+
+        ncells = NOTA * NOTA * gridsize * gridsize
+        self.hist = np.zeros((ncells, residualbins), dtype=np.int64)
+        self.sums = np.zeros((ncells, 2))
+        self.radialhist = np.zeros((radialbins, residualbins), dtype=np.int64)
+        self.nvisits = 0
+        self.outliers = 0
+
+    def add (self, residual, ota, odix, odiy):
+        '''
+        Accumulate residuals of visits on OTA ota at pixel odix, odiy (arrays).
+        '''
+        residual = np.asarray(residual, dtype=np.float64)
+        otax, otay = np.divmod(np.asarray(ota, dtype=np.int64), 10)
+        odix = np.asarray(odix, dtype=np.float64)
+        odiy = np.asarray(odiy, dtype=np.float64)
+
+        good = (np.abs(residual) < self.residualrange) & (otax >= 0) & (otax < NOTA) & (otay >= 0) & (otay < NOTA)
+        self.outliers += int(np.sum(~good & np.isfinite(residual)))
+        residual, otax, otay, odix, odiy = residual[good], otax[good], otay[good], odix[good], odiy[good]
+        self.nvisits += len(residual)
+        if len(residual) == 0:
+            return
+
+        rbin = ((residual + self.residualrange) / (2. * self.residualrange) * self.residualbins).astype(np.int64)
+        rbin = np.clip(rbin, 0, self.residualbins - 1)
+
+        cell = self._cell(otax, otay, odix, odiy)
+        ncells = self.hist.shape[0]
+        self.hist += np.bincount(cell * self.residualbins + rbin,
+                                 minlength=ncells * self.residualbins).reshape(self.hist.shape)
+        self.sums[:, 0] += np.bincount(cell, weights=residual, minlength=ncells)
+        self.sums[:, 1] += np.bincount(cell, weights=residual * residual, minlength=ncells)
+
+        x = OTAPIXELS * otax + odix
+        y = OTAPIXELS * otay + odiy
+        radius = np.hypot(x - self.center[0], y - self.center[1])
+        inside = radius < self.radialmax
+        radial = (radius[inside] / self.radialmax * self.radialbins).astype(np.int64)
+        self.radialhist += np.bincount(radial * self.residualbins + rbin[inside],
+                                       minlength=self.radialbins * self.residualbins).reshape(self.radialhist.shape)
+
+    def addVisits (self, visits, reference):
+        '''
+        Accumulate the visits of a phottables.visitTable against reference magnitudes (one per visit).
+        '''
+        self.add(visits['mag'] - reference, visits['ota'], visits['odix'], visits['odiy'])
+
+    def merge (self, other):
+        '''
+        Add the residuals accumulated in another map with the same binning.
+        '''
+        self.hist += other.hist
+        self.sums += other.sums
+        self.radialhist += other.radialhist
+        self.nvisits += other.nvisits
+        self.outliers += other.outliers
+        return self
+
+    def _cell (self, otax, otay, odix, odiy):
+        gx = np.clip((odix * self.gridsize / OTAPIXELS).astype(np.int64), 0, self.gridsize - 1)
+        gy = np.clip((odiy * self.gridsize / OTAPIXELS).astype(np.int64), 0, self.gridsize - 1)
+        return ((otax * NOTA + otay) * self.gridsize + gx) * self.gridsize + gy
+
+    def _grid (self, values):
+        '''
+        Per cell values as a focal plane image indexed [x, y], x = otax * gridsize + gx.
+        '''
+        values = values.reshape(NOTA, NOTA, self.gridsize, self.gridsize)
+        return values.transpose(0, 2, 1, 3).reshape(NOTA * self.gridsize, NOTA * self.gridsize)
+
+    def _median (self, hist):
+        return histogramMedian(hist, -self.residualrange, self.residualrange)
+
+    def otaMedians (self):
+        '''
+        Median residual per OTA as NOTA x NOTA array indexed [otax, otay].
+        '''
+        hist = self.hist.reshape(NOTA, NOTA, self.gridsize * self.gridsize, self.residualbins).sum(axis=2)
+        return self._median(hist)
+
+    def otaCounts (self):
+        return self.hist.sum(axis=1).reshape(NOTA, NOTA, -1).sum(axis=2)
+
+    def residualMap (self, statistic='median'):
+        '''
+        Binned residual map over the focal plane, NOTA * gridsize cells on a side, indexed [x, y].
+        statistic: 'median', 'mean', 'rms' or 'count'.
+        '''
+        counts = self.hist.sum(axis=1)
+        if statistic == 'median':
+            values = self._median(self.hist)
+        elif statistic == 'count':
+            values = counts
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = self.sums[:, 0] / counts
+                values = mean if statistic == 'mean' else np.sqrt(np.maximum(self.sums[:, 1] / counts - mean * mean, 0.))
+        return self._grid(values)
+
+    def radialProfile (self):
+        '''
+        Median residual versus distance from the field centre.
+        Returns arrays (bin centre radius in pixels, median, number of visits).
+        '''
+        width = self.radialmax / self.radialbins
+        return (np.arange(self.radialbins) * width + width / 2., self._median(self.radialhist),
+                self.radialhist.sum(axis=1))
+
+
+def referenceMagnitudes (db, visits, reference='mean'):
+    '''
+    Reference magnitude for every visit of a visitTable: 'mean' is the weighted mean magnitude
+    of the object in the visit's filter (from objectstats), any other value names a column of
+    the objects table, e.g. 'sdss_u'. Visits without reference get NaN.
+    '''
+    refmag = np.full(len(visits), np.nan)
+    if len(visits) == 0:
+        return refmag
+
+    if reference == 'mean':
+        for filter in np.unique(visits['filter']).tolist():
+            infilter = visits['filter'] == filter
+            stats = db.getObjectStats(filter=filter, objectids=np.unique(visits['objectid'][infilter]).tolist())
+            refmag[infilter] = _lookup(stats['objectid'], stats['meanmag'], visits['objectid'][infilter])
+        return refmag
+
+    objects = db.getObjectTable(np.unique(visits['objectid']).tolist())
+    return _lookup(objects['objectid'], objects[reference], visits['objectid'])
+
+
+def _lookup (keys, values, query):
+    '''
+    values[keys == query] for every query, NaN where the key is missing.
+    '''
+    result = np.full(len(query), np.nan)
+    if len(keys) == 0:
+        return result
+    order = np.argsort(keys)
+    idx = np.minimum(np.searchsorted(keys[order], query), len(keys) - 1)
+    found = keys[order][idx] == query
+    result[found] = values[order][idx][found]
+    return result
+
+
+def focalPlaneResiduals (db, filter=None, exposureids=None, reference='mean', fpmap=None, **kwargs):
+    '''
+    Stream the visits of a filter and / or exposure list through a focalPlaneMap. reference is
+    as in referenceMagnitudes; extra keyword arguments set the binning of a new map, or pass
+    fpmap to add to an existing one. Returns the map.
+    '''
+    if fpmap is None:
+        fpmap = focalPlaneMap(**kwargs)
+
+    for visits in db.iterVisits(filter=filter, exposureids=exposureids):
+        refmag = referenceMagnitudes(db, visits, reference)
+        known = np.isfinite(refmag)
+        fpmap.addVisits(visits.filter(known), refmag[known])
+        log.debug("%d visits accumulated, %d outliers" % (fpmap.nvisits, fpmap.outliers))
+
+    log.info("Focal plane map of %d visits (%d outliers beyond %.2f mag)" %
+             (fpmap.nvisits, fpmap.outliers, fpmap.residualrange))
+    return fpmap
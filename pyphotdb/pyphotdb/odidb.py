@@ -10,6 +10,7 @@ import numpy as np
 from database import photObject, photVisit
 from datetime import date, datetime, timedelta
 import dateutil.parser
+import itertools
 import logging
 
 
@@ -19,12 +20,21 @@ class odiQRIngester(object):
     '''
     log = logging.getLogger('odiQRIngester')
 
-    def __init__(self, odifilename, db):
+    def __init__(self, odifilename, db, batchsize=None, columnar=True, commitEvery=None):
         '''
         Constructor
+
+        batchsize: number of visits per multi-row INSERT; None uses the database default.
+        columnar: if True, the CAT.PHOTCALIB table is ingested as whole NumPy columns instead of
+        building a photObject / photVisit per row.
+        commitEvery: None commits each exposure as one transaction; a number additionally
+        commits every that many rows (see database.transaction).
         '''
         self.odifilename = odifilename
         self.db = db
+        self.batchsize = batchsize
+        self.columnar = columnar
+        self.commitEvery = commitEvery
 
         self.start()
 
@@ -36,6 +46,30 @@ class odiQRIngester(object):
         hdulist = fits.open(self.odifilename)
 
         ### Megtadata first
+        expObject = self.readExposure(hdulist)
+        obsid = expObject.data['exposureid']
+
+        # exposure, objects and visits of a file land together
+        with self.db.transaction(commitEvery=self.commitEvery):
+            self.db.addExposure(expObject)
+
+            try:
+                phottbl = hdulist['CAT.PHOTCALIB'].data
+                # phottbl.columns.info()
+            except:
+                self.log.warn("Coul dnot find extension CAT.PHOTCALIB, giving up on file %s " % (self.odifilename))
+                return
+
+            if self.columnar:
+                self.ingestColumns(phottbl, obsid)
+            else:
+                self.ingestRows(phottbl, obsid)
+
+    @staticmethod
+    def readExposure(hdulist):
+        '''
+        Build the photExposure for an ODI file from its primary header.
+        '''
         obsid = hdulist[0].header['OBSID']
         filter = hdulist[0].header['FILTER']
         airmass = float(hdulist[0].header['AIRMASS'])
@@ -46,16 +80,61 @@ class odiQRIngester(object):
 
         expObject = database.photExposure(obsid, datemid, filter, airmass, exptime, 0.6)
         expObject.data['photzp'] = photzp
+        return expObject
 
-        self.db.addExposure(expObject)
+    def ingestColumns(self, phottbl, obsid):
+        '''
+        Ingest a CAT.PHOTCALIB table column-wise: every field is read as one NumPy array and
+        objects and visits are handed to the database layer as columnar batches.
+        '''
+        self.log.debug("Process reference catalog (columnar)")
+        objcolumns, viscolumns = self.photTableColumns(phottbl, obsid)
+        writeColumns(self.db, objcolumns, viscolumns, batchsize=self.batchsize)
 
+    @staticmethod
+    def photTableColumns(phottbl, obsid):
+        '''
+        Extract the reference object and visit columns of a CAT.PHOTCALIB table as NumPy arrays,
+        keyed as in database.OBJECTCOLUMNS and database.VISITCOLUMNS.
+        '''
+        nrows = len(phottbl)
+
+        objcolumns = {'ra': np.asarray(phottbl['SDSS_RA'], dtype=np.float64),
+                      'decl': np.asarray(phottbl['SDSS_DEC'], dtype=np.float64)}
+        for band in ('u', 'g', 'r', 'i', 'z'):
+            objcolumns['sdss_%s' % band] = np.asarray(phottbl['SDSS_MAG_%s' % band.upper()], dtype=np.float64)
+
+        # objectid is unknown at this time, set to None
+        viscolumns = {'exposureid': obsid,
+                      'objectid': None,
+                      'ra': np.asarray(phottbl['ODI_RA'], dtype=np.float64),
+                      'decl': np.asarray(phottbl['ODI_DEC'], dtype=np.float64),
+                      'mag': np.asarray(phottbl['ODI_MAG_AUTO'], dtype=np.float64),
+                      'magerr': np.asarray(phottbl['ODI_ERR_AUTO'], dtype=np.float64),
+                      'odix': odiQRIngester._pixelColumn(phottbl, 'ODI_X', nrows),
+                      'odiy': odiQRIngester._pixelColumn(phottbl, 'ODI_Y', nrows),
+                      'ota': odiQRIngester._pixelColumn(phottbl, 'ODI_OTA', nrows)}
+        return objcolumns, viscolumns
+
+    @staticmethod
+    def _pixelColumn(phottbl, name, nrows):
+        '''
+        Return an integer column of the table; missing columns and non-finite entries become -1.
+        '''
         try:
-            phottbl = hdulist['CAT.PHOTCALIB'].data
-            # phottbl.columns.info()
-        except:
-            self.log.warn("Coul dnot find extension CAT.PHOTCALIB, giving up on file %s " % (self.odifilename))
-            return
+            values = np.asarray(phottbl[name], dtype=np.float64)
+        except KeyError:
+            return np.full(nrows, -1, dtype=np.int64)
+
+        good = np.isfinite(values)
+        result = np.full(nrows, -1, dtype=np.int64)
+        result[good] = values[good].astype(np.int64)
+        return result
 
+    def ingestRows(self, phottbl, obsid):
+        '''
+        Ingest a CAT.PHOTCALIB table row by row via photObject and photVisit instances.
+        '''
         objects = []
         visits = []
         self.log.debug("Process reference catalog")
@@ -89,7 +168,7 @@ class odiQRIngester(object):
         self.log.info("Ingesting objects into database")
         self.db.findaddObjects(objects)
         self.log.info("Ingesting visits into database")
-        self.db.addVisits(visits)
+        self.db.addVisits(visits, batchsize=self.batchsize)
         self.log.info("Done ingesting file")
 
     def pairVisits(self):
@@ -98,69 +177,170 @@ class odiQRIngester(object):
         '''
 
 
+def writeColumns(db, objcolumns, viscolumns, batchsize=None):
+    '''
+    Write the columnar reference objects and visits of one exposure to the database.
+    Returns the number of visits written.
+    '''
+    log = odiQRIngester.log
+    log.info("Ingesting objects into database")
+    db.findaddObjectColumns(objcolumns)
+    log.info("Ingesting visits into database")
+    nvisits = db.addVisitColumns(viscolumns, batchsize=batchsize)
+    log.info("Done ingesting file")
+    return nvisits
+
+
+def parsePhotFile(odifilename):
+    '''
+    Read an ODI file without touching the database. Returns (photExposure, objcolumns, viscolumns);
+    the columns are None if the file has no CAT.PHOTCALIB extension.
+    This is a module level function so it can be shipped to worker processes.
+    '''
+    hdulist = fits.open(odifilename)
+    try:
+        expObject = odiQRIngester.readExposure(hdulist)
+        try:
+            phottbl = hdulist['CAT.PHOTCALIB'].data
+        except KeyError:
+            return expObject, None, None
+        objcolumns, viscolumns = odiQRIngester.photTableColumns(phottbl, expObject.data['exposureid'])
+    finally:
+        hdulist.close()
+    return expObject, objcolumns, viscolumns
+
+
 class sextractorIngestor(object):
 
     log = logging.getLogger('odiSexIngester')
 
-    def __init__(self, odifilename, sextractorfilename, db):
+    def __init__(self, odifilename, sextractorfilename, db, batchsize=None, chunksize=None, commitEvery=None):
         '''
         Constructor
+
+        chunksize: number of catalogue lines parsed and ingested at a time; None uses SEXCHUNKSIZE.
+        commitEvery: commit policy as for odiQRIngester.
         '''
         self.odifilename = odifilename
         self.sextractorfilename = sextractorfilename
         self.db = db
+        self.batchsize = batchsize
+        self.chunksize = chunksize if chunksize is not None else SEXCHUNKSIZE
+        self.commitEvery = commitEvery
 
     def start(selfself):
         return 0
 
     def readSexFile(self):
+        '''
+        Ingest the SExtractor catalogue chunk by chunk, so memory use does not grow with the
+        size of the catalogue. Returns the number of visits ingested.
+        '''
         self.log.debug("Start ingestion of file: %s %s", self.odifilename, self.sextractorfilename)
         hdulist = fits.open(self.odifilename)
 
         ### Megtadata first
-        obsid = hdulist[0].header['OBSID']
-        filter = hdulist[0].header['FILTER']
-        airmass = float(hdulist[0].header['AIRMASS'])
-        exptime = float(hdulist[0].header['EXPTIME'])
-        photzp = float(hdulist[0].header['PHOTZP'])
-
-        datemid = dateutil.parser.parse(hdulist[0].header['DATE-MID'])
-
-        expObject = database.photExposure(obsid, datemid, filter, airmass, exptime, 0.6)
-        expObject.data['photzp'] = photzp
+        expObject = odiQRIngester.readExposure(hdulist)
+        obsid = expObject.data['exposureid']
+        hdulist.close()
 
-        self.db.addExposure(expObject)
-
-
-        photometrydata = np.loadtxt (self.sextractorfilename)
-
-        objects = []
-        visits = []
-        self.log.debug("Process reference catalog")
-        for row in photometrydata:
-
-
-            objra =   float(row[5])
-            objdec =  float(row[6])
-            odi_x  =  float (row[3])
-            odi_y  =  float (row[4])
-            odi_ota= 0
+        self.log.info("Ingesting visits into database")
+        nvisits = 0
+        with self.db.transaction(commitEvery=self.commitEvery):
+            self.db.addExposure(expObject)
+
+            for chunk in iterSexCatalog(self.sextractorfilename, self.chunksize):
+                # objectid is unknown at this time, set to None
+                chunk['exposureid'] = obsid
+                chunk['objectid'] = None
+                # image pixel coordinates if the catalogue has them; the OTA is unknown
+                nrows = len(chunk['mag'])
+                chunk['odix'] = odiQRIngester._pixelColumn(chunk, 'x', nrows)
+                chunk['odiy'] = odiQRIngester._pixelColumn(chunk, 'y', nrows)
+                chunk['ota'] = -1
+                nvisits += self.db.addVisitColumns(chunk, batchsize=self.batchsize)
+
+        self.log.info("Done ingesting file, %d visits" % nvisits)
+        return nvisits
+
+
+# number of SExtractor catalogue lines parsed at a time
+SEXCHUNKSIZE = 50000
+
+# catalogue parameters used for visits, in order of preference, and the column index
+# (0-based) used for catalogues without a header
+SEXCOLUMNS = {'mag': (('MAG_AUTO', 'MAG_BEST', 'MAG_ISOCOR', 'MAG_ISO'), 1),
+              'magerr': (('MAGERR_AUTO', 'MAGERR_BEST', 'MAGERR_ISOCOR', 'MAGERR_ISO'), 2),
+              'x': (('X_IMAGE', 'XWIN_IMAGE'), 3),
+              'y': (('Y_IMAGE', 'YWIN_IMAGE'), 4),
+              'ra': (('ALPHA_J2000', 'ALPHAWIN_J2000', 'X_WORLD'), 5),
+              'decl': (('DELTA_J2000', 'DELTAWIN_J2000', 'Y_WORLD'), 6)}
+
+# SEXCOLUMNS keys a catalogue may lack; its visits then get odix / odiy -1
+SEXOPTIONAL = ('x', 'y')
+
+
+def sexColumnIndices(header):
+    '''
+    Map the SEXCOLUMNS keys to 0-based column indices, given the header as a dict of
+    parameter name to 0-based column. Falls back to the legacy fixed layout without a header.
+    Keys in SEXOPTIONAL are left out if the header has none of their columns.
+    '''
+    indices = {}
+    for key, (names, default) in SEXCOLUMNS.items():
+        if len(header) == 0:
+            indices[key] = default
+            continue
+        for name in names:
+            if name in header:
+                indices[key] = header[name]
+                break
+        else:
+            if key in SEXOPTIONAL:
+                continue
+            raise ValueError("SExtractor catalogue has none of the columns %s" % ", ".join(names))
+    return indices
+
+
+def iterSexCatalog(sextractorfilename, chunksize=SEXCHUNKSIZE):
+    '''
+    Read a SExtractor ASCII catalogue in chunks of chunksize lines. The \'#\' header lines
+    (ASCII_HEAD format) identify the columns by name. Yields dicts of float arrays keyed as
+    SEXCOLUMNS, without x and y if the catalogue has no pixel coordinates.
+    '''
+    header = {}
+    with open(sextractorfilename, 'r') as inf:
+        first = None
+        for line in inf:
+            if line.startswith('#'):
+                fields = line[1:].split()
+                if len(fields) > 1 and fields[0].isdigit():
+                    header[fields[1]] = int(fields[0]) - 1
+                continue
+            if len(line.strip()) > 0:
+                first = line
+                break
+
+        if first is None:
+            return
 
+        indices = sexColumnIndices(header)
+        ncolumns = len(first.split())
+        lines = [first]
 
-            obj = photObject(objra, objdec)
-             # objectid is unknown at this time, set to None
-            visit = photVisit(obsid, None, objra, objdec,
-                           float (row[1]), float (row[2]))
+        while True:
+            lines.extend(itertools.islice(inf, chunksize - len(lines)))
+            if len(lines) == 0:
+                return
 
-            #
-            # objects.append(obj)
-            visits.append(visit)
+            data = np.fromstring(''.join(lines), sep=' ')
+            if len(data) % ncolumns != 0:
+                raise ValueError("Inconsistent number of columns in %s" % sextractorfilename)
+            data = data.reshape(-1, ncolumns)
 
-        #self.log.info("Ingesting objects into database")
-        #self.db.findaddObjects(objects)
-        self.log.info("Ingesting visits into database")
-        self.db.addVisits(visits)
-        self.log.info("Done ingesting file")
+            if len(data) > 0:
+                yield dict((key, data[:, idx].copy()) for key, idx in indices.items())
+            lines = []
 
 
 def pairVisits(self):
@@ -183,13 +363,11 @@ if __name__ == "__main__":
         db.cleanSlateDatabase()
         db.createDatabase()
 
+        import pipeline
+
         with open("/home/harbeck/git/pyphotdb/pyphotdb/m33.dat", 'r') as inf:
-            for line in inf:
-                print line
-                try:
-                    odidata = odiQRIngester(line.rstrip(), db);
-                except:
-                    print "Error while reading file: %s" % (line)
+            summary = pipeline.ingestPipeline(db).run(inf.readlines())
+        print "Ingested %d of %d files, %d failed" % (summary['ingested'], summary['files'], len(summary['failed']))
 
         db.matchVisits(1.0)
 
@@ -5,48 +5,35 @@ Created on Jan 9, 2016
 '''
 
 import database
+import focalplane
 import logging
 
 import matplotlib.pyplot as plt
 import numpy as np
 
 
-class MyClass(object):
+def applyZeroPoints(visits, exposures):
     '''
-    classdocs
-
-    Map structure
-
-
+    Recalibrate a phottables.visitTable with the zero points in an EXPOSUREDTYPE array, e.g. a
+    trial solution not yet stored with database.setZeroPoints. mag is recomputed from instmag,
+    so applying the same zero points again gives the same result. Visits of exposures not in
+    exposures keep their magnitude. Returns a new visitTable.
     '''
-
-
-    def __init__(self, params):
-        '''
-        Constructor
-        '''
-        
-    
-    def correctZPforObjects(db, objects):
-        '''
-       
-        '''   
-        for object in objects:
-       
-            for k,v in object.visits.iteritems():
-           
-           
-                exposure = db.getExposure(k)
-                zp = exposure.data['photzp']
-                airmass = exposure.data['airmass']
-                fwhm = exposure.data['fwhm']
-                dateobs = exposure.data['dateobs']
-                v.data['mag'] += zp
-                v.data['dateobs'] = dateobs
-        
-        
-
-
+    if len(exposures) == 0:
+        return visits
+    order = np.argsort(exposures['exposureid'])
+    expids = exposures['exposureid'][order]
+    idx = np.minimum(np.searchsorted(expids, visits['exposureid']), len(expids) - 1)
+    found = expids[idx] == visits['exposureid']
+
+    array = visits.array.copy()
+    photzp = exposures['photzp'][order][idx].astype(np.float64)
+    exptime = exposures['exptime'][order][idx].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mag = array['instmag'] + photzp + 2.5 * np.log10(exptime)
+    array['mag'] = np.where(found, mag, array['mag'])
+    array['photzp'] = np.where(found, photzp, array['photzp'])
+    return visits.__class__(array)
 
 
 if __name__ == "__main__":
@@ -58,41 +45,17 @@ if __name__ == "__main__":
      exposures = db.getExposureIDs('odi_u')
      print  exposures
      
-     objects = db.findObjects(48.66, 41.3, 3600)
-     
-     ra = []
-     dec = []
-     stddev = []
-     mean = []
-     delta = []
+     fpmap = focalplane.focalPlaneResiduals(db, filter='odi_u', exposureids=exposures, reference='sdss_u')
      
-     for object in objects:
-         db.getVisitsForObject(object, minVisits=1)
-         if len(object.visits) > 0:
-             refmag =  object.data['sdss_u']
-            
-             d = []
-             if refmag != None:
-                 for v in object.visits:
-                     x,y = v.getGlobalXY()
-                     delta.append (v.data['mag'] - refmag)
-                     ra.append(x)
-                     dec.append(y)
-                     
+     print np.nanmedian(fpmap.otaMedians())
+     print fpmap.otaMedians()
     
-     print np.median(delta)
-     print np.std(delta)
-    
-     plt.scatter (ra,dec, c= delta, marker="s",linewidths=0, vmin=-0.2,vmax=0.2)  
+     plt.imshow (fpmap.residualMap().T, origin='lower', interpolation='nearest', vmin=-0.2, vmax=0.2)
      plt.colorbar()
      plt.show()
-     
-     
-     
-     
-     
-    
-        
-        
-        
-    
\ No newline at end of file
+
+     radius, profile, counts = fpmap.radialProfile()
+     plt.plot (radius, profile, "o")
+     plt.xlabel ("radius")
+     plt.ylabel ("odi_u - sdss_u")
+     plt.show()
@@ -0,0 +1,228 @@
+'''
+Array backed containers for many visits or objects.
+
+A visitTable / objectTable keeps all rows in one NumPy structured array, so a whole field
+of visits costs ~100 bytes per visit instead of a photVisit with its own dict. Columns are
+accessed vectorized (table['mag']), rows are filtered with boolean masks, and visits can be
+grouped by object. For code written against photVisit / photObject, iterating a table yields
+light-weight row views with the familiar .data[...] access.
+
+@author: harbeck
+'''
+
+import numpy as np
+
+
+# record layout of visits returned as arrays; mag is zero point and exposure time corrected,
+# instmag is the magnitude as stored in the visits table
+VISITDTYPE = np.dtype([('visitid', np.int64), ('objectid', np.int64), ('exposureid', 'S20'), ('filter', 'S10'),
+                       ('ra', np.float64), ('decl', np.float64), ('mag', np.float64), ('magerr', np.float32),
+                       ('instmag', np.float32), ('photzp', np.float32), ('exptime', np.float32),
+                       ('ota', np.int32), ('odix', np.int32), ('odiy', np.int32),
+                       ('dateobs', 'datetime64[us]')])
+
+# record layout of reference objects
+OBJECTDTYPE = np.dtype([('objectid', np.int64), ('ra', np.float64), ('decl', np.float64),
+                        ('sdss_u', np.float32), ('sdss_g', np.float32), ('sdss_r', np.float32),
+                        ('sdss_i', np.float32), ('sdss_z', np.float32)])
+
+# record layout of exposures
+EXPOSUREDTYPE = np.dtype([('exposureid', 'S20'), ('instrument', 'S10'), ('filter', 'S10'), ('airmass', np.float32),
+                          ('exptime', np.float32), ('fwhm', np.float32), ('dateobs', 'datetime64[us]'),
+                          ('photzp', np.float32)])
+
+# record layout of per object (and filter) photometric statistics; rms is the unweighted
+# scatter around the unweighted mean, meanmag the inverse variance weighted mean
+OBJECTSTATSDTYPE = np.dtype([('objectid', np.int64), ('filter', 'S10'), ('nvisits', np.int32),
+                             ('meanmag', np.float64), ('rms', np.float64),
+                             ('firstobs', 'datetime64[us]'), ('lastobs', 'datetime64[us]'), ('timespan', np.float64)])
+
+# stand-in for NULL / missing values by dtype kind
+NULLS = {'i': -1, 'f': np.nan, 'S': '', 'M': np.datetime64('NaT')}
+
+
+class rowData(object):
+    '''
+    Mapping view of one table row, standing in for the .data dict of photVisit / photObject.
+    '''
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.array[key][self.index]
+
+    def __setitem__(self, key, value):
+        self.array[key][self.index] = value
+
+    def __contains__(self, key):
+        return key in self.array.dtype.names
+
+    def keys(self):
+        return list(self.array.dtype.names)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class visitRow(object):
+    '''
+    Row view of a visitTable with the interface of photVisit.
+    '''
+    __slots__ = ('data',)
+
+    def __init__(self, array, index):
+        self.data = rowData(array, index)
+
+    def getGlobalXY(self):
+        otax, otay = divmod(int(self.data['ota']), 10)
+        return (4200 * otax + self.data['odix'], 4200 * otay + self.data['odiy'])
+
+
+class objectRow(object):
+    '''
+    Row view of an objectTable with the data interface of photObject.
+    '''
+    __slots__ = ('data',)
+
+    def __init__(self, array, index):
+        self.data = rowData(array, index)
+
+
+class recordTable(object):
+    '''
+    Base class of the containers: wraps a structured array of dtype DTYPE.
+    '''
+    DTYPE = None
+    ROWCLASS = None
+
+    def __init__(self, array=None):
+        if array is None:
+            array = np.zeros(0, dtype=self.DTYPE)
+        self.array = np.asarray(array)
+
+    @classmethod
+    def fromRecords(cls, records):
+        '''
+        Build a table from photVisit / photObject like instances; missing fields and None
+        become -1, NaN, '' or NaT depending on the column type.
+        '''
+        array = np.zeros(len(records), dtype=cls.DTYPE)
+        for name in cls.DTYPE.names:
+            null = NULLS[cls.DTYPE[name].kind]
+            array[name] = [null if record.data.get(name) is None else record.data[name] for record in records]
+        return cls(array)
+
+    @classmethod
+    def concatenate(cls, tables):
+        arrays = [table.array for table in tables]
+        if len(arrays) == 0:
+            return cls()
+        return cls(np.concatenate(arrays))
+
+    @property
+    def fields(self):
+        return self.array.dtype.names
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for index in range(len(self.array)):
+            yield self.ROWCLASS(self.array, index)
+
+    def __getitem__(self, key):
+        '''
+        table['mag'] is a column, table[5] a row view, and a slice, index array or boolean
+        mask selects a new table.
+        '''
+        if isinstance(key, basestring):
+            return self.array[key]
+        if isinstance(key, (int, np.integer)):
+            return self.ROWCLASS(self.array, key)
+        return self.__class__(self.array[key])
+
+    def filter(self, mask):
+        return self.__class__(self.array[np.asarray(mask)])
+
+    def sort(self, *fields):
+        return self.__class__(np.sort(self.array, order=list(fields)))
+
+
+class visitTable(recordTable):
+    '''
+    Many visits in one structured array of VISITDTYPE.
+    '''
+    DTYPE = VISITDTYPE
+    ROWCLASS = visitRow
+
+    def getGlobalXY(self):
+        '''
+        Focal plane coordinates of all visits, vectorized version of photVisit.getGlobalXY.
+        '''
+        otax, otay = np.divmod(self.array['ota'].astype(np.int64), 10)
+        return 4200 * otax + self.array['odix'], 4200 * otay + self.array['odiy']
+
+    def groupByObject(self, minVisits=0):
+        '''
+        Split into one visitTable per objectid. Returns a dict objectid -> visitTable
+        of the objects with at least minVisits visits.
+        '''
+        objectids, first, counts = self.objectCounts()
+        order = np.argsort(self.array['objectid'], kind='mergesort')
+        groups = {}
+        for objectid, start, count in zip(objectids.tolist(), first.tolist(), counts.tolist()):
+            if count >= minVisits:
+                groups[objectid] = visitTable(self.array[order[start:start + count]])
+        return groups
+
+    def iterObjects(self):
+        '''
+        Yield (objectid, visitTable) per object in objectid order, keeping the order of the
+        visits within each object.
+        '''
+        objectids, first, counts = self.objectCounts()
+        order = np.argsort(self.array['objectid'], kind='mergesort')
+        for objectid, start, count in zip(objectids.tolist(), first.tolist(), counts.tolist()):
+            yield objectid, visitTable(self.array[order[start:start + count]])
+
+    def objectCounts(self):
+        '''
+        Distinct objectids, the position of their first visit in objectid order, and their visit counts.
+        '''
+        ids = np.sort(self.array['objectid'], kind='mergesort')
+        objectids, first, counts = np.unique(ids, return_index=True, return_counts=True)
+        return objectids, first, counts
+
+    def minVisits(self, minVisits):
+        '''
+        Keep only the visits of objects with at least minVisits visits.
+        '''
+        objectids, first, counts = self.objectCounts()
+        keep = objectids[counts >= minVisits]
+        return self.filter(np.in1d(self.array['objectid'], keep))
+
+    def meanMag(self):
+        '''
+        Per object mean and standard deviation of mag. Returns arrays (objectids, mean, std).
+        '''
+        objectids, inverse = np.unique(self.array['objectid'], return_inverse=True)
+        counts = np.bincount(inverse).astype(np.float64)
+        mag = self.array['mag']
+        mean = np.bincount(inverse, weights=mag) / counts
+        var = np.bincount(inverse, weights=mag * mag) / counts - mean * mean
+        return objectids, mean, np.sqrt(np.maximum(var, 0.))
+
+
+class objectTable(recordTable):
+    '''
+    Many reference objects in one structured array of OBJECTDTYPE.
+    '''
+    DTYPE = OBJECTDTYPE
+    ROWCLASS = objectRow
@@ -0,0 +1,333 @@
+'''
+Parallel ingestion of many ODI exposures.
+
+FITS reading and table conversion run in a pool of worker processes, while a small,
+fixed number of writer threads - each with its own database connection - load the
+parsed exposures into the database. A failure in one file is logged and recorded
+without stopping the other files. ingestService keeps doing so for the files arriving in a
+directory.
+
+@author: harbeck
+'''
+
+import argparse
+import fnmatch
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import Queue
+
+import database
+import odidb
+
+
+# file name patterns and polling interval in seconds of ingestService
+WATCHPATTERNS = ('*.fits', '*.fits.fz')
+WATCHINTERVAL = 10.
+
+# seconds after submission within which a file must come back from the parsers
+PARSETIMEOUT = 600.
+
+
+def _parseSafely(odifilename):
+    '''
+    Worker process entry: parse one file and return (filename, parsed result, error message).
+    '''
+    try:
+        return odifilename, odidb.parsePhotFile(odifilename), None
+    except Exception:
+        return odifilename, None, traceback.format_exc()
+
+
+class ingestPipeline(object):
+    '''
+    Ingest a list of ODI files with nparsers worker processes and nwriters database writers.
+
+    At most queuesize parsed files wait for a writer at any time, so a slow database throttles
+    the parsers instead of letting parsed tables pile up in memory.
+
+    The writers load visits in parallel, but resolve reference objects one at a time, each in
+    its own committed transaction; the objects of an exposure may therefore already be in the
+    database if writing its visits fails.
+
+    A file that does not come back from the parsers within parsetimeout seconds, e.g. because
+    its worker process died, is recorded as failed and its queue slot is freed. The pool is then
+    terminated instead of joined at the end, as it still waits for that file.
+    '''
+
+    log = logging.getLogger('ingestPipeline')
+
+    def __init__(self, db, nparsers=None, nwriters=2, queuesize=4, batchsize=None, commitEvery=None,
+                 parsetimeout=PARSETIMEOUT):
+        self.db = db
+        self.nparsers = nparsers if nparsers is not None else multiprocessing.cpu_count()
+        self.nwriters = nwriters
+        self.queuesize = queuesize
+        self.batchsize = batchsize
+        self.commitEvery = commitEvery
+        self.parsetimeout = parsetimeout
+
+    def run(self, filenames):
+        '''
+        Ingest all files and return a summary dict with the number of files ingested, the
+        failures as (filename, error) pairs, visits written, and the throughput.
+        '''
+        filenames = [f.rstrip() for f in filenames if len(f.strip()) > 0]
+        self.start()
+        try:
+            for odifilename in filenames:
+                self.submit(odifilename)
+        finally:
+            summary = self.finish()
+        return summary
+
+    def start(self):
+        '''
+        Start the writer threads and parser processes; files are then handed in with submit.
+        '''
+        self.started = time.time()
+        self.parsed = Queue.Queue()
+        self.slots = threading.BoundedSemaphore(self.queuesize + self.nwriters)
+        self.lock = threading.Lock()
+        self.objectLock = threading.Lock()
+        self.summary = {'files': 0, 'ingested': 0, 'failed': [], 'visits': 0}
+        # files handed to the parsers and not back yet, by token: (filename, submission time)
+        self.pending = {}
+        self.tokens = itertools.count()
+        self.returned = threading.Condition(self.lock)
+        self.lost = 0
+        self.stopping = threading.Event()
+
+        # fork the parsers first: a fork after the writers started would copy their open
+        # database connections and any lock a writer holds at that moment into the children
+        self.pool = multiprocessing.Pool(self.nparsers)
+        self.writers = [threading.Thread(target=self._writer, name='ingestWriter-%d' % ii)
+                        for ii in range(self.nwriters)]
+        for writer in self.writers:
+            writer.start()
+        self.watchdog = threading.Thread(target=self._watchdog, name='ingestWatchdog')
+        self.watchdog.start()
+
+    def submit(self, odifilename):
+        '''
+        Queue one file for parsing. Blocks while queuesize parsed files wait for a writer.
+        '''
+        self.slots.acquire()
+        with self.lock:
+            self.summary['files'] += 1
+            token = next(self.tokens)
+            self.pending[token] = (odifilename, time.time())
+        self.pool.apply_async(_parseSafely, (odifilename,), callback=functools.partial(self._parsed, token))
+
+    def finish(self):
+        '''
+        Wait for all submitted files to be written or given up, stop the workers and return the
+        summary.
+        '''
+        try:
+            with self.lock:
+                while len(self.pending) > 0:
+                    self.returned.wait(1.)
+            if self.lost == 0:
+                self.pool.close()
+                self.pool.join()
+        finally:
+            self.stopping.set()
+            self.watchdog.join()
+            for writer in self.writers:
+                self.parsed.put(None)
+            for writer in self.writers:
+                writer.join()
+            self.pool.terminate()
+
+        elapsed = time.time() - self.started
+        self.summary['elapsed'] = elapsed
+        self.summary['filespersec'] = self.summary['ingested'] / elapsed if elapsed > 0 else 0.
+        self.summary['visitspersec'] = self.summary['visits'] / elapsed if elapsed > 0 else 0.
+
+        self.log.info("Ingested %d of %d files, %d visits in %.1f s (%.2f files/s, %.0f visits/s)" %
+                      (self.summary['ingested'], self.summary['files'], self.summary['visits'], elapsed,
+                       self.summary['filespersec'], self.summary['visitspersec']))
+        for odifilename, error in self.summary['failed']:
+            self.log.error("Failed to ingest %s:\n%s" % (odifilename, error))
+        return self.summary
+
+    def _parsed(self, token, result):
+        '''
+        Pool callback: hand a parsed file to the writers, unless it was given up already.
+        '''
+        with self.lock:
+            if self.pending.pop(token, None) is None:
+                return
+            self.parsed.put(result)
+            if len(self.pending) == 0:
+                self.returned.notify_all()
+
+    def _watchdog(self):
+        '''
+        Record the files not back from the parsers within parsetimeout as failed and free their
+        slots; a dead worker process never returns its file.
+        '''
+        while not self.stopping.wait(self.parsetimeout / 4.):
+            now = time.time()
+            with self.lock:
+                for token, (odifilename, submitted) in self.pending.items():
+                    if now - submitted > self.parsetimeout:
+                        del self.pending[token]
+                        self.summary['failed'].append(
+                            (odifilename, "No result from the parsers within %.0f s" % self.parsetimeout))
+                        self.lost += 1
+                        self.slots.release()
+                if len(self.pending) == 0:
+                    self.returned.notify_all()
+
+    def _writer(self):
+        '''
+        Writer thread: owns one database connection and writes parsed files until told to stop.
+        '''
+        with self.db.clone() as db:
+            while True:
+                item = self.parsed.get()
+                if item is None:
+                    return
+                odifilename, parsed, error = item
+                try:
+                    if error is None:
+                        nvisits = self._write(db, parsed)
+                except Exception:
+                    error = traceback.format_exc()
+                finally:
+                    self.slots.release()
+
+                with self.lock:
+                    if error is None:
+                        self.summary['ingested'] += 1
+                        self.summary['visits'] += nvisits
+                    else:
+                        self.summary['failed'].append((odifilename, error))
+
+    def _write(self, db, parsed):
+        expObject, objcolumns, viscolumns = parsed
+        if objcolumns is not None:
+            # Reference objects are resolved by one writer at a time and committed before the
+            # next one looks: concurrent transactions cannot see each other's new objects and
+            # would insert the same stars of overlapping exposures twice.
+            with self.objectLock:
+                with db.transaction():
+                    db.findaddObjectColumns(objcolumns)
+
+        with db.transaction(commitEvery=self.commitEvery):
+            db.addExposure(expObject)
+            if objcolumns is None:
+                self.log.warn("No CAT.PHOTCALIB extension for exposure %s" % expObject.data['exposureid'])
+                return 0
+            return db.addVisitColumns(viscolumns, batchsize=self.batchsize)
+
+
+class ingestService(ingestPipeline):
+    '''
+    Ingest ODI files as they arrive, e.g. during the night.
+
+    The directory tree is polled every interval seconds for files matching patterns; a file is
+    submitted once its size and modification time did not change between two polls, so files
+    still being copied are left alone. Parsing and writing overlap as in ingestPipeline, and a
+    slow database blocks the polling through the bounded queue. Further files can be handed in
+    from other threads with submit.
+    '''
+
+    log = logging.getLogger('ingestService')
+
+    def __init__(self, db, directory, patterns=WATCHPATTERNS, interval=WATCHINTERVAL, **kwargs):
+        ingestPipeline.__init__(self, db, **kwargs)
+        self.directory = directory
+        self.patterns = patterns
+        self.interval = interval
+        self.seen = set()
+        self.candidates = {}
+        self.stopped = threading.Event()
+
+    def poll(self):
+        '''
+        Submit the new files that are complete. Returns the number of files submitted.
+        '''
+        found = {}
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                    path = os.path.join(root, name)
+                    if path in self.seen:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_size, stat.st_mtime)
+
+        submitted = 0
+        for path in sorted(found):
+            if self.candidates.get(path) == found[path]:
+                self.seen.add(path)
+                self.submit(path)
+                submitted += 1
+        self.candidates = dict((path, state) for path, state in found.items() if path not in self.seen)
+        return submitted
+
+    def serve(self, duration=None):
+        '''
+        Poll until stop is called or after duration seconds, then finish the files already
+        submitted. Returns the ingestPipeline summary.
+        '''
+        self.log.info("Watching %s for %s" % (self.directory, ", ".join(self.patterns)))
+        self.stopped.clear()
+        self.start()
+        try:
+            while not self.stopped.is_set():
+                self.poll()
+                if duration is not None and time.time() - self.started >= duration:
+                    break
+                self.stopped.wait(self.interval)
+        finally:
+            summary = self.finish()
+        return summary
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Ingest ODI files into a photometry database')
+    parser.add_argument('files', nargs='*', help='files to ingest; with --watch, the directory to watch')
+    parser.add_argument('--watch', action='store_true', help='keep ingesting files arriving in a directory')
+    parser.add_argument('--interval', type=float, default=WATCHINTERVAL)
+    parser.add_argument('--duration', type=float, help='stop watching after this many seconds')
+    parser.add_argument('--sqlite', help='SQLite database file instead of the MySQL server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='stardb')
+    parser.add_argument('--password', default='stardb')
+    parser.add_argument('--dbname', default='m33')
+    parser.add_argument('--writers', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.sqlite is not None:
+        db = database.sqliteDatabase(args.sqlite)
+    else:
+        db = database.database(args.host, args.port, args.user, args.password, args.dbname)
+    db.createDatabase()
+
+    with db:
+        if args.watch:
+            service = ingestService(db, args.files[0], interval=args.interval, nwriters=args.writers)
+            try:
+                service.serve(args.duration)
+            except KeyboardInterrupt:
+                service.stop()
+        else:
+            ingestPipeline(db, nwriters=args.writers).run(args.files)
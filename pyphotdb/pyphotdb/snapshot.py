@@ -0,0 +1,293 @@
+'''
+Columnar snapshots of the objects, visits and exposures tables.
+
+exportSnapshot writes (a region, filter or exposure list of) the database into a directory
+with one .npy file per table column, e.g. visits/mag.npy, plus a snapshot.json manifest.
+The column files are memory-mapped when read back, so an analysis session only touches the
+columns and rows it uses. With compress=True every table goes into one compressed .npz
+instead, which is smaller but decompressed on load.
+
+A snapshot answers the common array queries of database - findObjectTable, getVisitTable,
+getVisitsByExpID - without a database connection:
+
+    snap = snapshot.snapshot('m33_r')
+    visits = snap.visits(minVisits=5)
+
+@author: harbeck
+'''
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+import numpy as np
+
+import crossmatch
+import database
+import phottables
+
+
+# manifest file of a snapshot directory
+MANIFEST = 'snapshot.json'
+
+# rows fetched from the database at a time while exporting
+EXPORTCHUNK = 100000
+
+# record layout of every snapshot table
+TABLES = {'exposures': phottables.EXPOSUREDTYPE,
+          'objects': phottables.OBJECTDTYPE,
+          'visits': phottables.VISITDTYPE}
+
+log = logging.getLogger('snapshot')
+
+
+def exportSnapshot (db, directory, region=None, filter=None, exposureids=None, compress=False):
+    '''
+    Export the exposures, objects and visits of db into directory.
+
+    region: optional (declo, dechi, ralo, rahi) in degrees restricting objects and visits by
+    position; filter / exposureids restrict exposures and visits.
+    Returns the manifest, which records the selection and the number of rows per table.
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    exposureCondition = []
+    visitCondition = []
+    objectCondition = []
+    data = {}
+    if region is not None:
+        condition, regiondata = database.regionCondition(*region)
+        data.update(regiondata)
+        objectCondition.append(condition)
+        visitCondition.append(condition)
+    if filter is not None:
+        data['filter'] = filter
+        exposureCondition.append("`filter` = %(filter)s")
+        visitCondition.append("e.filter = %(filter)s")
+    if exposureids is not None:
+        exposureids = [id.rstrip() for id in exposureids]
+        exposureCondition.append("`exposureid` IN (%s)" % database.inList('exposureid', exposureids, data))
+        visitCondition.append("v.exposureid IN (%s)" % database.inList('exposureid', exposureids, data))
+
+    queries = (('exposures', database.EXPOSUREQUERY, exposureCondition,
+                lambda rows: database.recordArrayFromRows(rows, phottables.EXPOSUREDTYPE)),
+               ('objects', database.OBJECTQUERY, objectCondition,
+                lambda rows: database.recordArrayFromRows(rows, phottables.OBJECTDTYPE)),
+               ('visits', db.VISITQUERY, visitCondition, database.visitArrayFromRows))
+
+    manifest = {'created': datetime.utcnow().isoformat(),
+                'database': db.dbname,
+                'backend': db.backend.name,
+                'selection': {'region': region, 'filter': filter, 'exposureids': exposureids},
+                'compressed': compress,
+                'tables': {}}
+
+    for table, sqlQuery, conditions, toArray in queries:
+        start = time.time()
+        if len(conditions) > 0:
+            sqlQuery += " WHERE " + " AND ".join("(%s)" % condition for condition in conditions)
+        nrows = _exportTable(db, directory, table, sqlQuery, data, toArray, compress)
+        manifest['tables'][table] = {'rows': nrows, 'columns': list(TABLES[table].names)}
+        elapsed = time.time() - start
+        log.info("Exported %d %s in %.1f s (%.0f rows/s)" %
+                 (nrows, table, elapsed, nrows / elapsed if elapsed > 0 else 0.))
+
+    with open(os.path.join(directory, MANIFEST), 'w') as outf:
+        json.dump(manifest, outf, indent=1)
+    return manifest
+
+
+def _exportTable (db, directory, table, sqlQuery, data, toArray, compress):
+    '''
+    Run sqlQuery over a streaming cursor and write the rows into the column files of table,
+    EXPORTCHUNK rows at a time, so only one chunk is held in memory. Returns the number of rows.
+
+    The column data are appended to raw files in a temporary directory first; the .npy header
+    needs the final row count and is written in front of them once all rows are in.
+    '''
+    dtype = TABLES[table]
+    workdir = tempfile.mkdtemp(prefix='.' + table, dir=directory)
+    try:
+        nrows = 0
+        rawfiles = {}
+        conn = db.getConnection()
+        try:
+            for name in dtype.names:
+                rawfiles[name] = open(os.path.join(workdir, name), 'wb')
+            cursor = db.cursor(conn, buffered=False)
+            cursor.execute(sqlQuery, data)
+            while True:
+                rows = cursor.fetchmany(EXPORTCHUNK)
+                if len(rows) == 0:
+                    break
+                array = toArray(rows)
+                for name in dtype.names:
+                    np.ascontiguousarray(array[name], dtype=dtype[name]).tofile(rawfiles[name])
+                nrows += len(array)
+            cursor.close()
+        finally:
+            conn.close()
+            for rawfile in rawfiles.values():
+                rawfile.close()
+
+        tabledir = workdir if compress else os.path.join(directory, table)
+        if not os.path.isdir(tabledir):
+            os.makedirs(tabledir)
+        for name in dtype.names:
+            _writeColumn(os.path.join(tabledir, name + '.npy'), os.path.join(workdir, name),
+                         dtype[name], nrows)
+        if compress:
+            with zipfile.ZipFile(os.path.join(directory, table + '.npz'), 'w',
+                                 zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+                for name in dtype.names:
+                    npz.write(os.path.join(workdir, name + '.npy'), arcname=name + '.npy')
+    finally:
+        shutil.rmtree(workdir)
+    return nrows
+
+
+def _writeColumn (filename, rawfilename, dtype, nrows):
+    '''
+    Write the .npy file of a column of nrows values of dtype stored without header in rawfilename.
+    '''
+    with open(filename, 'wb') as outf:
+        np.lib.format.write_array_header_1_0(outf, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                    'fortran_order': False, 'shape': (nrows,)})
+        with open(rawfilename, 'rb') as inf:
+            shutil.copyfileobj(inf, outf)
+
+
+class snapshot (object):
+    '''
+    Read access to a snapshot directory written by exportSnapshot.
+    '''
+
+    def __init__ (self, directory, mmap=True):
+        self.directory = directory
+        self.mmap = mmap
+        with open(os.path.join(directory, MANIFEST)) as inf:
+            self.manifest = json.load(inf)
+        self._npz = {}
+
+    def column (self, table, name):
+        '''
+        One column of a table; memory-mapped unless the snapshot is compressed or mmap is False.
+        '''
+        if self.manifest['compressed']:
+            if table not in self._npz:
+                self._npz[table] = np.load(os.path.join(self.directory, table + '.npz'))
+            return self._npz[table][name]
+        return np.load(os.path.join(self.directory, table, name + '.npy'),
+                       mmap_mode='r' if self.mmap else None)
+
+    def table (self, table, rows=None):
+        '''
+        A table as structured array, optionally only the rows selected by an index array or mask.
+        '''
+        dtype = TABLES[table]
+        columns = [self.column(table, name) for name in dtype.names]
+        if rows is not None:
+            columns = [column[rows] for column in columns]
+        nrows = len(columns[0])
+        array = np.zeros(nrows, dtype=dtype)
+        for name, column in zip(dtype.names, columns):
+            array[name] = column
+        return array
+
+    def exposures (self, filter=None):
+        '''
+        The exposures as EXPOSUREDTYPE structured array.
+        '''
+        rows = None if filter is None else (self.column('exposures', 'filter') == filter)
+        return self.table('exposures', rows)
+
+    def objects (self, region=None):
+        '''
+        The objects as phottables.objectTable, optionally only those in region (declo, dechi, ralo, rahi).
+        '''
+        rows = None
+        if region is not None:
+            rows = _inRegion(self.column('objects', 'ra'), self.column('objects', 'decl'), region)
+        return phottables.objectTable(self.table('objects', rows))
+
+    def findObjectTable (self, ra, dec, sqr=3.):
+        '''
+        As database.findObjectTable: the objects within the box of half width sqr (arcsec) around ra, dec.
+        '''
+        tol = sqr / 3600.
+        rawidth = crossmatch.raHalfWidth(dec, tol)
+        return self.objects((dec - tol, dec + tol, ra - rawidth, ra + rawidth))
+
+    def visits (self, objectids=None, minVisits=0, exposureids=None, filter=None, region=None):
+        '''
+        The visits as phottables.visitTable, with the selections of database.getVisitTable.
+        '''
+        rows = np.ones(self.manifest['tables']['visits']['rows'], dtype=bool)
+        if objectids is not None:
+            rows &= np.in1d(self.column('visits', 'objectid'), np.asarray(objectids, dtype=np.int64))
+        if exposureids is not None:
+            rows &= np.in1d(self.column('visits', 'exposureid'), [id.rstrip() for id in exposureids])
+        if filter is not None:
+            rows &= self.column('visits', 'filter') == filter
+        if region is not None:
+            rows &= _inRegion(self.column('visits', 'ra'), self.column('visits', 'decl'), region)
+
+        visits = phottables.visitTable(self.table('visits', np.flatnonzero(rows)))
+        return visits.minVisits(minVisits) if minVisits > 0 else visits
+
+    def getVisitsByExpID (self, exposureid):
+        return self.visits(exposureids=[exposureid])
+
+
+def _inRegion (ra, dec, region):
+    '''
+    Mask of positions in (declo, dechi, ralo, rahi), with RA limits wrapping as in database.regionCondition.
+    '''
+    declo, dechi, ralo, rahi = region
+    mask = (dec >= declo) & (dec <= dechi)
+    if rahi - ralo >= 360.:
+        return mask
+    if ralo < 0.:
+        return mask & ((ra >= ralo + 360.) | (ra <= rahi))
+    if rahi > 360.:
+        return mask & ((ra >= ralo) | (ra <= rahi - 360.))
+    return mask & (ra >= ralo) & (ra <= rahi)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Export a columnar snapshot of a photometry database')
+    parser.add_argument('directory')
+    parser.add_argument('--sqlite', help='SQLite database file instead of the MySQL server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='stardb')
+    parser.add_argument('--password', default='stardb')
+    parser.add_argument('--dbname', default='m33')
+    parser.add_argument('--region', type=float, nargs=4, metavar=('DECLO', 'DECHI', 'RALO', 'RAHI'))
+    parser.add_argument('--filter')
+    parser.add_argument('--exposures', help='file with one exposureid per line')
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    if args.sqlite is not None:
+        db = database.sqliteDatabase(args.sqlite)
+    else:
+        db = database.database(args.host, args.port, args.user, args.password, args.dbname)
+
+    exposureids = None
+    if args.exposures is not None:
+        with open(args.exposures) as inf:
+            exposureids = [line for line in inf.readlines() if len(line.strip()) > 0]
+
+    with db:
+        exportSnapshot(db, args.directory, region=args.region, filter=args.filter,
+                       exposureids=exposureids, compress=args.compress)
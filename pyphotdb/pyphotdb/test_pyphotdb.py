@@ -2,6 +2,643 @@ import unittest
 import odidb
 import database
 
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import astropy.io.fits as fits
+import numpy as np
+
+import backends
+import crossmatch
+import pipeline
+import snapshot
+import ubercal
+
+
+logging.disable(logging.CRITICAL)
+
+
+def bruteForcePairs(ra, dec, refra, refdec, radius):
+    '''
+    All (query index, reference index) pairs within radius (degrees), by brute force.
+    '''
+    pairs = set()
+    for idx in range(len(ra)):
+        sep = crossmatch.angularSeparation(ra[idx], dec[idx], refra, refdec)
+        pairs.update((idx, ref) for ref in np.flatnonzero(sep <= radius).tolist())
+    return pairs
+
+
+def skyPositions(rng, n):
+    '''
+    Random positions clustered around the RA wrap-around, an ordinary field and the north pole.
+    '''
+    third = n // 3
+    ra = np.concatenate((np.mod(rng.uniform(-0.2, 0.2, third), 360.), rng.uniform(150., 150.4, third),
+                         rng.uniform(0., 360., n - 2 * third)))
+    dec = np.concatenate((rng.uniform(-0.2, 0.2, third), rng.uniform(30., 30.4, third),
+                          rng.uniform(89.8, 90., n - 2 * third)))
+    return ra, dec
+
+
+def makeExposure(exposureid, hour=0):
+    '''
+    A photExposure in odi_r with a header zero point of 25.
+    '''
+    exposure = database.photExposure(exposureid, datetime.datetime(2016, 1, 1, hour), 'odi_r', 1.1, 100., 0.8)
+    exposure.data['photzp'] = 25.
+    return exposure
+
+
+def fakePhotFile(odifilename):
+    '''
+    Stand-in for odidb.parsePhotFile in the pipeline workers: file expN holds ten stars of its
+    own, well apart from those of the other files; files named bad* cannot be parsed, and
+    reading a file named die* kills the worker process.
+    '''
+    name = os.path.basename(odifilename)
+    if name.startswith('bad'):
+        raise IOError("Cannot read %s" % odifilename)
+    if name.startswith('die'):
+        os._exit(1)
+    index = int(name[3:])
+    ra = 10. + 0.01 * index + 1e-3 * np.arange(10)
+    dec = np.full(10, 41.)
+    objcolumns = {'ra': ra, 'decl': dec}
+    for band in 'ugriz':
+        objcolumns['sdss_%s' % band] = np.full(10, 18.)
+    viscolumns = {'exposureid': name, 'objectid': None, 'ra': ra, 'decl': dec,
+                  'mag': np.full(10, -7.), 'magerr': np.full(10, 0.01),
+                  'odix': np.arange(10), 'odiy': np.arange(10), 'ota': np.full(10, 33)}
+    return makeExposure(name, index), objcolumns, viscolumns
+
+
+class databaseTestCase(unittest.TestCase):
+    '''
+    Fresh SQLite database per test.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = database.sqliteDatabase(os.path.join(self.directory, 'test.db'))
+        self.db.createDatabase()
+
+    def tearDown(self):
+        self.db.closeDataBase()
+        shutil.rmtree(self.directory)
+
+    def countRows(self, table):
+        '''
+        Number of rows in table as seen from another connection, i.e., the committed ones.
+        '''
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM `%s`" % table)
+            count = cursor.fetchone()[0]
+            cursor.close()
+        return count
+
+    def addExposures(self, nexposures=3, nstars=200, seed=0):
+        '''
+        nexposures exposures of the same stars in odi_r, ingested and matched. Returns the
+        injected zero point offsets.
+        '''
+        rng = np.random.RandomState(seed)
+        ra = rng.uniform(10., 10.1, nstars)
+        dec = rng.uniform(41., 41.1, nstars)
+        mag = rng.uniform(-9., -4., nstars)
+        offsets = rng.normal(0., 0.05, nexposures)
+        for idx in range(nexposures):
+            self.db.addExposure(makeExposure('exp%d' % idx, idx))
+            self.db.addVisitColumns({'exposureid': 'exp%d' % idx, 'objectid': None,
+                                     'ra': ra + rng.normal(0., 1e-5, nstars), 'decl': dec,
+                                     'mag': mag - offsets[idx] + rng.normal(0., 0.01, nstars),
+                                     'magerr': np.full(nstars, 0.01),
+                                     'odix': np.arange(nstars), 'odiy': np.arange(nstars),
+                                     'ota': np.where(np.arange(nstars) % 2 == 0, 33, 34)})
+        self.db.matchVisits(0.5)
+        return offsets
+
+
+class testZoneIndex(unittest.TestCase):
+
+    def testQueryMatchesBruteForce(self):
+        rng = np.random.RandomState(1)
+        refra, refdec = skyPositions(rng, 3000)
+        ra, dec = skyPositions(rng, 300)
+        radius = 60. / 3600.
+
+        queryidx, refidx, sep = crossmatch.ZoneIndex(refra, refdec).query(ra, dec, radius)
+        self.assertEqual(set(zip(queryidx.tolist(), refidx.tolist())),
+                         bruteForcePairs(ra, dec, refra, refdec, radius))
+        np.testing.assert_allclose(sep, crossmatch.angularSeparation(ra[queryidx], dec[queryidx],
+                                                                     refra[refidx], refdec[refidx]))
+
+    def testNearestMatchesBruteForce(self):
+        rng = np.random.RandomState(2)
+        refra, refdec = skyPositions(rng, 3000)
+        ra, dec = skyPositions(rng, 300)
+        radius = 120. / 3600.
+
+        refidx, sep = crossmatch.ZoneIndex(refra, refdec).nearest(ra, dec, radius)
+        for idx in range(len(ra)):
+            separation = crossmatch.angularSeparation(ra[idx], dec[idx], refra, refdec)
+            if np.min(separation) > radius:
+                self.assertEqual(refidx[idx], -1)
+            else:
+                self.assertAlmostEqual(sep[idx], np.min(separation))
+
+
+class blockingPipeline(pipeline.ingestPipeline):
+    '''
+    An ingestPipeline whose writers wait for the release event before writing anything.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        pipeline.ingestPipeline.__init__(self, *args, **kwargs)
+        self.release = threading.Event()
+
+    def _write(self, db, parsed):
+        self.release.wait()
+        return pipeline.ingestPipeline._write(self, db, parsed)
+
+
+class testPipeline(databaseTestCase):
+
+    def setUp(self):
+        databaseTestCase.setUp(self)
+        self.parsePhotFile = odidb.parsePhotFile
+        odidb.parsePhotFile = fakePhotFile
+
+    def tearDown(self):
+        odidb.parsePhotFile = self.parsePhotFile
+        databaseTestCase.tearDown(self)
+
+    def testFailureIsolation(self):
+        summary = pipeline.ingestPipeline(self.db, nparsers=2, nwriters=1).run(['exp0', 'bad1', 'exp2', 'exp3'])
+
+        self.assertEqual(summary['ingested'], 3)
+        self.assertEqual([odifilename for odifilename, error in summary['failed']], ['bad1'])
+        self.assertIn('IOError', summary['failed'][0][1])
+        self.assertEqual(summary['visits'], 30)
+        for exposureid in ('exp0', 'exp2', 'exp3'):
+            self.assertEqual(len(self.db.getVisitsByExpID(exposureid)), 10)
+
+    def testBackpressure(self):
+        ingest = blockingPipeline(self.db, nparsers=2, nwriters=1, queuesize=2)
+        summaries = []
+        runner = threading.Thread(target=lambda: summaries.append(ingest.run(['exp%d' % idx for idx in range(8)])))
+        runner.start()
+        try:
+            deadline = time.time() + 30.
+            while getattr(ingest, 'parsed', None) is None or ingest.parsed.qsize() < 2:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            time.sleep(0.5)
+            # the blocked writer holds one file and queuesize more wait; nothing else is parsed
+            self.assertEqual(ingest.parsed.qsize(), 2)
+        finally:
+            ingest.release.set()
+            runner.join()
+
+        self.assertEqual(summaries[0]['ingested'], 8)
+        self.assertEqual(summaries[0]['visits'], 80)
+
+    def testWorkerDeath(self):
+        ingest = pipeline.ingestPipeline(self.db, nparsers=2, nwriters=1, queuesize=1, parsetimeout=3.)
+        summary = ingest.run(['exp0', 'die1', 'exp2', 'exp3', 'exp4'])
+
+        self.assertEqual(summary['ingested'], 4)
+        self.assertEqual([odifilename for odifilename, error in summary['failed']], ['die1'])
+
+
+class testRegionCondition(databaseTestCase):
+
+    def setUp(self):
+        databaseTestCase.setUp(self)
+        rng = np.random.RandomState(4)
+        self.ra, self.dec = skyPositions(rng, 3000)
+        self.db.addObjectRows([(r, d, None, None, None, None, None)
+                               for r, d in zip(self.ra.tolist(), self.dec.tolist())])
+
+    def select(self, declo, dechi, ralo, rahi):
+        condition, data = database.regionCondition(declo, dechi, ralo, rahi)
+        cursor = self.db.cursor()
+        cursor.execute("SELECT `ra`, `decl` FROM `objects` WHERE %s" % condition, data)
+        rows = cursor.fetchall()
+        cursor.close()
+        return sorted(rows)
+
+    def expected(self, declo, dechi, ralo, rahi):
+        inside = (self.dec >= declo) & (self.dec <= dechi)
+        if rahi - ralo < 360.:
+            ra = np.mod(self.ra - ralo, 360.)
+            inside &= ra <= rahi - ralo
+        return sorted(zip(self.ra[inside].tolist(), self.dec[inside].tolist()))
+
+    def testRegions(self):
+        for region in ((-0.1, 0.1, -0.1, 0.1),          # across RA 0
+                       (-0.1, 0.1, 359.9, 360.1),
+                       (30.1, 30.2, 150.1, 150.3),
+                       (89.9, 90., 0., 360.),           # polar cap
+                       (-1., 1., 0., 400.)):
+            self.assertEqual(self.select(*region), self.expected(*region))
+
+    def testStatementIndependentOfPosition(self):
+        conditions = set(database.regionCondition(dec, dec + 1e-3, 10., 10.001)[0]
+                         for dec in np.linspace(-60., 60., 50))
+        self.assertEqual(len(conditions), 1)
+
+
+class testSexCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as outf:
+            outf.write(text)
+        return filename
+
+    def testHeaderMapping(self):
+        filename = self.write('header.cat',
+                              "#   1 DELTA_J2000\n#   2 ALPHA_J2000\n#   3 MAGERR_AUTO\n#   4 MAG_AUTO\n"
+                              "#   5 Y_IMAGE\n#   6 X_IMAGE\n"
+                              "41.0 10.0 0.01 18.0 20.0 30.0\n"
+                              "41.1 10.1 0.02 19.0 21.0 31.0\n"
+                              "41.2 10.2 0.03 20.0 22.0 32.0\n")
+        chunks = list(odidb.iterSexCatalog(filename, chunksize=2))
+        self.assertEqual([len(chunk['mag']) for chunk in chunks], [2, 1])
+        columns = dict((key, np.concatenate([chunk[key] for chunk in chunks])) for key in chunks[0])
+        np.testing.assert_allclose(columns['decl'], [41.0, 41.1, 41.2])
+        np.testing.assert_allclose(columns['ra'], [10.0, 10.1, 10.2])
+        np.testing.assert_allclose(columns['mag'], [18.0, 19.0, 20.0])
+        np.testing.assert_allclose(columns['magerr'], [0.01, 0.02, 0.03])
+        np.testing.assert_allclose(columns['x'], [30.0, 31.0, 32.0])
+        np.testing.assert_allclose(columns['y'], [20.0, 21.0, 22.0])
+
+    def testLegacyLayout(self):
+        filename = self.write('legacy.cat', "1 18.0 0.01 30.0 20.0 10.0 41.0\n2 19.0 0.02 31.0 21.0 10.1 41.1\n")
+        chunk = list(odidb.iterSexCatalog(filename))[0]
+        np.testing.assert_allclose(chunk['ra'], [10.0, 10.1])
+        np.testing.assert_allclose(chunk['mag'], [18.0, 19.0])
+
+    def testMissingColumn(self):
+        filename = self.write('missing.cat', "#   1 MAG_AUTO\n#   2 MAGERR_AUTO\n18.0 0.01\n")
+        self.assertRaises(ValueError, list, odidb.iterSexCatalog(filename))
+
+    def testWithoutPixelColumns(self):
+        filename = self.write('nopixels.cat', "#   1 ALPHA_J2000\n#   2 DELTA_J2000\n#   3 MAG_AUTO\n#   4 MAGERR_AUTO\n"
+                                              "10.0 41.0 18.0 0.01\n")
+        chunk = list(odidb.iterSexCatalog(filename))[0]
+        self.assertEqual(sorted(chunk), ['decl', 'mag', 'magerr', 'ra'])
+
+
+class testSexIngestor(databaseTestCase):
+
+    def ingest(self, columns, text):
+        odifilename = os.path.join(self.directory, 'exp0.fits')
+        primary = fits.PrimaryHDU()
+        for key, value in (('OBSID', 'exp0'), ('FILTER', 'odi_r'), ('AIRMASS', 1.1), ('EXPTIME', 100.),
+                           ('PHOTZP', 25.), ('DATE-MID', '2016-01-01T00:00:00')):
+            primary.header[key] = value
+        primary.writeto(odifilename)
+
+        sexfilename = os.path.join(self.directory, 'exp0.cat')
+        with open(sexfilename, 'w') as outf:
+            outf.write("".join("#%4d %s\n" % (idx + 1, name) for idx, name in enumerate(columns)) + text)
+        odidb.sextractorIngestor(odifilename, sexfilename, self.db).readSexFile()
+        return np.sort(self.db.getVisitsByExpID('exp0', asarray=True), order='ra')
+
+    def testPixelCoordinates(self):
+        visits = self.ingest(('ALPHA_J2000', 'DELTA_J2000', 'MAG_AUTO', 'MAGERR_AUTO', 'X_IMAGE', 'Y_IMAGE'),
+                             "10.0 41.0 -7.0 0.01 30.6 20.2\n10.1 41.1 -8.0 0.02 31.0 21.0\n")
+        self.assertEqual(visits['odix'].tolist(), [30, 31])
+        self.assertEqual(visits['odiy'].tolist(), [20, 21])
+
+    def testWithoutPixelCoordinates(self):
+        visits = self.ingest(('ALPHA_J2000', 'DELTA_J2000', 'MAG_AUTO', 'MAGERR_AUTO'),
+                             "10.0 41.0 -7.0 0.01\n10.1 41.1 -8.0 0.02\n")
+        self.assertEqual(len(visits), 2)
+        self.assertEqual(visits['odix'].tolist(), [-1, -1])
+        self.assertEqual(visits['odiy'].tolist(), [-1, -1])
+
+
+class testTransaction(databaseTestCase):
+
+    def testRollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.addExposure(makeExposure('exp0'))
+                self.db.addObjectRows([(10., 41., None, None, None, None, None)] * 3)
+                raise RuntimeError("abort")
+        self.assertEqual(self.countRows('exposures'), 0)
+        self.assertEqual(self.countRows('objects'), 0)
+
+        # outside a transaction every write is committed on its own again
+        self.db.addExposure(makeExposure('exp1'))
+        self.assertEqual(self.countRows('exposures'), 1)
+
+    def testCommitEvery(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction(commitEvery=2):
+                for idx in range(5):
+                    self.db.addExposure(makeExposure('exp%d' % idx, idx))
+                    self.assertEqual(self.countRows('exposures'), 2 * ((idx + 1) // 2))
+                raise RuntimeError("abort")
+        # only the row written since the last intermediate commit is rolled back
+        self.assertEqual(self.countRows('exposures'), 4)
+
+    def testErrorReportedOnce(self):
+        self.db.addExposure(makeExposure('exp0'))
+        errors = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = errors.append
+        self.db.log.addHandler(handler)
+        logging.disable(logging.NOTSET)
+        try:
+            # outside a transaction the duplicate is logged and not raised
+            self.db.addExposure(makeExposure('exp0'))
+            self.assertEqual(len(errors), 1)
+            # inside one it is raised to the caller and not logged
+            with self.assertRaises(backends.Error):
+                with self.db.transaction():
+                    self.db.addExposure(makeExposure('exp0'))
+            self.assertEqual(len(errors), 1)
+        finally:
+            logging.disable(logging.CRITICAL)
+            self.db.log.removeHandler(handler)
+
+
+class testExposureCache(unittest.TestCase):
+
+    def testLeastRecentlyUsedEviction(self):
+        cache = database.exposureCache(maxsize=2)
+        for exposureid in ('exp0', 'exp1'):
+            cache.put(exposureid, makeExposure(exposureid))
+        self.assertTrue(cache.get('exp0')[0])
+        cache.put('exp2', makeExposure('exp2'))
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('exp1'), (False, None))
+        self.assertEqual(cache.get('exp0')[1].data['exposureid'], 'exp0')
+        self.assertEqual(cache.stats['evictions'], 1)
+
+
+class testGetExposure(databaseTestCase):
+
+    def testPrefetch(self):
+        for idx in range(3):
+            self.db.addExposure(makeExposure('exp%d' % idx, idx))
+        self.assertEqual(self.db.prefetchExposures(filter='odi_r'), 3)
+
+        hits = self.db.exposureCache.stats['hits']
+        exposure = self.db.getExposure('exp1')
+        self.assertEqual(self.db.exposureCache.stats['hits'], hits + 1)
+        self.assertEqual(exposure.data['exposureid'], 'exp1')
+        self.assertEqual(exposure.data['filter'], 'odi_r')
+
+    def testAddedThroughClone(self):
+        self.assertIsNone(self.db.getExposure('exp0').data['exposureid'])
+        with self.db.clone() as writer:
+            writer.addExposure(makeExposure('exp0'))
+        self.assertEqual(self.db.getExposure('exp0').data['exposureid'], 'exp0')
+
+
+class testConeSearch(databaseTestCase):
+
+    def testConeSearchMatchesBruteForce(self):
+        rng = np.random.RandomState(3)
+        refra, refdec = skyPositions(rng, 3000)
+        self.db.addObjectRows([(r, d, None, None, None, None, None) for r, d in zip(refra.tolist(), refdec.tolist())])
+        objectids, objra, objdec = self.db.getObjectPositions(-90., 90., 0., 360.)
+
+        ra, dec = skyPositions(rng, 300)
+        radius = 60.
+        queryidx, ids, sep = self.db.coneSearch(ra, dec, radius)
+        expected = bruteForcePairs(ra, dec, objra, objdec, radius / 3600.)
+        self.assertEqual(set(zip(queryidx.tolist(), ids.tolist())),
+                         set((query, int(objectids[ref])) for query, ref in expected))
+
+
+class testSqliteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = backends.sqliteBackend(os.path.join(self.directory, 'test.db'))
+        self.conn = self.backend.connect()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def execute(self, sqlCommand, data=()):
+        cursor = self.backend.cursor(self.conn)
+        cursor.execute(sqlCommand, data)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def testSchema(self):
+        statements = self.backend.schema(
+            "CREATE TABLE IF NOT EXISTS `stars` ("
+            " `starid` bigint(20) NOT NULL AUTO_INCREMENT,"
+            " `ra` double NOT NULL,"
+            " `decl` double NOT NULL,"
+            " `zoneid` int GENERATED ALWAYS AS (FLOOR((`decl` + 90.) * 60.)) STORED,"
+            " PRIMARY KEY (`starid`),"
+            " INDEX `zone_ra` (`zoneid`, `ra`),"
+            " KEY (`decl`)"
+            ") ENGINE=InnoDB DEFAULT CHARSET=latin1;")
+        self.assertEqual(statements,
+                         ["CREATE TABLE IF NOT EXISTS `stars` (`starid` INTEGER PRIMARY KEY AUTOINCREMENT,"
+                          " `ra` double NOT NULL, `decl` double NOT NULL,"
+                          " `zoneid` int GENERATED ALWAYS AS (CAST((`decl` + 90.) * 60. AS INTEGER)) STORED)",
+                          "CREATE INDEX IF NOT EXISTS `stars_zone_ra` ON `stars` (`zoneid`, `ra`)",
+                          "CREATE INDEX IF NOT EXISTS `stars_decl` ON `stars` (`decl`)"])
+
+        for statement in statements:
+            self.execute(statement)
+        self.execute("INSERT INTO `stars` (`ra`, `decl`) VALUES (%s, %s)", (10., 41.51))
+        self.execute("INSERT INTO `stars` (`ra`, `decl`) VALUES (%s, %s)", (10., -0.01))
+        self.assertEqual(self.execute("SELECT `starid`, `zoneid` FROM `stars` ORDER BY `starid`"),
+                         [(1, 7890), (2, 5399)])
+
+    def testParameters(self):
+        self.assertEqual(self.backend.translate("SELECT `ra` FROM `stars` WHERE `decl` > %s AND `ra` < %(ralo)s"
+                                                " AND `name` LIKE 'M%%'"),
+                         "SELECT `ra` FROM `stars` WHERE `decl` > ? AND `ra` < :ralo AND `name` LIKE 'M%'")
+
+        self.execute("CREATE TABLE `stars` (`name` TEXT, `ra` REAL)")
+        self.execute("INSERT INTO `stars` (`name`, `ra`) VALUES (%s, %s)", ('M33', 23.46))
+        self.execute("INSERT INTO `stars` (`name`, `ra`) VALUES (%(name)s, %(ra)s)", {'name': 'N300', 'ra': 13.72})
+        self.assertEqual(self.execute("SELECT `name` FROM `stars` WHERE `ra` > %(ralo)s AND `name` LIKE 'M%%'",
+                                      {'ralo': 10.}), [('M33',)])
+
+    def testUpsert(self):
+        self.execute("CREATE TABLE `stats` (`objectid` INTEGER, `filter` TEXT, `nvisits` INTEGER,"
+                     " `first` REAL, `last` REAL, PRIMARY KEY (`objectid`, `filter`))")
+        statement = self.backend.upsert('stats', ('objectid', 'filter', 'nvisits', 'first', 'last'),
+                                        ('objectid', 'filter'), {'nvisits': 'add', 'first': 'min', 'last': 'max'})
+        for row in ((1, 'odi_r', 2, 5., 6.), (1, 'odi_r', 3, 4., 5.), (2, 'odi_r', 1, None, 7.),
+                    (2, 'odi_r', 1, 3., None), (1, 'odi_g', 1, 8., 8.)):
+            self.execute(statement, row)
+
+        self.assertEqual(self.execute("SELECT * FROM `stats` ORDER BY `objectid`, `filter`"),
+                         [(1, 'odi_g', 1, 8., 8.), (1, 'odi_r', 5, 4., 6.), (2, 'odi_r', 2, 3., 7.)])
+
+    def testUpdateJoin(self):
+        self.execute("CREATE TABLE `exposures` (`exposureid` TEXT PRIMARY KEY, `photzp` REAL)")
+        self.execute("CREATE TABLE `visits` (`visitid` INTEGER PRIMARY KEY, `exposureid` TEXT, `mag` REAL, `calmag` REAL)")
+        self.execute("INSERT INTO `exposures` VALUES ('exp0', 25.), ('exp1', 26.), ('exp2', NULL)")
+        self.execute("INSERT INTO `visits` (`exposureid`, `mag`) VALUES"
+                     " ('exp0', -7.), ('exp1', -7.), ('exp1', -8.), ('exp2', -7.), ('exp3', -7.)")
+
+        statement = self.backend.updateJoin('visits', 'v', 'exposures', 'e', "e.exposureid = v.exposureid",
+                                            (('calmag', "v.mag + e.photzp"),), "e.photzp IS NOT NULL AND v.mag > %s")
+        self.execute(statement, (-7.5,))
+
+        self.assertEqual(self.execute("SELECT `calmag` FROM `visits` ORDER BY `visitid`"),
+                         [(18.,), (19.,), (None,), (None,), (None,)])
+
+
+class testSnapshot(databaseTestCase):
+
+    def setUp(self):
+        databaseTestCase.setUp(self)
+        self.addExposures()
+        self.objectids = range(1, 201)
+        self.visits = np.sort(self.db.getVisitTable(self.objectids).array, order='visitid')
+
+    def export(self, compress):
+        directory = os.path.join(self.directory, 'snapshot')
+        chunk = snapshot.EXPORTCHUNK
+        # several chunks per table
+        snapshot.EXPORTCHUNK = 64
+        try:
+            snapshot.exportSnapshot(self.db, directory, compress=compress)
+        finally:
+            snapshot.EXPORTCHUNK = chunk
+        return snapshot.snapshot(directory)
+
+    def assertVisitsEqual(self, visits):
+        visits = np.sort(visits.array, order='visitid')
+        self.assertEqual(visits.dtype, self.visits.dtype)
+        self.assertEqual(len(visits), 600)
+        for name in self.visits.dtype.names:
+            np.testing.assert_array_equal(visits[name], self.visits[name], err_msg=name)
+
+    def testColumnFiles(self):
+        snap = self.export(compress=False)
+        self.assertIsInstance(snap.column('visits', 'mag'), np.memmap)
+        self.assertVisitsEqual(snap.visits(self.objectids))
+        self.assertEqual(sorted(snap.exposures()['exposureid'].tolist()), ['exp0', 'exp1', 'exp2'])
+        self.assertEqual(len(snap.objects()), 200)
+
+    def testCompressed(self):
+        snap = self.export(compress=True)
+        self.assertVisitsEqual(snap.visits(self.objectids))
+        self.assertEqual(len(snap.objects()), 200)
+        self.assertEqual(sorted(os.listdir(snap.directory)),
+                         ['exposures.npz', 'objects.npz', 'snapshot.json', 'visits.npz'])
+
+
+class testObjectStats(databaseTestCase):
+
+    def testIncrementalMatchesRebuild(self):
+        self.addExposures()
+        incremental = np.sort(self.db.getObjectStats(filter='odi_r'), order='objectid')
+        self.db.rebuildObjectStats()
+        rebuilt = np.sort(self.db.getObjectStats(filter='odi_r'), order='objectid')
+
+        self.assertEqual(len(incremental), 200)
+        np.testing.assert_array_equal(incremental['objectid'], rebuilt['objectid'])
+        np.testing.assert_array_equal(incremental['nvisits'], rebuilt['nvisits'])
+        np.testing.assert_allclose(incremental['meanmag'], rebuilt['meanmag'], atol=1e-5)
+        np.testing.assert_allclose(incremental['rms'], rebuilt['rms'], atol=1e-4)
+
+
+class testZeroPoints(databaseTestCase):
+
+    def testApplyZeroPointsIdempotent(self):
+        self.addExposures()
+        self.db.setZeroPoints(['exp0', 'exp1'], [25.5, 24.5], 1)
+        self.assertEqual(self.db.applyZeroPoints(), 3)
+        visits = np.sort(self.db.getVisitTable(range(1, 201)).array, order='visitid')
+        stats = self.db.getObjectStats(filter='odi_r')
+
+        self.assertEqual(self.db.applyZeroPoints(), 0)
+        again = np.sort(self.db.getVisitTable(range(1, 201)).array, order='visitid')
+        np.testing.assert_array_equal(visits['mag'], again['mag'])
+        np.testing.assert_array_equal(stats['meanmag'], self.db.getObjectStats(filter='odi_r')['meanmag'])
+
+        exp0 = visits['exposureid'] == 'exp0'
+        np.testing.assert_allclose(visits['mag'][exp0], visits['instmag'][exp0] + 25.5 + 5., atol=1e-4)
+
+    def testApplyZeroPointsError(self):
+        self.addExposures()
+        self.db.setZeroPoints(['exp0', 'exp1', 'exp2'], [25.5, 24.5, 25.], 1)
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("CREATE TRIGGER `failcal` BEFORE UPDATE ON `visits` WHEN NEW.`exposureid` = 'exp1'"
+                           " BEGIN SELECT RAISE(ABORT, 'calibration failed'); END")
+            cursor.close()
+            conn.commit()
+        self.db.ZPCHUNK = 1
+
+        applied = self.db.applyZeroPoints()
+        self.assertLess(applied, 3)
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT `exposureid` FROM `exposures` WHERE `calversion` = 1")
+            calibrated = [str(row[0]) for row in cursor.fetchall()]
+            cursor.close()
+        self.assertEqual(len(calibrated), applied)
+        self.assertNotIn('exp1', calibrated)
+
+
+class testUbercal(unittest.TestCase):
+
+    def simulate(self, seed=5):
+        rng = np.random.RandomState(seed)
+        nstars = 300
+        exposures = np.repeat(['a', 'b', 'c', 'd'], nstars)
+        objectids = np.tile(np.arange(nstars), 4)
+        offsets = {'a': 0.05, 'b': -0.03, 'c': 0.01, 'd': -0.03}
+        mag = (rng.uniform(15., 20., nstars)[objectids] - np.array([offsets[e] for e in exposures]) +
+               rng.normal(0., 0.005, len(objectids)))
+        # a few gross outliers
+        mag[rng.choice(len(mag), 5, replace=False)] += 1.
+        return exposures, objectids, mag, np.full(len(mag), 0.005), offsets
+
+    def testRecoversOffsets(self):
+        exposures, objectids, mag, magerr, offsets = self.simulate()
+        solution = ubercal.ubercalSolver(exposures, objectids, mag, magerr).solve()
+        self.assertEqual(solution['exposureid'].tolist(), ['a', 'b', 'c', 'd'])
+        np.testing.assert_allclose(solution['offset'], [offsets[e] for e in 'abcd'], atol=2e-3)
+        self.assertEqual(np.sum(solution['nrejected']), 5)
+
+    def testPerOTAWithoutOTA(self):
+        exposures, objectids, mag, magerr, offsets = self.simulate()
+        # exposure a has no OTA information at all, the others only for half of the visits
+        ota = np.where(np.arange(len(mag)) % 2 == 0, 33, -1)
+        ota[exposures == 'a'] = -1
+        solution = ubercal.ubercalSolver(exposures, objectids, mag, magerr, ota=ota, perOTA=True).solve()
+
+        self.assertEqual(zip(solution['exposureid'].tolist(), solution['ota'].tolist()),
+                         [('a', -1), ('b', -1), ('b', 33), ('c', -1), ('c', 33), ('d', -1), ('d', 33)])
+        np.testing.assert_allclose(solution['offset'], [offsets[e] for e in solution['exposureid']], atol=3e-3)
+        perexposure = ubercal.exposureOffsets(solution)
+        np.testing.assert_allclose(perexposure['offset'], [offsets[e] for e in 'abcd'], atol=2e-3)
 
 
 if __name__ == '__main__':
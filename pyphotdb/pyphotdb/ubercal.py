@@ -0,0 +1,277 @@
+'''
+Global relative photometric calibration ("ubercal") across matched exposures.
+
+Every object observed in several exposures ties the zero points of these exposures
+together. The solver finds per exposure (or per exposure and OTA) offsets d that minimize
+
+    sum over visits  w * (mag + d[exposure] - M[object])^2,     w = 1 / (magerr^2 + SYSERR^2)
+
+where M are the unknown object magnitudes. The object magnitudes are eliminated analytically
+(M is the weighted mean of mag + d over the visits of an object), which leaves a sparse, positive
+semi-definite system in the offsets alone. It is solved matrix-free with preconditioned conjugate
+gradients, so memory and time per iteration are linear in the number of visits. The overall
+level of every connected group of exposures is kept at its mean header zero point. The worst
+visit of every object deviating by more than NSIGMA is rejected and the system solved again.
+
+    solution = ubercal.solveZeroPoints(db, filter='odi_r', write=True)
+    db.applyZeroPoints()
+
+@author: harbeck
+'''
+
+import logging
+import time
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+
+# systematic error floor added in quadrature to magerr, in magnitudes
+SYSERR = 0.005
+
+# visits with larger errors do not enter the solution
+MAXMAGERR = 0.1
+
+# outlier rejection threshold in units of the visit error, and maximum number of rejection rounds
+NSIGMA = 4.
+MAXITER = 10
+
+# tolerance and iteration limit of the conjugate gradient solver
+CGTOL = 1e-10
+CGMAXITER = 10000
+
+# record layout of a zero point solution; ota is -1 for per exposure offsets
+SOLUTIONDTYPE = np.dtype([('exposureid', 'S20'), ('ota', np.int32), ('offset', np.float64),
+                          ('offseterr', np.float64), ('nvisits', np.int64), ('nrejected', np.int64)])
+
+log = logging.getLogger('ubercal')
+
+
+class ubercalSolver (object):
+    '''
+    Zero point offsets from matched visits given as parallel arrays.
+
+    With perOTA, every OTA of every exposure gets its own offset; otherwise all OTAs of an
+    exposure share one.
+    '''
+
+    def __init__ (self, exposureids, objectids, mag, magerr, ota=None, perOTA=False,
+                  syserr=SYSERR, nsigma=NSIGMA, maxiter=MAXITER):
+        exposureids = np.asarray(exposureids)
+        self.perOTA = perOTA
+        self.nsigma = nsigma
+        self.maxiter = maxiter
+
+        self.mag = np.asarray(mag, dtype=np.float64)
+        magerr = np.asarray(magerr, dtype=np.float64)
+        self.sigma = np.sqrt(magerr * magerr + syserr * syserr)
+        self.weight = 1. / (self.sigma * self.sigma)
+
+        # parameter (exposure or exposure-OTA) and object index of every visit
+        self.exposures, expidx = np.unique(exposureids, return_inverse=True)
+        if perOTA:
+            # visits without OTA (ota -1, e.g. from SExtractor catalogues) share one parameter per exposure
+            keys = np.zeros(len(expidx), dtype=[('exposure', np.int64), ('ota', np.int64)])
+            keys['exposure'] = expidx
+            keys['ota'] = ota
+            self.parameters, self.pidx = np.unique(keys, return_inverse=True)
+            self.parexposure = self.parameters['exposure']
+            self.parota = self.parameters['ota'].astype(np.int32)
+        else:
+            self.pidx = expidx
+            self.parexposure = np.arange(len(self.exposures))
+            self.parota = np.full(len(self.exposures), -1, dtype=np.int32)
+        self.objects, self.oidx = np.unique(np.asarray(objectids, dtype=np.int64), return_inverse=True)
+
+        self.npar = len(self.parota)
+        self.nobj = len(self.objects)
+        self.used = np.isfinite(self.mag) & np.isfinite(self.weight)
+
+    def _objectMean (self, values, weight):
+        '''
+        Weighted mean of values per object.
+        '''
+        wsum = np.bincount(self.oidx, weights=weight, minlength=self.nobj)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.bincount(self.oidx, weights=weight * values, minlength=self.nobj) / wsum
+
+    def _solveOnce (self, weight):
+        '''
+        Offsets d for visit weights weight (0 for rejected visits). Returns (d, error estimate, converged).
+        '''
+        pidx = self.pidx
+        oidx = self.oidx
+        wobj = np.bincount(oidx, weights=weight, minlength=self.nobj)
+
+        def apply (x):
+            # C x = A^T W (x[pidx] - xbar[oidx]), xbar the weighted mean of x per object
+            xv = x[pidx]
+            xbar = self._objectMean(xv, weight)
+            xbar[~np.isfinite(xbar)] = 0.
+            return np.bincount(pidx, weights=weight * (xv - xbar[oidx]), minlength=self.npar)
+
+        mbar = self._objectMean(self.mag, weight)
+        residual = np.where(weight > 0, self.mag - mbar[oidx], 0.)
+        rhs = -np.bincount(pidx, weights=weight * residual, minlength=self.npar)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diagonal = np.bincount(pidx, weights=weight * (1. - np.where(wobj[oidx] > 0, weight / wobj[oidx], 0.)),
+                                   minlength=self.npar)
+        constrained = diagonal > 1e-12 * np.max(diagonal) if self.npar > 0 and np.max(diagonal) > 0 \
+            else np.zeros(self.npar, dtype=bool)
+        preconditioner = np.where(constrained, 1. / np.where(constrained, diagonal, 1.), 0.)
+
+        operator = scipy.sparse.linalg.LinearOperator((self.npar, self.npar), matvec=apply, dtype=np.float64)
+        precond = scipy.sparse.linalg.LinearOperator((self.npar, self.npar), matvec=lambda x: preconditioner * x,
+                                                     dtype=np.float64)
+        # absolute tolerance: a residual equivalent to offsets of about CGTOL magnitudes
+        offsets, info = scipy.sparse.linalg.cg(operator, rhs, M=precond, tol=CGTOL, maxiter=CGMAXITER,
+                                               atol=CGTOL * np.sqrt(np.sum(diagonal * diagonal)))
+        offsets[~constrained] = 0.
+
+        # fix the free level of every connected group of parameters: zero weighted mean offset
+        components = self._components(weight)
+        parweight = np.bincount(pidx, weights=weight, minlength=self.npar)
+        ncomp = np.max(components) + 1 if self.npar > 0 else 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            level = (np.bincount(components, weights=parweight * offsets, minlength=ncomp) /
+                     np.bincount(components, weights=parweight, minlength=ncomp))
+        offsets -= np.where(np.isfinite(level), level, 0.)[components]
+
+        with np.errstate(divide='ignore'):
+            error = np.where(constrained, 1. / np.sqrt(np.where(constrained, diagonal, 1.)), np.nan)
+        return offsets, error, info == 0
+
+    def _components (self, weight):
+        '''
+        Connected component of every parameter in the graph linking parameters through shared objects.
+        '''
+        used = weight > 0
+        rows = self.pidx[used]
+        cols = self.npar + self.oidx[used]
+        size = self.npar + self.nobj
+        graph = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(size, size)).tocsr()
+        ncomp, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        return np.unique(labels[:self.npar], return_inverse=True)[1]
+
+    def solve (self):
+        '''
+        Solve with iterative outlier rejection. Returns a SOLUTIONDTYPE array with one row per parameter.
+        '''
+        start = time.time()
+        rejected = np.zeros(len(self.mag), dtype=bool)
+        for iteration in range(self.maxiter):
+            accepted = self.used & ~rejected
+            weight = np.where(accepted, self.weight, 0.)
+            # objects seen only once carry no information about the offsets
+            nvisits = np.bincount(self.oidx, weights=accepted, minlength=self.nobj)
+            weight[nvisits[self.oidx] < 2] = 0.
+
+            offsets, error, converged = self._solveOnce(weight)
+            if not converged:
+                log.warn("Conjugate gradient solution did not converge")
+
+            # reject the worst visit of every object beyond nsigma; one outlier drags the mean
+            # of its object, so the other visits are only judged again after the next solution
+            calibrated = self.mag + offsets[self.pidx]
+            model = self._objectMean(calibrated, weight)
+            deviation = np.where(weight > 0, np.abs(calibrated - model[self.oidx]) / self.sigma, 0.)
+            worst = np.zeros(self.nobj)
+            np.maximum.at(worst, self.oidx, deviation)
+            outlier = (deviation > self.nsigma) & (deviation >= worst[self.oidx])
+            log.info("Iteration %d: %d visits, %d parameters, %d rejected" %
+                     (iteration, int(np.sum(weight > 0)), self.npar, int(np.sum(outlier))))
+            if not np.any(outlier):
+                break
+            rejected |= outlier
+
+        solution = np.zeros(self.npar, dtype=SOLUTIONDTYPE)
+        solution['exposureid'] = self.exposures[self.parexposure]
+        solution['ota'] = self.parota
+        solution['offset'] = offsets
+        solution['offseterr'] = error
+        solution['nvisits'] = np.bincount(self.pidx, weights=weight > 0, minlength=self.npar)
+        solution['nrejected'] = np.bincount(self.pidx, weights=rejected, minlength=self.npar)
+
+        log.info("Solved %d zero point offsets from %d visits of %d objects in %.1f s" %
+                 (self.npar, int(np.sum(weight > 0)), self.nobj, time.time() - start))
+        return solution
+
+
+def exposureOffsets (solution):
+    '''
+    Per exposure offsets of a per OTA solution: the inverse variance weighted mean over its OTAs.
+    '''
+    if len(solution) == 0 or np.all(solution['ota'] < 0):
+        return solution
+    exposures, inverse = np.unique(solution['exposureid'], return_inverse=True)
+    good = np.isfinite(solution['offseterr'])
+    weight = np.where(good, 1. / np.where(good, solution['offseterr'], 1.) ** 2, 0.)
+    wsum = np.bincount(inverse, weights=weight)
+
+    result = np.zeros(len(exposures), dtype=SOLUTIONDTYPE)
+    result['exposureid'] = exposures
+    result['ota'] = -1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['offset'] = np.where(wsum > 0, np.bincount(inverse, weights=weight * solution['offset']) / wsum, 0.)
+        result['offseterr'] = np.where(wsum > 0, 1. / np.sqrt(wsum), np.nan)
+    result['nvisits'] = np.bincount(inverse, weights=solution['nvisits'])
+    result['nrejected'] = np.bincount(inverse, weights=solution['nrejected'])
+    return result
+
+
+def solveZeroPoints (db, filter=None, exposureids=None, perOTA=False, write=False, version=None,
+                     maxmagerr=MAXMAGERR, **kwargs):
+    '''
+    Solve relative zero points for the matched visits of a filter and / or exposure list in db.
+
+    Visits are streamed from the database; only the few columns needed are kept in memory.
+    With write, the per exposure zero points photzp + offset are stored with db.setZeroPoints as
+    calibration version (default: one above the highest in use); db.applyZeroPoints then brings
+    the calibrated magnitudes up to date. Per OTA offsets are only returned, as the exposures
+    table holds a single zero point per exposure. Exposures without a zero point are skipped.
+    Extra keyword arguments go to ubercalSolver. Returns the SOLUTIONDTYPE array.
+    '''
+    start = time.time()
+    columns = {'exposureid': [], 'objectid': [], 'mag': [], 'magerr': [], 'ota': []}
+    for visits in db.iterVisits(filter=filter, exposureids=exposureids, minVisits=2):
+        good = visits['magerr'] <= maxmagerr
+        for name in columns:
+            columns[name].append(visits[name][good])
+    for name in columns:
+        columns[name] = np.concatenate(columns[name]) if len(columns[name]) > 0 else np.zeros(0)
+    log.info("Loaded %d visits in %.1f s" % (len(columns['mag']), time.time() - start))
+
+    if len(columns['mag']) == 0:
+        return np.zeros(0, dtype=SOLUTIONDTYPE)
+
+    solver = ubercalSolver(columns['exposureid'], columns['objectid'], columns['mag'], columns['magerr'],
+                           ota=columns['ota'], perOTA=perOTA, **kwargs)
+    solution = solver.solve()
+
+    if write:
+        offsets = exposureOffsets(solution)
+        if version is None:
+            version = _currentVersion(db) + 1
+        exposureids = []
+        photzp = []
+        for exposureid, offset in zip(offsets['exposureid'].tolist(), offsets['offset'].tolist()):
+            header = db.getExposure(exposureid).data['photzp']
+            if header is None:
+                log.warn("Exposure %s has no zero point to correct, skipped" % exposureid)
+                continue
+            exposureids.append(exposureid)
+            photzp.append(header + offset)
+        db.setZeroPoints(exposureids, photzp, version)
+        log.info("Stored zero points of %d exposures as version %d" % (len(exposureids), version))
+    return solution
+
+
+def _currentVersion (db):
+    cursor = db.cursor()
+    cursor.execute("SELECT MAX(`zpversion`) FROM `exposures`")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return int(version or 0)